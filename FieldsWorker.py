@@ -3,8 +3,8 @@ from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRunnable, pyqtSlot, QThr
 import traceback
 import sys
 from WorkerSignals import WorkerSignals
+import device_broker
 from teslameter_3MH6 import teslameter_3MH6
-mutex = QMutex()
 
 
 class FieldsWorker(QRunnable):
@@ -20,6 +20,7 @@ class FieldsWorker(QRunnable):
 
     def run(self):
         """Task to read Hall probe fields and emit signal"""
+        session = device_broker.broker(HP=self.HP).shared('fields', ['probe'])  # waits while a scan or move holds it
         try:
             fields = self.HP.get_fields(self.averages)  # read current field data from Teslameter
         except:
@@ -36,4 +37,5 @@ class FieldsWorker(QRunnable):
             self.signals.result.emit([bx, by, bz, temp])  # emit fields to GUI to update display
 
         finally:
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
@@ -4,7 +4,7 @@ import traceback
 import sys
 import datetime
 from WorkerSignals import WorkerSignals
-mutex = QMutex()
+import device_broker
 
 class GlobalMoveWorker(QRunnable):
     """Runnable class to move motors to global position"""
@@ -25,6 +25,7 @@ class GlobalMoveWorker(QRunnable):
 
     def run(self):
         """Function to move Hall probe relative distance and track progress"""
+        session = device_broker.broker(self.mc).exclusive('global move', ['stage'])  # no monitor reads until released
         try:
             x0 = self.xa.get_position()  # get starting x position
             y0 = self.ya.get_position()  # get starting y position
@@ -90,6 +91,7 @@ class GlobalMoveWorker(QRunnable):
                                               "{:.3f}".format(current_z_position)])
 
         finally:
+            session.release()  # let monitors and other workers use the devices again
             print('emit finished signal')
             self.signals.finished.emit()
             print('finish signal emitted')
\ No newline at end of file
@@ -5,7 +5,7 @@ import sys
 import time
 import datetime
 from WorkerSignals import WorkerSignals
-mutex = QMutex()
+import device_broker
 import numpy as np
 import csv
 
@@ -24,7 +24,7 @@ class MotorSettingsWorker(QRunnable):
     def run(self):
         """Task to read motor positions and emit signal"""
         global mc
-        mutex.lock()  # lock access to motor controller class
+        session = device_broker.broker(self.mc).shared('motor settings', ['stage'])
         try:
             x_speed = "{:.1f}".format(self.xa.getSpeed())
             y_speed = "{:.1f}".format(self.ya.getSpeed())
@@ -47,5 +47,5 @@ class MotorSettingsWorker(QRunnable):
             self.signals.result.emit(
                 [x_speed, y_speed, z_speed, x_lower, x_upper, y_lower, y_upper, z_lower, z_upper])  # emit fields
         finally:
-            mutex.unlock()
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
\ No newline at end of file
@@ -2,13 +2,14 @@ import PyQt5
 from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRunnable, pyqtSlot, QThreadPool, QMutex
 import traceback
 import sys
-import time
 import datetime
 from WorkerSignals import WorkerSignals
+import device_broker
 
-mutex = QMutex()
 import numpy as np
-import csv
+import instrumentation
+import scan_output
+import scan_plan
 
 
 class MultipoleScanWorker(QRunnable):
@@ -16,7 +17,6 @@ class MultipoleScanWorker(QRunnable):
 
     def __init__(self, HP, mc, x0, y0, r0, steps, z0, z1, dz, filename, averages):
         super(MultipoleScanWorker, self).__init__()
-        mutex.lock()
         self.signals = WorkerSignals()
         self.isRun = True  # isRun flag = true; do not stop action
 
@@ -34,11 +34,13 @@ class MultipoleScanWorker(QRunnable):
         self.dz = float(dz)  # z interval
         self.filename = filename  # filename to save csv to
         self.averages = averages  # number of samples to use in fields average
+        self.raw_samples = False  # also save samples used in each average (binary columnar output only)
 
         print('scan worker initialised')
 
     def run(self):
         """Function to move Hall probe relative distance and track progress"""
+        session = device_broker.broker(self.mc, self.HP).exclusive('multipole scan')  # no monitor reads until released
         try:
             print('scan worker running')
             x_lims = self.xa.getLimits()
@@ -71,19 +73,14 @@ class MultipoleScanWorker(QRunnable):
         else:  # if no exceptions
             print('starting scan')
 
-            theta_values = np.linspace(0, 2 * np.pi, int(self.steps), endpoint=False)  # values of theta
+            # Points around a circle at each z value, angles in theta
+            plan = scan_plan.CylindricalPlan(self.x0, self.y0, self.r0, self.steps, self.z0, self.z1, self.dz)
 
-            z_np = int(1 + abs(float(self.z1) - float(self.z0)) / float(self.dz))  # number of intervals along x
-
-            print('z0, z1, dz, np = ', self.z0, self.z1, self.dz, z_np)
-
-            z_values = np.linspace(float(self.z0), float(self.z1), z_np)  # array of x coordinate values
-
-            print('z values = ', z_values)
+            print('z values = ', plan.z_values)
 
             self.distance = 0
             count = 0  # number of points measured
-            total_count = len(theta_values) * len(z_values)
+            total_count = len(plan)
 
             header_list = ['Time', 'theta / rad', 'x / mm', 'y / mm', 'z / mm', 'bx / mT', 'by / mT', 'bz / mT',
                            'std(bx) / mT',
@@ -91,37 +88,28 @@ class MultipoleScanWorker(QRunnable):
                            'std(bz) / mT', 'T / C',
                            'std(T) / C']
 
-            with open(self.filename, "w", newline='') as f:  # write data to csv file
-                dw = csv.DictWriter(f, delimiter=',',
-                                    fieldnames=header_list)
-                dw.writeheader()
-                writer = csv.writer(f, delimiter=",")
+            self.HP.start_stream()  # start probe broadcast once for the whole scan
+
+            # csv file, or binary columns if filename ends .npycols
+            with scan_output.open_scan_writer(self.filename, header_list, self.raw_samples) as writer:
 
                 while self.distance < 100:
-                    for i in range(len(z_values)):
+                    for start, stop in zip(*plan.line_bounds()):  # one circle at each z value
                         print('Move to z coordinate')
-                        self.za.move(z_values[i], wait=True)
-                        for j in range(len(theta_values)):
+                        self.mc.move_to({'z': plan.points[start, 2]})
+                        for j in range(start, stop):
                             print('Move to angular position!')
 
-                            x_pos = round(self.x0 + self.r0 * np.cos(theta_values[j]), 3)  # new x coordinate to 3 d.p.
-                            y_pos = round(self.y0 + self.r0 * np.sin(theta_values[j]), 3)  # new y coordinate to 3 d.p.
+                            x_pos, y_pos = plan.points[j, :2]  # x, y coordinates to 3 d.p.
 
                             print('x pos = ', x_pos)
                             print('y pos = ', y_pos)
 
-                            if 0 < theta_values[j] < np.pi / 2 or np.pi < theta_values[j] < 3 * np.pi / 2:
-                                self.xa.move(x_pos, wait=True)  # move x axis, wait til reach position
-                                self.ya.move(y_pos, wait=True)  # move y axis, wait til reach position
-                            else:
-                                self.ya.move(y_pos, wait=True)  # move y axis, wait til reach position
-                                self.xa.move(x_pos, wait=True)  # move x axis, wait til reach position
+                            self.mc.move_to({'x': x_pos, 'y': y_pos})  # move x and y together, wait til reach position
 
                             print('read the positions')
                             # Read motor controller positions
-                            x = self.xa.get_position()
-                            y = self.ya.get_position()
-                            z = self.za.get_position()
+                            x, y, z = self.mc.get_positions(['x', 'y', 'z'])  # query all three axes at once
 
                             print('positions read - get the fields')
 
@@ -132,11 +120,8 @@ class MultipoleScanWorker(QRunnable):
                             print('got the fields - write to csv')
 
                             # Write positions measurements to csv file
-                            writer.writerow(
-                                [datetime.datetime.now(), "{:.3f}".format(theta_values[j]), "{:.3f}".format(x),
-                                 "{:.3f}".format(y), "{:.3f}".format(z), fields[0], fields[1], fields[2], fields[3],
-                                 fields[4], fields[5],
-                                 fields[6], fields[7]])
+                            writer.writerow([datetime.datetime.now(), plan.theta[j], x, y, z] + list(fields),
+                                            samples=self.HP.last_block)  # raw samples kept if saving them
                             print('Position = ', x, y, z)
                             print('Fields = ', fields[0], fields[1], fields[2])
 
@@ -155,7 +140,6 @@ class MultipoleScanWorker(QRunnable):
                             self.distance = int(
                                 100 * (count / total_count))  # increase dummy variable to the nearest integer value
                             self.signals.progress.emit(self.distance - 1)
-                            time.sleep(0.1)
 
                             if not self.isRun:  # check if STOP button pressed
                                 print('Scan cancelled!')  # print to console
@@ -174,7 +158,9 @@ class MultipoleScanWorker(QRunnable):
             # Emit signal
             print('no errors')
         finally:
+            self.HP.stop_stream()  # stop probe broadcast if it was started
+            instrumentation.save_scan_stats(self.filename)  # serial statistics, if collected
             print('emit finished signal')
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
             print('finish signal emitted')
-            mutex.unlock()
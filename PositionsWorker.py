@@ -3,8 +3,7 @@ from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRunnable, pyqtSlot, QThr
 import traceback
 import sys
 from WorkerSignals import WorkerSignals
-mutex = QMutex()
-
+import device_broker
 
 
 class PositionsWorker(QRunnable):
@@ -22,11 +21,12 @@ class PositionsWorker(QRunnable):
     def run(self):
         """Task to read motor positions and emit signal"""
         #global mc
-        #mutex.lock()  # lock access to motor controller class
+        session = device_broker.broker(self.mc).shared('positions', ['stage'])  # waits while a scan or move holds it
         try:
-            x_pos = "{:.3f}".format(self.xa.get_position())
-            y_pos = "{:.3f}".format(self.ya.get_position())
-            z_pos = "{:.3f}".format(self.za.get_position())
+            x, y, z = self.mc.get_positions(['x', 'y', 'z'])  # pipelined query of all three axes
+            x_pos = "{:.3f}".format(x)
+            y_pos = "{:.3f}".format(y)
+            z_pos = "{:.3f}".format(z)
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
@@ -35,5 +35,5 @@ class PositionsWorker(QRunnable):
             # Emit signal
             self.signals.result.emit([x_pos, y_pos, z_pos])  # emit fields
         finally:
-            #mutex.unlock()
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
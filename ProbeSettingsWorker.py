@@ -5,7 +5,7 @@ import sys
 import time
 import datetime
 from WorkerSignals import WorkerSignals
-mutex = QMutex()
+import device_broker
 import numpy as np
 import csv
 
@@ -20,36 +20,43 @@ class ProbeSettingsWorker(QRunnable):
 
     def run(self):
         """Task to read probe settings and emit signal"""
+        session = device_broker.broker(HP=self.HP).shared('probe settings', ['probe'])
         try:
-            range = self.HP.get_range()  # query current measurement range
-            sample_rate = "{:.0f}".format(self.HP.get_sample_rate())
+            settings = read_probe_settings(self.HP)
         except:
             traceback.print_exc()
             exctype, value = sys.exc_info()[:2]
             self.signals.error.emit((exctype, value, traceback.format_exc()))
         else:  # if no exceptions
-
-            if self.HP.type() == '3MH6':
-                if range[0:6] == 'mrng:2':  # if range 2
-                    range_string = 'Measurement Range = 500 mT'
-                elif range[0:6] == 'mrng:3':  # if range 3
-                    range_string = 'Measurement Range = 2 T'
-                else:  # if not range 2 or 3
-                    range_string = 'Measurement Range = ?'
-
-            elif self.HP.type() == '3MTS':
-                print('3mts probe')
-                range_list = ['100 mT', '500 mT', '3 T', '20 T']
-                print('range = ', range)
-                range_string = 'Measurement Range = ' + range_list[range]
-
-            elif self.HP.type() == '3MH3':
-                print('3MH3 teslameter')
-                range_list = ['2 T']
-                print('range = ', range)
-                range_string = 'Measurement Range = ' + range_list[range]
-
             # Emit signal
-            self.signals.result.emit([range_string, sample_rate])  # emit fields
+            self.signals.result.emit(settings)  # emit fields
         finally:
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
+
+
+def read_probe_settings(HP):
+    """Return [range description, sample rate] of probe as strings for the GUI"""
+    range = HP.get_range()  # query current measurement range
+    sample_rate = "{:.0f}".format(HP.get_sample_rate())
+
+    if HP.type() == '3MH6':
+        if range[0:6] == 'mrng:2':  # if range 2
+            range_string = 'Measurement Range = 500 mT'
+        elif range[0:6] == 'mrng:3':  # if range 3
+            range_string = 'Measurement Range = 2 T'
+        else:  # if not range 2 or 3
+            range_string = 'Measurement Range = ?'
+
+    elif HP.type() == '3MTS':
+        range_list = ['100 mT', '500 mT', '3 T', '20 T']
+        range_string = 'Measurement Range = ' + range_list[range]
+
+    elif HP.type() == '3MH3':
+        range_list = ['2 T']
+        range_string = 'Measurement Range = ' + range_list[range]
+
+    else:
+        range_string = 'Measurement Range = ?'
+
+    return [range_string, sample_rate]
@@ -4,8 +4,7 @@ import traceback
 import sys
 import datetime
 from WorkerSignals import WorkerSignals
-
-mutex = QMutex()
+import device_broker
 
 
 class RelativeMoveWorker(QRunnable):
@@ -28,6 +27,7 @@ class RelativeMoveWorker(QRunnable):
     def run(self):
         """Function to move Hall probe relative distance and track progress"""
         print('running', datetime.datetime.now())
+        session = device_broker.broker(self.mc).exclusive('relative move', ['stage'])  # no monitor reads until released
         try:
             print('get positions', datetime.datetime.now())
             x0 = self.xa.get_position()  # get starting x position
@@ -105,4 +105,5 @@ class RelativeMoveWorker(QRunnable):
                                               "{:.3f}".format(current_z_position)])  # emit signals for updating GUI
 
         finally:
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
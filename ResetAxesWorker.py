@@ -4,8 +4,7 @@ import traceback
 import sys
 import datetime
 from WorkerSignals import WorkerSignals
-
-mutex = QMutex()
+import device_broker
 
 
 class ResetAxesWorker(QRunnable):
@@ -24,6 +23,7 @@ class ResetAxesWorker(QRunnable):
 
     def run(self):
         """Function to send reset commands to motor controller axes if runtime error has been raised"""
+        session = device_broker.broker(self.mc).exclusive('reset axes', ['stage'])  # no monitor reads until released
         try:
             self.xa.reset()
             self.distance = 25  # update progress bar
@@ -47,4 +47,5 @@ class ResetAxesWorker(QRunnable):
             self.signals.progress.emit(self.distance - 1)
 
         finally:
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
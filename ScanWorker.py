@@ -7,8 +7,7 @@ import sys
 import time
 import datetime
 from WorkerSignals import WorkerSignals
-
-mutex = QMutex()  # imported so that Teslameter and motor controller classes only accessed by this function
+import device_broker
 
 
 class ScanWorker(QRunnable):
@@ -16,7 +15,6 @@ class ScanWorker(QRunnable):
 
     def __init__(self, HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order, filename, averages):
         super(ScanWorker, self).__init__()
-        mutex.lock()
         self.signals = WorkerSignals()
         self.isRun = True  # isRun flag = true; do not stop action
 
@@ -42,6 +40,7 @@ class ScanWorker(QRunnable):
 
     def run(self):
         """Function to move Hall probe over 3D volume and track progress"""
+        session = device_broker.broker(self.mc, self.HP).exclusive('scan')  # no monitor reads until released
         try:  # check if entered measurement volume is within motor controller soft limits
             x_lims = self.xa.getLimits()
             y_lims = self.ya.getLimits()
@@ -198,6 +197,6 @@ class ScanWorker(QRunnable):
             print('no errors')
         finally:
             print('emit finished signal')
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
             print('finish signal emitted')
-            mutex.unlock()
@@ -0,0 +1,160 @@
+import PyQt5
+from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRunnable, pyqtSlot, QThreadPool, QMutex
+import traceback
+import sys
+import datetime
+import numpy as np
+import instrumentation
+import scan_output
+import scan_plan
+import scan_planner
+from WorkerSignals import WorkerSignals
+import device_broker
+
+
+class ScanWorker_adaptive(QRunnable):
+    """Runnable class to scan over 3D coordinates and record fields - coarse grid, then extra points where the
+    field is changing fastest"""
+
+    def __init__(self, HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order, filename, averages, tolerance, max_points):
+        super(ScanWorker_adaptive, self).__init__()
+        self.signals = WorkerSignals()
+        self.isRun = True  # isRun flag = true; do not stop action
+
+        self.HP = HP  # Teslameter class
+        self.mc = mc  # motor controller class
+        self.xa = mc.axis['x']  # motor controller x axis
+        self.ya = mc.axis['y']  # motor controller y axis
+        self.za = mc.axis['z']  # motor controller z axis
+        self.x0 = float(x0)  # start x
+        self.x1 = float(x1)  # end x
+        self.dx = float(dx)  # x interval of coarse grid
+        self.y0 = float(y0)  # start y
+        self.y1 = float(y1)  # end y
+        self.dy = float(dy)  # y interval of coarse grid
+        self.z0 = float(z0)  # start z
+        self.z1 = float(z1)  # end z
+        self.dz = float(dz)  # z interval of coarse grid
+        self.order = order  # scan order of coarse grid
+        self.filename = filename  # filename to save csv to
+        self.averages = averages  # number of samples to use in fields average
+        self.raw_samples = False  # also save samples used in each average (binary columnar output only)
+        self.tolerance = float(tolerance)  # acceptable error interpolating linearly between points / mT
+        self.max_points = int(max_points)  # most points to measure in total
+        self.max_level = 4  # number of times coarse grid spacing can be halved
+        self.plan_time = 2  # longest time to spend ordering each batch of new points / s
+
+    def run(self):
+        """Function to move Hall probe over 3D volume, refining where needed, and track progress"""
+        session = device_broker.broker(self.mc, self.HP).exclusive('adaptive scan')  # no monitor reads until released
+        try:
+            # Read current soft limits from motor controller axes
+            x_lims = self.xa.getLimits()
+            y_lims = self.ya.getLimits()
+            z_lims = self.za.getLimits()
+            x_lower = (x_lims[0])
+            x_upper = (x_lims[1])
+            y_lower = (y_lims[0])
+            y_upper = (y_lims[1])
+            z_lower = (z_lims[0])
+            z_upper = (z_lims[1])
+            # Check movement is in soft limit range and raise exception if not
+            if self.x0 < x_lower or self.x1 > x_upper:
+                raise Exception
+
+            if self.y0 < y_lower or self.y1 > y_upper:
+                raise Exception
+
+            if self.z1 < z_lower or self.z1 > z_upper:
+                raise Exception
+
+        except:
+            traceback.print_exc()
+            exctype, value = sys.exc_info()[:2]
+            self.signals.error.emit((exctype, value, traceback.format_exc()))  # send error signal to main GUI
+        else:  # if no exceptions - run adaptive scan
+            plan = scan_plan.AdaptivePlan(self.x0, self.x1, self.dx, self.y0, self.y1, self.dy, self.z0, self.z1,
+                                          self.dz, self.order, self.tolerance, self.max_level)
+            kinematics = scan_planner.axis_kinematics(self.mc)
+            todo = plan.first_points()  # lattice indices of points to measure next, coarse grid first
+            print('Adaptive scan - coarse grid of {} points, up to {} points in total'.format(len(todo),
+                                                                                           self.max_points))
+
+            self.distance = 0  # normalised distance value used to calculate % completion for progress bar
+            count = 0  # number of points measured
+            total_count = max(self.max_points, len(todo))  # most points which will be measured
+
+            header_list = ['Time', 'x / mm', 'y / mm', 'z / mm', 'bx / mT', 'by / mT', 'bz / mT', 'std(bx) / mT',
+                           'std(by) / mT',
+                           'std(bz) / mT', 'T / C',
+                           'std(T) / C']
+
+            self.HP.start_stream()  # start probe broadcast once for the whole scan
+
+            # csv file, or binary columns if filename ends .npycols
+            with scan_output.open_scan_writer(self.filename, header_list, self.raw_samples) as writer:
+                while todo and self.isRun:
+                    for index, (x_target, y_target, z_target) in zip(todo, plan.positions(todo)):
+                        try:
+                            # move all three motors together - only those not already in place actually move
+                            self.mc.move_to({'x': x_target, 'y': y_target, 'z': z_target}, tolerance=1E-3)
+                        except ValueError as e:
+                            print('ValueError, Keep going, ', e)
+
+                        # Read actual motor controller positions
+                        x, y, z = self.mc.get_positions(['x', 'y', 'z'])  # query all three axes at once
+
+                        # Take field measurements
+                        fields = self.HP.get_fields(
+                            self.averages)  # get fields averaged from n samples from Tesla-meter
+                        plan.add(index, fields)
+
+                        # Write position and field measurements to csv file
+                        writer.writerow([datetime.datetime.now(), x, y, z] + list(fields),
+                                        samples=self.HP.last_block)  # raw samples kept if saving them
+                        print('Position = ', x, y, z)
+                        print('Fields = ', fields[0], fields[1], fields[2])
+
+                        # Format fields and temperatures to export to GUI
+                        bx = "{:.3f}".format(fields[0])
+                        by = "{:.3f}".format(fields[1])
+                        bz = "{:.3f}".format(fields[2])
+                        temp = "{:.3f}".format(fields[6])
+
+                        # emit positions and fields to update GUI
+                        self.signals.result.emit(
+                            ["{:.3f}".format(x), "{:.3f}".format(y), "{:.3f}".format(z), bx, by, bz,
+                             temp])
+
+                        # Update step count and emit signal to update GUI progress bar
+                        count += 1
+                        self.distance = int(
+                            100 * (count / total_count))  # increase dummy variable to the nearest integer value
+                        self.signals.progress.emit(self.distance - 1)
+
+                        if not self.isRun:  # check if STOP button pressed
+                            # Send STOP command to motor axes
+                            self.xa.stop()
+                            self.ya.stop()
+                            self.za.stop()
+                            break  # break out of movement loop
+                    else:
+                        # Add points where interpolation error is too large, visiting them in a short tour
+                        error = plan.max_error()
+                        todo = plan.refine(self.max_points - count)
+                        if todo:
+                            start = self.mc.get_positions(['x', 'y', 'z'])
+                            path = scan_planner.tour(plan.positions(todo), kinematics, start, self.plan_time)
+                            todo = [todo[i] for i in path]
+                            print('Largest error estimate {} mT - refining with {} more points'.format(
+                                '{:.4f}'.format(error) if np.isfinite(error) else 'unknown', len(todo)))
+
+            print('Adaptive scan finished - {} points, largest error estimate {:.4f} mT'.format(count,
+                                                                                            plan.max_error()))
+
+        finally:
+            self.HP.stop_stream()  # stop probe broadcast if it was started
+            instrumentation.save_scan_stats(self.filename)  # serial statistics, if collected
+            # emit finished signal to GUI
+            session.release()  # let monitors and other workers use the devices again
+            self.signals.finished.emit()
@@ -2,13 +2,14 @@ import PyQt5
 from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRunnable, pyqtSlot, QThreadPool, QMutex
 import traceback
 import sys
-import time
 import datetime
 from WorkerSignals import WorkerSignals
+import device_broker
 
-mutex = QMutex()
 import numpy as np
-import csv
+import instrumentation
+import scan_output
+import scan_plan
 
 
 class ScanWorker_boundary(QRunnable):
@@ -16,7 +17,6 @@ class ScanWorker_boundary(QRunnable):
 
     def __init__(self, HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order, filename, averages):
         super(ScanWorker_boundary, self).__init__()
-        mutex.lock()
         self.signals = WorkerSignals()
         self.isRun = True  # isRun flag = true; do not stop action
 
@@ -37,11 +37,13 @@ class ScanWorker_boundary(QRunnable):
         self.order = order  # scan order
         self.filename = filename  # filename to save csv to
         self.averages = averages  # number of samples to use in fields average
+        self.raw_samples = False  # also save samples used in each average (binary columnar output only)
 
         print('scan worker initialised ', datetime.datetime.now())
 
     def run(self):
         """Function to move Hall probe relative distance and track progress"""
+        session = device_broker.broker(self.mc, self.HP).exclusive('boundary scan')  # no monitor reads until released
         try:
             print('scan worker running ', datetime.datetime.now())
             x_lims = self.xa.getLimits()
@@ -74,121 +76,35 @@ class ScanWorker_boundary(QRunnable):
         else:  # if no exceptions
             print('starting scan')
 
-            # Establish list of coordinate values
-            def raster(x0, x1, dx, y0, y1, dy, z):
-                """Function to raster scan over 2d plane and return list of coordinates"""
-
-                x_np = int(1 + abs(float(x1) - float(x0)) / float(dx))  # number of intervals along x
-                x_values = np.linspace(float(x0), float(x1), x_np)  # array of x coordinate values
-                y_np = int(1 + abs(float(y1) - float(y0)) / float(dy))  # number of intervals along x
-                y_values = np.linspace(float(y0), float(y1), y_np)  # array of x coordinate values
-
-                coordinates = []  # list to store coordinate values in
-
-                for y in y_values:
-                    for x in x_values:
-                        point = [x, y, z]
-                        coordinates.append(point)
-
-                    x_values = np.flip(x_values)  # reverse order of x value for raster scanning
-
-                return coordinates
-
-            def boundary(x0, x1, dx, y0, y1, dy, z):
-                """Function to scan over 2d plane boundary and return list of coordinates"""
-
-                x_np = int(1 + abs(float(x1) - float(x0)) / float(dx))  # number of intervals along x
-                y_np = int(1 + abs(float(y1) - float(y0)) / float(dy))  # number of intervals along x
-
-                if x1 < x0:
-                    dx = -dx
-                if y1 < y0:
-                    dy = -dy
-
-                coordinates = []  # list to store coordinate values in
-
-                # Line1 (x0, y0) -> (x1-dx, y0)
-                x_vals = np.linspace(x0, x1 - dx, x_np - 1)
-                for x in x_vals:
-                    coordinates.append([x, y0, z])
-
-                # Line2 (x1, y0) -> (x1, y1-dy)
-                y_vals = np.linspace(y0, y1 - dy, y_np - 1)
-                for y in y_vals:
-                    coordinates.append([x1, y, z])
-
-                # Line3 (x1, y1) -> (x0+dx, y1)
-                x_vals = np.linspace(x1, x0 + dx, x_np - 1)
-                for x in x_vals:
-                    coordinates.append([x, y1, z])
-
-                # Line4 (x0, y1) -> (x0, y0+dy)
-                y_vals = np.linspace(y1, y0 + dy, y_np - 1)
-                for y in y_vals:
-                    coordinates.append([x0, y, z])
-
-                return coordinates
-
-            # raster scan in first z plane
-            rasterz0 = (raster(self.x0, self.x1, self.dx, self.y0, self.y1, self.dy, self.z0))
-
-            # Determine z coordaintes of planes in main body (where only boundary values scanned)
-            z_np = int(1 + abs(float(self.z1) - float(self.z0)) / float(self.dz))  # number of intervals along x
-            z_values = np.linspace(float(self.z0), float(self.z1), z_np)  # array of x coordinate values
-            z_planes = z_values[1:-1]
-
-            all_points = rasterz0  # list of all coordinates begins with raster can on z0 plane
-
-            y_np = int(1 + abs(float(self.y1) - float(self.y0)) / float(self.dy))
-
-            # Add boundary data around central z planes
-            for z in z_planes:
-                if y_np % 2 == 0:  # if even number of y_points
-                    boundary_vals = boundary(self.x0, self.x1, self.dx, self.y1, self.y0, self.dy, z)
-                else:  # if order number of y_points, different starting x coordinate
-                    boundary_vals = boundary(self.x1, self.x0, self.dx, self.y1, self.y0, self.dy, z)
-
-                all_points += boundary_vals
-
-            # Finally, add coordinates for raster scan in z1 plane
-            if y_np % 2 == 0:  # if even number of y_points
-                rasterz1 = raster(self.x0, self.x1, self.dx, self.y1, self.y0, self.dy, self.z1)
-            else:
-                rasterz1 = raster(self.x1, self.x0, self.dx, self.y1, self.y0, self.dy, self.z1)
-
-            all_points += rasterz1
+            # Full planes at either end of z, just the x-y edge in between
+            plan = scan_plan.BoundaryPlan(self.x0, self.x1, self.dx, self.y0, self.y1, self.dy, self.z0, self.z1,
+                                          self.dz)
 
             self.distance = 0
             count = 0  # number of points measured
-            total_count = len(all_points)  # total number of points to scan over
+            total_count = len(plan)  # total number of points to scan over
 
             header_list = ['Time', 'x / mm', 'y / mm', 'z / mm', 'bx / mT', 'by / mT', 'bz / mT', 'std(bx) / mT',
                            'std(by) / mT',
                            'std(bz) / mT', 'T / C',
                            'std(T) / C']
 
-            with open(self.filename, "w", newline='') as f:  # write data to csv file
-                dw = csv.DictWriter(f, delimiter=',',
-                                    fieldnames=header_list)
-                dw.writeheader()
-                writer = csv.writer(f, delimiter=",")
+            self.HP.start_stream()  # start probe broadcast once for the whole scan
+
+            # csv file, or binary columns if filename ends .npycols
+            with scan_output.open_scan_writer(self.filename, header_list, self.raw_samples) as writer:
 
                 while self.distance < 100:
-                    for point in all_points:  # for each coordinate to be scanned
+                    for point in plan.points:  # for each coordinate to be scanned
                         try:
-                            self.xa.move(point[0], wait=True)  # move x axis to x coordinate
-                            self.ya.move(point[1], wait=True)  # move y axis to y coordinate
-                            self.za.move(point[2], wait=True)  # move z axis to z coordinate
+                            # move all axes together to coordinate, wait until all reach position
+                            self.mc.move_to({'x': point[0], 'y': point[1], 'z': point[2]})
                         except ValueError as e:  # if value error due to incorrect response, keep going
                             print('ValueError, Keep going, ', e)
 
-                        time.sleep(0.5)  # wait for motor controllers to settle
-
                         print('read the positions ', datetime.datetime.now())
                         # Read motor controller positions
-                        x = self.xa.get_position()
-                        y = self.ya.get_position()
-                        z = self.za.get_position()
+                        x, y, z = self.mc.get_positions(['x', 'y', 'z'])  # query all three axes at once
 
                         print('positions read - get the fields', datetime.datetime.now())
 
@@ -199,11 +115,8 @@ class ScanWorker_boundary(QRunnable):
                         print('got the fields - write to csv ', datetime.datetime.now())
 
                         # Write positions measurements to csv file
-                        writer.writerow(
-                            [str(datetime.datetime.now()), "{:.3f}".format(x), "{:.3f}".format(y),
-                             "{:.3f}".format(z), fields[0], fields[1], fields[2], fields[3], fields[4],
-                             fields[5],
-                             fields[6], fields[7]])
+                        writer.writerow([datetime.datetime.now(), x, y, z] + list(fields),
+                                        samples=self.HP.last_block)  # raw samples kept if saving them
                         print('Position = ', x, y, z)
                         print('Fields = ', fields[0], fields[1], fields[2])
 
@@ -222,7 +135,6 @@ class ScanWorker_boundary(QRunnable):
                         self.distance = int(
                             100 * (count / total_count))  # increase dummy variable to the nearest integer value
                         self.signals.progress.emit(self.distance - 1)
-                        time.sleep(0.1)
 
                         if not self.isRun:  # check if STOP button pressed
                             print('Scan cancelled!')  # print to console
@@ -240,7 +152,9 @@ class ScanWorker_boundary(QRunnable):
             # Emit signal
             print('no errors')
         finally:
+            self.HP.stop_stream()  # stop probe broadcast if it was started
+            instrumentation.save_scan_stats(self.filename)  # serial statistics, if collected
             print('emit finished signal')
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
             print('finish signal emitted')
-            mutex.unlock()
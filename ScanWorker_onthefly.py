@@ -5,10 +5,14 @@ import sys
 import time
 import datetime
 from WorkerSignals import WorkerSignals
+import device_broker
 
-mutex = QMutex()
 import numpy as np
-import csv
+import instrumentation
+import scan_output
+import scan_plan
+import position_fusion
+import time_calibration
 
 
 def arange(start, stop=None, step=1.0):
@@ -28,7 +32,6 @@ class ScanWorker_onthefly(QRunnable):
 
     def __init__(self, HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order, filename, averages, scan_speed):
         super(ScanWorker_onthefly, self).__init__()
-        mutex.lock()
         self.signals = WorkerSignals()
         self.isRun = True  # isRun flag = true; do not stop action
 
@@ -49,12 +52,17 @@ class ScanWorker_onthefly(QRunnable):
         self.order = order  # scan order
         self.filename = filename  # filename to save csv to
         self.averages = averages  # number of samples to use in fields average
+        self.raw_samples = False  # also save samples used in each average (binary columnar output only)
         self.scan_speed = scan_speed # speed selected by user to perform scan
+        self.continuous = True  # stream fields and fuse with logged positions, if probe can stream; else use triggers
+        self.poll_interval = 0.1  # time between position reads while scanning a line continuously / s
+        self.line_margin = 10  # time allowed beyond predicted line scan time before giving up on the axis / s
 
         print('scan worker initialised ', datetime.datetime.now())
 
     def run(self):
         """Function to move Hall probe relative distance and track progress"""
+        session = device_broker.broker(self.mc, self.HP).exclusive('on the fly scan')  # no monitor reads until released
         try:
             print('scan worker running ', datetime.datetime.now())
             x_lims = self.xa.getLimits()
@@ -87,213 +95,167 @@ class ScanWorker_onthefly(QRunnable):
         else:  # if no exceptions
             print('starting scan')
 
-            x_np = int(1 + abs(float(self.x1) - float(self.x0)) / float(self.dx))  # number of intervals along x
-            x_values = np.linspace(float(self.x0), float(self.x1), x_np)  # array of x coordinate values
-            y_np = int(1 + abs(float(self.y1) - float(self.y0)) / float(self.dy))  # number of intervals along x
-            y_values = np.linspace(float(self.y0), float(self.y1), y_np)  # array of x coordinate values
-            z_np = int(1 + abs(float(self.z1) - float(self.z0)) / float(self.dz))  # number of intervals along x
-            z_values = np.linspace(float(self.z0), float(self.z1), z_np)  # array of x coordinate values
-
-            motors = []  # list to store motor objects in
-            positions = []  # list to store position coordinates in
-
-            # Set order to scan coordinates in
-            # 0=zxy, 1=zyx, 2=xyz, 3=xzy, 4=yzx, 5=yxz
-            # Scan u,v,w arrays
-            if self.order == 0:  # zxy
-                motors = [self.za, self.xa, self.ya]
-                positions = [z_values, x_values, y_values]
-            elif self.order == 1:  # zyx
-                motors = [self.za, self.ya, self.xa]
-                positions = [z_values, y_values, x_values]
-            elif self.order == 2:  # xyz
-                motors = [self.xa, self.ya, self.za]
-                positions = [x_values, y_values, z_values]
-            elif self.order == 3:  # xzy
-                motors = [self.xa, self.za, self.ya]
-                positions = [x_values, z_values, y_values]
-            elif self.order == 4:  # yzx
-                motors = [self.ya, self.za, self.xa]
-                positions = [y_values, z_values, x_values]
-            elif self.order == 5:  # yxz
-                motors = [self.ya, self.xa, self.za]
-                positions = [y_values, x_values, z_values]
+            # Grid in serpentine order - each line is scanned on the fly along the first (fastest) axis
+            plan = scan_plan.GridPlan(self.x0, self.x1, self.dx, self.y0, self.y1, self.dy, self.z0, self.z1,
+                                      self.dz, self.order)
+            motors = [self.mc.axis[axis] for axis in plan.axes]  # motor axes from fastest to slowest
+            fast = 'xyz'.index(plan.axes[0])  # column of on the fly axis in plan points
 
             self.distance = 0
             count = 0  # number of points measured
-            total_count = len(x_values) * len(y_values) * len(z_values)
+            total_count = len(plan)
 
             header_list = ['Time', 'x / mm', 'y / mm', 'z / mm', 'bx / mT', 'by / mT', 'bz / mT', 'std(bx) / mT',
                            'std(by) / mT',
                            'std(bz) / mT', 'T / C',
                            'std(T) / C']
 
-            # Initialise write port output settings
-            on_time = 20  # pulse on time / ms
-            port = 1
-            step = positions[0][1] - positions[0][0]
-            print('write port modulus step = ', step)
-            motors[0].initialiseTrigger(0, step, on_time, port)
+            speed0 = motors[0].getSpeed()  # current speed of motor before scan
+            print('current speed = ', speed0)
+
+            self.HP.start_stream()  # start probe broadcast once for the whole scan
+            continuous = self.continuous and getattr(self.HP, 'streaming', False)
+
+            if not continuous:
+                # Initialise write port output settings
+                on_time = 20  # pulse on time / ms
+                port = 1
+                step = plan.values[plan.axes[0]][1] - plan.values[plan.axes[0]][0]
+                print('write port modulus step = ', step)
+                motors[0].initialiseTrigger(0, step, on_time, port)
+
+                # Calculate reasonable timeout for wait for pulse function
+                timeout = abs(10*(step/float(self.scan_speed)))  # timeout = 10 times expected time between pulses
+                print('timeout = ', timeout)
+
+            # csv file, or binary columns if filename ends .npycols
+            with scan_output.open_scan_writer(self.filename, header_list, self.raw_samples) as writer:
+
+                if continuous:
+                    try:
+                        self.scan_continuous(plan, fast, writer, speed0)
+                    except:
+                        traceback.print_exc()
+                        exctype, value = sys.exc_info()[:2]
+                        self.signals.error.emit((exctype, value, traceback.format_exc()))
+
+                while self.distance < 100 and not continuous:
+                    for first, last in zip(*plan.line_bounds()):
+                        line = plan.points[first:last]  # x, y, z of points along this line
+                        start = line[0, fast]  # start of on the fly scan
+                        stop = line[-1, fast]  # end of on the fly scan
+
+                        print('Move to start')
+                        # move slower axes to next line and on the fly axis back to start together
+                        self.mc.move_to({'x': line[0, 0], 'y': line[0, 1], 'z': line[0, 2]},
+                                        tolerance=0.005, timeout=3600)
+
+                        time.sleep(1)  # wait 1 second
+
+                        print('read the positions ', datetime.datetime.now())
+                        # Read motor controller positions
+                        x, y, z = self.mc.get_positions(['x', 'y', 'z'])  # query all three axes at once
+
+                        print('positions read - get the fields', datetime.datetime.now())
+
+                        # Take field measurements
+                        fields = self.HP.get_fields(
+                            self.averages)  # get fields averaged from n samples from Tesla-meter
+
+                        print('got the fields - write to csv ', datetime.datetime.now())
+
+                        # Write positions measurements to csv file
+                        writer.writerow([datetime.datetime.now(), x, y, z] + list(fields),
+                                        samples=self.HP.last_block)  # raw samples kept if saving them
+                        print('Position = ', x, y, z)
+                        print('Fields = ', fields[0], fields[1], fields[2])
+
+                        bx = "{:.3f}".format(fields[0])
+                        by = "{:.3f}".format(fields[1])
+                        bz = "{:.3f}".format(fields[2])
+                        temp = "{:.3f}".format(fields[6])
+
+                        self.signals.result.emit(
+                            ["{:.3f}".format(x), "{:.3f}".format(y), "{:.3f}".format(z), bx, by, bz,
+                             temp])  # emit positions and fields to update GUI
+
+                        print('positions and fields emitted ', datetime.datetime.now())
+
+                        count += 1
+                        self.distance = int(
+                            100 * (count / total_count))  # increase dummy variable to the nearest integer value
+                        self.signals.progress.emit(self.distance - 1)
+                        time.sleep(0.1)
+
+                        direction_sign = np.copysign(1, stop - start)
+
+                        print('setting speed to ', self.scan_speed)
+
+                        motors[0].setSpeed(float(self.scan_speed))
+
+                        print('Moving to:', stop)
+                        motors[0].move(
+                            stop + direction_sign * 0.1)  # move a tiny bit further so we definitely hit the last trigger point
+
+                        time.sleep(0.05)  # short sleep so first trigger is not at start point
+
+                        for point in line[1:]:  # for each position along line, wait for trigger, measure fields
+                            trigger_at = point[fast]
+                            pos_now = motors[0].get_position()
+                            print(f'Waiting for position {trigger_at}, now at {pos_now}')
+                            try:
+                                if np.copysign(1,
+                                               trigger_at - pos_now) != direction_sign:  # already passed the trigger!
+                                    raise MissedTriggerError(
+                                        f'Missed trigger at {trigger_at}, already at {pos_now}')
+                            except MissedTriggerError:
+                                print('oh no, missed trigger!')
+                                self.isRun = False  # stop scan
+                                self.signals.error.emit(
+                                    ("MissedTrigger", "MissedTrigger",
+                                     traceback.format_exc()))  # raise warning to user
+                                writer.writerow(['Missed Trigger'])  # write line in csv file
+
+                            try:
+                                motors[0].waitforPulse(port, timeout)
+                            except TimeoutError:
+                                print('oh no, timed out waiting for trigger!')
+                                self.isRun = False  # stop scan
+                                self.signals.error.emit(
+                                    ("Timeout", "Timeout",
+                                     traceback.format_exc()))  # raise warning to user
+                                writer.writerow(['Timeout Waiting for Trigger'])  # write line in csv file
 
-            # Calculate reasonable timeout for wait for pulse function
-            timeout = abs(10*(step/float(self.scan_speed)))  # timeout = 10 times expected time between pulses
-            print('timeout = ', timeout)
-
-            with open(self.filename, "w", newline='') as f:  # write data to csv file
-                dw = csv.DictWriter(f, delimiter=',',
-                                    fieldnames=header_list)
-                dw.writeheader()
-                writer = csv.writer(f, delimiter=",")
-
-                while self.distance < 100:
-                    for i in range(len(positions[2])):
-                        print('Move motor 3!')
-                        motors[2].move(positions[2][i], wait=True)
-                        for j in range(len(positions[1])):
-                            print('Move motor 2!')
-                            motors[1].move(positions[1][j], wait=True)  # move motor 2, wait til reach position
-
-                            start = positions[0][0]  # start of on the fly scan
-                            stop = positions[0][-1]  # end of on the fly scan
-
-                            print('Move to start')
-                            motors[0].move(start, wait=True, tolerance=0.005, timeout=3600)
-
-                            time.sleep(1)  # wait 1 second
-
-                            print('read the positions ', datetime.datetime.now())
-                            # Read motor controller positions
-                            x = self.xa.get_position()
-                            y = self.ya.get_position()
-                            z = self.za.get_position()
-
-                            print('positions read - get the fields', datetime.datetime.now())
-
-                            # Take field measurements
                             fields = self.HP.get_fields(
                                 self.averages)  # get fields averaged from n samples from Tesla-meter
 
-                            print('got the fields - write to csv ', datetime.datetime.now())
-
-                            # Write positions measurements to csv file
-                            writer.writerow(
-                                [str(datetime.datetime.now()), "{:.3f}".format(x), "{:.3f}".format(y),
-                                 "{:.3f}".format(z), fields[0], fields[1], fields[2], fields[3], fields[4], fields[5],
-                                 fields[6], fields[7]])
-                            print('Position = ', x, y, z)
-                            print('Fields = ', fields[0], fields[1], fields[2])
-
-                            bx = "{:.3f}".format(fields[0])
-                            by = "{:.3f}".format(fields[1])
-                            bz = "{:.3f}".format(fields[2])
-                            temp = "{:.3f}".format(fields[6])
-
-                            self.signals.result.emit(
-                                ["{:.3f}".format(x), "{:.3f}".format(y), "{:.3f}".format(z), bx, by, bz,
-                                 temp])  # emit positions and fields to update GUI
-
-                            print('positions and fields emitted ', datetime.datetime.now())
-
                             count += 1
                             self.distance = int(
                                 100 * (count / total_count))  # increase dummy variable to the nearest integer value
                             self.signals.progress.emit(self.distance - 1)
                             time.sleep(0.1)
 
-                            direction_sign = np.copysign(1, stop - start)
-
-                            speed0 = motors[0].getSpeed() # current speed of motor before scan
-                            print('current speed = ', speed0)
-                            print('setting speed to ', self.scan_speed)
-
-                            motors[0].setSpeed(float(self.scan_speed))
-
-                            print('Moving to:', stop)
-                            motors[0].move(
-                                stop + direction_sign * 0.1)  # move a tiny bit further so we definitely hit the last trigger point
-
-                            time.sleep(0.05)  # short sleep so first trigger is not at start point
-
-                            for k, pos in enumerate(positions[0][1:]):  # for each position in array, wait for trigger, measure fields
-                                trigger_at = pos
-                                pos_now = motors[0].get_position()
-                                print(f'Waiting for position {trigger_at}, now at {pos_now}')
-                                try:
-                                    if np.copysign(1,
-                                                   trigger_at - pos_now) != direction_sign:  # already passed the trigger!
-                                        raise MissedTriggerError(
-                                            f'Missed trigger at {trigger_at}, already at {pos_now}')
-                                except MissedTriggerError:
-                                    print('oh no, missed trigger!')
-                                    self.isRun = False  # stop scan
-                                    self.signals.error.emit(
-                                        ("MissedTrigger", "MissedTrigger",
-                                         traceback.format_exc()))  # raise warning to user
-                                    writer.writerow(['Missed Trigger'])  # write line in csv file
-
-                                try:
-                                    motors[0].waitforPulse(port, timeout)
-                                except TimeoutError:
-                                    print('oh no, timed out waiting for trigger!')
-                                    self.isRun = False  # stop scan
-                                    self.signals.error.emit(
-                                        ("Timeout", "Timeout",
-                                         traceback.format_exc()))  # raise warning to user
-                                    writer.writerow(['Timeout Waiting for Trigger'])  # write line in csv file
-
-                                fields = self.HP.get_fields(
-                                    self.averages)  # get fields averaged from n samples from Tesla-meter
-
-                                count += 1
-                                self.distance = int(
-                                    100 * (count / total_count))  # increase dummy variable to the nearest integer value
-                                self.signals.progress.emit(self.distance - 1)
-                                time.sleep(0.1)
-
-                                if not self.isRun:  # check if STOP button pressed
-                                    print('Scan cancelled!')  # print to console
-                                    # Send STOP command to motor
-                                    self.xa.stop()
-                                    self.ya.stop()
-                                    self.za.stop()
-
-                                    time.sleep(1) # sleep for a second to let axes settle
-
-                                    break  # break out of loop
-
-                                current_cmd_positions = positions[0][k + 1], positions[1][j], positions[2][
-                                    i]  # current command positions
-
-                                if self.order == 0:
-                                    z, x, y = current_cmd_positions
-                                elif self.order == 1:
-                                    z, y, x = current_cmd_positions
-                                elif self.order == 2:
-                                    x, y, z = current_cmd_positions
-                                elif self.order == 3:
-                                    x, z, y = current_cmd_positions
-                                elif self.order == 4:
-                                    y, z, x = current_cmd_positions
-                                elif self.order == 5:
-                                    y, x, z = current_cmd_positions
-
-                                # Write positions measurements to csv file
-                                writer.writerow(
-                                    [str(datetime.datetime.now()), "{:.3f}".format(x), "{:.3f}".format(y),
-                                     "{:.3f}".format(z), fields[0], fields[1], fields[2], fields[3], fields[4],
-                                     fields[5],
-                                     fields[6], fields[7]])
-
-                            else:
-                                print('line scan successful')
-                                positions[0] = np.flip(
-                                    positions[0])  # reverse order of axis 1 to reduce total scan time
-                                continue
-                            break  # break out of v values loop if stop button pressed
+                            if not self.isRun:  # check if STOP button pressed
+                                print('Scan cancelled!')  # print to console
+                                # Send STOP command to motor
+                                self.xa.stop()
+                                self.ya.stop()
+                                self.za.stop()
+
+                                time.sleep(1) # sleep for a second to let axes settle
+
+                                break  # break out of loop
+
+                            x, y, z = point  # current command positions
+
+                            # Write positions measurements to csv file
+                            writer.writerow([datetime.datetime.now(), x, y, z] + list(fields),
+                                            samples=self.HP.last_block)  # raw samples kept if saving them
+
                         else:
-                            positions[1] = np.flip(positions[1])  # reverse order of axis 2 to reduce total scan time
+                            print('line scan successful')  # next line runs the other way to reduce total scan time
                             continue
-                        break  # break out of w value loop if stop button pressed
+                        break  # break out of lines loop if stop button pressed
                     else:
                         continue
                     break  # break out of while loop
@@ -306,7 +268,103 @@ class ScanWorker_onthefly(QRunnable):
                 print('error resetting speed')
 
         finally:
+            self.HP.stop_stream()  # stop probe broadcast if it was started
+            instrumentation.save_scan_stats(self.filename)  # serial statistics, if collected
             print('emit finished signal')
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
             print('finish signal emitted')
-            mutex.unlock()
+
+    def scan_continuous(self, plan, fast, writer, speed0):
+        """Scan each line at constant speed while the probe streams, then interpolate fields onto the line's points.
+
+        The axis position is read a few times a second during each line and fitted with the commanded trapezoidal
+        move to give the position at every field sample's timestamp, so line speed is limited by the stage, not by
+        serial round trips."""
+        motor = self.mc.axis[plan.axes[0]]  # on the fly axis
+        count = 0  # number of points measured
+        for first, last in zip(*plan.line_bounds()):
+            line = plan.points[first:last]  # x, y, z of points along this line
+            start = line[0, fast]  # start of on the fly scan
+            stop = line[-1, fast]  # end of on the fly scan
+            direction_sign = np.copysign(1, stop - start)
+
+            print('Move to start')
+            motor.setSpeed(speed0)
+            self.mc.move_to({'x': line[0, 0], 'y': line[0, 1], 'z': line[0, 2]}, tolerance=0.005, timeout=3600)
+            arrived = time.time()  # samples from now on are at the start of the line until the axis moves
+
+            # Log actual positions with the time each read was latched by the controller
+            calibration = time_calibration.profile
+            log_times = []
+            log_positions = []
+            t1 = time.time()
+            log_positions.append(motor.get_position(set_value=False))
+            log_times.append(calibration.stage_time(t1, time.time()))
+
+            motor.setSpeed(float(self.scan_speed))
+            t1 = time.time()
+            end = stop + direction_sign * 0.1  # move a tiny bit further so the last point is passed at speed
+            motor.send_move(end)
+            profile = position_fusion.MoveProfile(log_positions[0], end, calibration.stage_time(t1, time.time()),
+                                                  float(self.scan_speed), motor.acceleration)
+            print('Scanning line to', stop, 'expected time = ', profile.duration())
+            deadline = profile.t0 + profile.duration() + self.line_margin  # axis stuck if still moving after this
+
+            while True:
+                time.sleep(self.poll_interval)
+                t1 = time.time()
+                log_positions.append(motor.get_position(set_value=False))
+                log_times.append(calibration.stage_time(t1, time.time()))
+                if not self.isRun:  # check if STOP button pressed
+                    break
+                if log_times[-1] > profile.t0 + profile.duration() and not motor.is_busy():
+                    break
+                if t1 > deadline:
+                    motor.stop()
+                    raise TimeoutError('Axis {} still moving {:.0f} s after line scan to {} should have finished'
+                                       .format(plan.axes[0], self.line_margin, stop))
+            finished = time.time()
+
+            if not self.isRun:
+                print('Scan cancelled!')  # print to console
+                # Send STOP command to motor
+                self.xa.stop()
+                self.ya.stop()
+                self.za.stop()
+                time.sleep(1)  # sleep for a second to let axes settle
+                break
+
+            # Fuse field stream with reconstructed positions - the probe driver has already corrected sample times
+            # for its measured delay (see time_calibration)
+            samples = self.HP.buffer.window(arrived, finished)
+            if len(samples):
+                sample_times = samples[:, 4]
+                positions = position_fusion.reconstruct(sample_times, log_times, log_positions, profile)
+                values, deviations = position_fusion.fuse(positions, samples[:, :4], line[:, fast], self.averages)
+                nearest = np.abs(positions[None, :] - line[:, fast, None]).argmin(axis=1)  # sample nearest each point
+                point_times = sample_times[nearest]
+                print('line scan successful - {} samples, {} positions read'.format(len(samples), len(log_times)))
+            else:  # stream stalled or dropped out - no fields for this line
+                values = deviations = np.full((len(line), 4), np.nan)
+                point_times = np.full(len(line), finished)
+                print('No field samples during line scan - fields of its points not measured')
+
+            for point, value, deviation, point_time in zip(line, values, deviations, point_times):
+                x, y, z = point  # command positions
+                fields = [value[0], value[1], value[2], deviation[0], deviation[1], deviation[2], value[3],
+                          deviation[3]]
+                if np.isnan(value[0]):
+                    print('No field samples at position', point)
+
+                # Write positions measurements to csv file
+                writer.writerow([datetime.datetime.fromtimestamp(point_time), x, y, z] + fields)
+
+                self.signals.result.emit(
+                    ["{:.3f}".format(x), "{:.3f}".format(y), "{:.3f}".format(z), "{:.3f}".format(fields[0]),
+                     "{:.3f}".format(fields[1]), "{:.3f}".format(fields[2]),
+                     "{:.3f}".format(fields[6])])  # emit positions and fields to update GUI
+
+                count += 1
+                self.distance = int(100 * (count / len(plan)))  # increase dummy variable to the nearest integer value
+                self.signals.progress.emit(self.distance - 1)
@@ -2,13 +2,14 @@ import PyQt5
 from PyQt5.QtCore import QObject, QThread, pyqtSignal, QRunnable, pyqtSlot, QThreadPool, QMutex
 import traceback
 import sys
-import time
 import datetime
 import numpy as np
-import csv
+import instrumentation
+import scan_output
+import scan_plan
+import scan_planner
 from WorkerSignals import WorkerSignals
-
-mutex = QMutex()
+import device_broker
 
 
 class ScanWorker_random_sample(QRunnable):
@@ -16,7 +17,6 @@ class ScanWorker_random_sample(QRunnable):
 
     def __init__(self, HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order, filename, averages, number_points):
         super(ScanWorker_random_sample, self).__init__()
-        mutex.lock()  # lock motor controller and Teslameter classes to this function
         self.signals = WorkerSignals()
         self.isRun = True  # isRun flag = true; do not stop action
 
@@ -37,10 +37,13 @@ class ScanWorker_random_sample(QRunnable):
         self.order = order  # scan order
         self.filename = filename  # filename to save csv to
         self.averages = averages  # number of samples to use in fields average
+        self.raw_samples = False  # also save samples used in each average (binary columnar output only)
         self.number_points = int(number_points)  # number of points to sample
+        self.plan_time = 10  # longest time to spend finding a quick order to visit the points / s
 
     def run(self):
         """Function to move Hall probe over 3D volume and track progress"""
+        session = device_broker.broker(self.mc, self.HP).exclusive('random sample scan')
         try:
             # Read current soft limits from motor controller axes
             x_lims = self.xa.getLimits()
@@ -70,16 +73,16 @@ class ScanWorker_random_sample(QRunnable):
 
             print('Scanning over random points, number = ', self.number_points)
 
-            # Create lists of random points within one step size of measurement volume
-            x_points = np.random.uniform(low=self.x0 + self.dx, high=self.x1 - self.dx, size=(self.number_points,))
-            y_points = np.random.uniform(low=self.y0 + self.dy, high=self.y1 - self.dy, size=(self.number_points,))
-            z_points = np.random.uniform(low=self.z0 + self.dz, high=self.z1 - self.dz, size=(self.number_points,))
-            z_points = np.sort(z_points)  # put z values in ascending order to reduce measurement time
+            # Random points within one step size of measurement volume, to 10 um precision - achievable with PM1000
+            plan = scan_plan.RandomPlan(self.x0, self.x1, self.dx, self.y0, self.y1, self.dy, self.z0, self.z1,
+                                        self.dz, self.number_points)
 
-            # Truncate points to 10 um precision - achievable with PM1000 motor controllers
-            x_points = [np.around(x, 2) for x in x_points]
-            y_points = [np.around(y, 2) for y in y_points]
-            z_points = [np.around(z, 2) for z in z_points]
+            # Visit points in a short tour from the current position, weighting moves by each axis's travel time
+            kinematics = scan_planner.axis_kinematics(self.mc)
+            start = self.mc.get_positions(['x', 'y', 'z'])
+            plan = plan.take(scan_planner.tour(plan.points, kinematics, start, self.plan_time))
+            print('Estimated scan time =', scan_planner.format_duration(scan_planner.path_time(plan.points, kinematics,
+                                                                                              start)))
 
             self.distance = 0  # normalised distance value used to calculate % completion for progress bar
             count = 0  # number of points measured
@@ -90,40 +93,26 @@ class ScanWorker_random_sample(QRunnable):
                            'std(bz) / mT', 'T / C',
                            'std(T) / C']
 
-            with open(self.filename, "w", newline='') as f:  # open csv file to write data to at each point
-                dw = csv.DictWriter(f, delimiter=',',
-                                    fieldnames=header_list)
-                dw.writeheader()
-                writer = csv.writer(f, delimiter=",")
+            self.HP.start_stream()  # start probe broadcast once for the whole scan
 
-                while self.distance < 100:
-                    for i in range(self.number_points):
-                        xi = x_points[i]
-                        yi = y_points[i]
-                        zi = z_points[i]
+            # csv file, or binary columns if filename ends .npycols
+            with scan_output.open_scan_writer(self.filename, header_list, self.raw_samples) as writer:
 
+                while self.distance < 100:
+                    for xi, yi, zi in plan.points:
                         # Move to measurement point
-                        self.xa.move(xi, wait=True)
-                        self.ya.move(yi, wait=True)
-                        self.za.move(zi, wait=True)
-
-                        time.sleep(0.5)  # wait for motor controllers to settle before reading fields
+                        self.mc.move_to({'x': xi, 'y': yi, 'z': zi})  # move all axes together
 
                         # Read actual motor controller positions
-                        x = self.xa.get_position()
-                        y = self.ya.get_position()
-                        z = self.za.get_position()
+                        x, y, z = self.mc.get_positions(['x', 'y', 'z'])  # query all three axes at once
 
                         # Take field measurements
                         fields = self.HP.get_fields(
                             self.averages)  # get fields averaged from n samples from Tesla-meter
 
                         # Write position and field measurements to csv file
-                        writer.writerow(
-                            [str(datetime.datetime.now()), "{:.3f}".format(x), "{:.3f}".format(y),
-                             "{:.3f}".format(z), fields[0], fields[1], fields[2], fields[3], fields[4],
-                             fields[5],
-                             fields[6], fields[7]])
+                        writer.writerow([datetime.datetime.now(), x, y, z] + list(fields),
+                                        samples=self.HP.last_block)  # raw samples kept if saving them
                         print('Position = ', x, y, z)
                         print('Fields = ', fields[0], fields[1], fields[2])
 
@@ -143,7 +132,6 @@ class ScanWorker_random_sample(QRunnable):
                         self.distance = int(
                             100 * (count / total_count))  # increase dummy variable to the nearest integer value
                         self.signals.progress.emit(self.distance - 1)
-                        time.sleep(0.1)
 
                         if not self.isRun:  # check if STOP button pressed
                             # Send STOP command to motor axes
@@ -156,6 +144,8 @@ class ScanWorker_random_sample(QRunnable):
                     break  # break out of while loop
 
         finally:
+            self.HP.stop_stream()  # stop probe broadcast if it was started
+            instrumentation.save_scan_stats(self.filename)  # serial statistics, if collected
             # emit finished signal to GUI
+            session.release()  # let monitors and other workers use the devices again
             self.signals.finished.emit()
-            mutex.unlock()  # unlock the motor controller and teslameter classes
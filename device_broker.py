@@ -0,0 +1,157 @@
+import itertools
+import threading
+import time
+
+devices = ('stage', 'probe')  # devices the broker arbitrates: motor controller and teslameter
+
+
+class Session:
+    """Access to some of a broker's devices, granted by DeviceBroker.shared or DeviceBroker.exclusive.
+
+    Release it when finished, or use it in a with statement."""
+
+    def __init__(self, broker, owner, devices, exclusive, priority):
+        self.broker = broker
+        self.owner = owner  # description of who holds session, for diagnostics
+        self.devices = tuple(devices)
+        self.exclusive = exclusive
+        self.priority = priority  # exclusive requests with higher priority are granted first
+        self.sequence = None  # order requested, so equal priorities are first come first served
+        self.active = False
+
+    def release(self):
+        self.broker.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.release()
+
+    def __repr__(self):
+        return '<{} session of {} for {}>'.format('exclusive' if self.exclusive else 'shared', self.owner,
+                                                 '/'.join(self.devices))
+
+
+class DeviceBroker:
+    """Owns the motor controller and teslameter and arbitrates access to them between threads.
+
+    Monitoring takes shared sessions, which run alongside each other. Scans, moves and settings changes take
+    exclusive sessions, which wait for shared sessions in progress to end and stop new ones starting, so they are
+    never kept waiting by monitor reads. While a device is held exclusively, monitors can still show what the holder
+    is reading: positions it has queried and fields in the probe's sample buffer."""
+
+    def __init__(self, mc, HP):
+        self.mc = mc
+        self.HP = HP
+        self.condition = threading.Condition()
+        self.holders = {device: [] for device in devices}  # sessions holding each device
+        self.waiting = []  # exclusive sessions waiting to be granted
+        self.sequence = itertools.count()
+        for device in (mc, HP):
+            if device is not None:
+                device.broker = self  # so workers given the devices can find their broker
+
+    def shared(self, owner, devices=devices, block=True, timeout=None):
+        """Return shared session on devices, or None if not granted (immediately when block is False)"""
+        return self.acquire(Session(self, owner, devices, False, 0), timeout if block else 0)
+
+    def exclusive(self, owner, devices=devices, priority=5, timeout=None):
+        """Return exclusive session on devices, waiting for other sessions to end. Raises TimeoutError after timeout s"""
+        session = self.acquire(Session(self, owner, devices, True, priority), timeout)
+        if session is None:
+            raise TimeoutError('{} waited {} s for {}, held by {}'.format(owner, timeout, '/'.join(devices),
+                                                                      self.describe()))
+        return session
+
+    def acquire(self, session, timeout):
+        with self.condition:
+            if session.exclusive:
+                session.sequence = next(self.sequence)
+                self.waiting.append(session)
+            try:
+                granted = self.condition.wait_for(lambda: self.can_grant(session), timeout)
+            finally:
+                if session.exclusive:
+                    self.waiting.remove(session)
+                    self.condition.notify_all()  # others may have been waiting behind this one
+            if not granted:
+                return None
+            for device in session.devices:
+                self.holders[device].append(session)
+            session.active = True
+            return session
+
+    def can_grant(self, session):
+        """True if session can be granted now - call with condition held"""
+        for device in session.devices:
+            held = self.holders[device]
+            if session.exclusive and held:
+                return False
+            if any(holder.exclusive for holder in held):
+                return False
+            for other in self.waiting:  # exclusive requests ahead of this one
+                if other is session or device not in other.devices:
+                    continue
+                if not session.exclusive or (-other.priority, other.sequence) < (-session.priority, session.sequence):
+                    return False
+        return True
+
+    def release(self, session):
+        with self.condition:
+            if not session.active:
+                return
+            for device in session.devices:
+                self.holders[device].remove(session)
+            session.active = False
+            self.condition.notify_all()
+
+    def busy(self, device):
+        """True if device is held or wanted exclusively, so shared sessions on it would have to wait"""
+        with self.condition:
+            return any(holder.exclusive for holder in self.holders[device]) or \
+                any(device in other.devices for other in self.waiting)
+
+    def describe(self):
+        """Return description of sessions held, for diagnostics"""
+        with self.condition:
+            sessions = {id(s): s for held in self.holders.values() for s in held}
+            return ', '.join(repr(s) for s in sessions.values()) or 'nobody'
+
+    def latest_positions(self, names=('x', 'y', 'z'), max_age=1.0):
+        """Return the axis positions most recently read by anyone, or None if any is older than max_age s"""
+        if self.mc is None:
+            return None
+        now = time.time()
+        positions = []
+        for name in names:
+            last = self.mc.axis[name].last_position
+            if last is None or now - last[0] > max_age:
+                return None
+            positions.append(last[1])
+        return positions
+
+    def latest_samples(self, samples, max_age=1.0):
+        """Return the newest field samples read by anyone from the probe's buffer, or None if they are older than
+        max_age s"""
+        buffer = getattr(self.HP, 'buffer', None)
+        if buffer is None or buffer.count == 0:
+            return None
+        block = buffer.latest(samples)
+        if time.time() - block[-1, 4] > max_age:
+            return None
+        return block
+
+
+def broker(mc=None, HP=None):
+    """Return the broker owning mc (or HP), creating one the first time"""
+    existing = next((device.broker for device in (mc, HP) if getattr(device, 'broker', None) is not None), None)
+    if existing is None:
+        return DeviceBroker(mc, HP)
+    if existing.mc is None and mc is not None:  # first created for the probe alone
+        existing.mc = mc
+        mc.broker = existing
+    if existing.HP is None and HP is not None:
+        existing.HP = HP
+        HP.broker = existing
+    return existing
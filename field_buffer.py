@@ -0,0 +1,138 @@
+import threading
+import time
+import numpy as np
+
+
+class FieldBuffer:
+    """Fixed-capacity ring buffer of timestamped field samples shared between probe drivers and their consumers.
+
+    Keeps O(1) running mean and variance of bx, by, bz and temperature (Welford's algorithm, merged one block of
+    samples at a time) and answers statistics queries over the samples taken between two host times."""
+
+    columns = ('bx', 'by', 'bz', 'th', 'host_time', 'device_time')  # column order of stored samples
+    field_columns = 4  # number of leading columns holding measured values (bx, by, bz, th)
+
+    def __init__(self, capacity=2 ** 18):
+        self.capacity = int(capacity)  # maximum number of samples kept before the oldest are overwritten
+        self.data = np.zeros((self.capacity, len(self.columns)))  # preallocated sample storage
+        self.count = 0  # total number of samples written since buffer was created or cleared
+        self.condition = threading.Condition()  # notifies waiting consumers when new samples are written
+
+        # Running statistics since buffer created or reset_stats called
+        self.stats_count = 0  # number of samples included in running statistics
+        self.stats_mean = np.zeros(self.field_columns)  # running mean of bx, by, bz, th
+        self.stats_m2 = np.zeros(self.field_columns)  # running sum of squared differences from the mean
+
+    @classmethod
+    def new_block(cls, n):
+        """Return an empty block of n samples for a driver to fill in before calling append"""
+        block = np.empty((n, len(cls.columns)))
+        block[:, 5] = np.nan  # device timestamp not available unless the driver provides one
+        return block
+
+    def clear(self):
+        """Discard all stored samples and running statistics"""
+        with self.condition:
+            self.count = 0
+            self.reset_stats()
+
+    def reset_stats(self):
+        """Restart running mean and variance from the next sample written"""
+        with self.condition:
+            self.stats_count = 0
+            self.stats_mean[:] = 0
+            self.stats_m2[:] = 0
+
+    def append(self, values):
+        """Write a block of samples, one row per sample with columns in the order given by FieldBuffer.columns"""
+        values = np.asarray(values, dtype=float)
+        n = len(values)
+        if n == 0:
+            return
+        fields = values[:, :self.field_columns]
+        block_mean = fields.mean(axis=0)
+        block_m2 = ((fields - block_mean) ** 2).sum(axis=0)
+        if n > self.capacity:  # only the newest samples fit
+            values = values[-self.capacity:]
+        with self.condition:
+            start = (self.count + n - len(values)) % self.capacity  # where the rows kept belong
+            first = min(len(values), self.capacity - start)  # number of rows before wrapping round
+            self.data[start:start + first] = values[:first]
+            self.data[:len(values) - first] = values[first:]
+            self.count += n
+
+            # Merge block statistics into running statistics (Chan et al. parallel form of Welford's algorithm)
+            total = self.stats_count + n
+            delta = block_mean - self.stats_mean
+            self.stats_mean += delta * n / total
+            self.stats_m2 += block_m2 + delta ** 2 * self.stats_count * n / total
+            self.stats_count = total
+
+            self.condition.notify_all()
+
+    def running_stats(self):
+        """Return running mean and standard deviation arrays of bx, by, bz, th since statistics were last reset"""
+        with self.condition:
+            if self.stats_count == 0:
+                return np.full(self.field_columns, np.nan), np.full(self.field_columns, np.nan)
+            return self.stats_mean.copy(), np.sqrt(self.stats_m2 / self.stats_count)
+
+    def _rows(self, first, last):
+        """Return copy of samples with absolute indices first to last - 1"""
+        first = max(first, self.count - self.capacity, 0)  # oldest sample still stored
+        indices = np.arange(first, last) % self.capacity
+        return self.data[indices]
+
+    def latest(self, n):
+        """Return the last n samples written"""
+        with self.condition:
+            return self._rows(self.count - n, self.count)
+
+    def since(self, t0):
+        """Return all stored samples with host timestamps at or after t0"""
+        with self.condition:
+            return self._rows(self._index_at(t0), self.count)
+
+    def window(self, t0, t1):
+        """Return all stored samples with host timestamps at or after t0 and before t1"""
+        with self.condition:
+            return self._rows(self._index_at(t0), self._index_at(t1))
+
+    def stats(self, t0=None, t1=None):
+        """Return mean and standard deviation arrays of bx, by, bz, th over the samples between host times t0 and t1.
+
+        Leaving out t0 or t1 uses the oldest or newest stored sample respectively."""
+        with self.condition:
+            first = self.count - self.capacity if t0 is None else self._index_at(t0)
+            last = self.count if t1 is None else self._index_at(t1)
+            rows = self._rows(first, last)[:, :self.field_columns]
+        if len(rows) == 0:
+            return np.full(self.field_columns, np.nan), np.full(self.field_columns, np.nan)
+        return rows.mean(axis=0), rows.std(axis=0)
+
+    def _index_at(self, t0):
+        """Return absolute index of the first stored sample with host timestamp at or after t0 (binary search)"""
+        low = max(0, self.count - self.capacity)  # oldest sample still stored
+        high = self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.data[middle % self.capacity, 4] < t0:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def wait_for(self, n, since=None, timeout=10):
+        """Block until n samples taken at or after host time since are available and return the first n of them"""
+        since = time.time() if since is None else since
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                first = self._index_at(since)
+                if self.count - first >= n:
+                    return self._rows(first, first + n)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError('Timed out waiting for {} field samples, received {}'.format(
+                        n, self.count - first))
+                self.condition.wait(remaining)
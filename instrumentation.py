@@ -0,0 +1,271 @@
+import atexit
+import json
+import os
+import re
+import threading
+import time
+from bisect import bisect_left
+
+# Upper edges of latency histogram bins / s - the last bin holds anything slower
+latency_bins = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+
+pm1000_command = re.compile(r'\d*(_*[A-Za-z]+)')  # command in a PM1000 command string, e.g. "3MA1000" -> "MA"
+probe_command = re.compile(rb'[A-Za-z]+\??')  # command at start of a teslameter message, e.g. b"K?" or b"mr3"
+
+
+def pm1000_name(send):
+    """Return lower case command name of a PM1000 command string, without axis id or parameter."""
+    match = pm1000_command.match(send)
+    return match.group(1).lower() if match else send
+
+
+def probe_name(message):
+    """Return command name of a message written to a teslameter, without parameter bytes."""
+    match = probe_command.match(bytes(message))
+    return match.group().decode('ascii') if match else bytes(message[:1]).hex()
+
+
+class CommandStats:
+    """Running totals for one command sent to one device"""
+
+    def __init__(self):
+        self.count = 0  # number of round trips timed
+        self.total_time = 0.0  # total latency / s
+        self.min_time = None  # fastest round trip / s
+        self.max_time = 0.0  # slowest round trip / s
+        self.histogram = [0] * (len(latency_bins) + 1)  # number of round trips in each latency bin
+        self.sent = 0  # number of times command was written
+        self.bytes_out = 0  # bytes written, including line end
+        self.bytes_in = 0  # bytes of reply received
+        self.retries = 0  # number of times reply was re-read or command re-sent after a bad reply
+        self.timeouts = 0  # number of replies which were missing or incomplete
+
+    def add_time(self, latency):
+        self.count += 1
+        self.total_time += latency
+        self.min_time = latency if self.min_time is None else min(self.min_time, latency)
+        self.max_time = max(self.max_time, latency)
+        self.histogram[bisect_left(latency_bins, latency)] += 1
+
+    def percentile(self, fraction):
+        """Return upper edge of the histogram bin holding the given fraction of round trips, or None."""
+        if self.count == 0:
+            return None
+        total = 0
+        for edge, number in zip(latency_bins + (float('inf'),), self.histogram):
+            total += number
+            if total >= fraction * self.count:
+                return edge if edge != float('inf') else self.max_time
+
+    def as_dict(self):
+        return {'count': self.count, 'sent': self.sent, 'total time': self.total_time,
+                'mean time': self.total_time / self.count if self.count else None,
+                'min time': self.min_time, 'max time': self.max_time,
+                'histogram': dict(zip(['<={}'.format(edge) for edge in latency_bins] + ['>{}'.format(latency_bins[-1])],
+                                      self.histogram)),
+                'bytes out': self.bytes_out, 'bytes in': self.bytes_in,
+                'retries': self.retries, 'timeouts': self.timeouts}
+
+
+class SerialStats:
+    """Live per-command statistics of serial round trips to the motor controller and teslameters.
+
+    Safe to update from several threads. Keyed by (device, command), e.g. ('PM1000', 'oc') or ('3MH6', 'K?')."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}  # (device, command): CommandStats
+        self.started = time.time()
+
+    def command(self, device, command):
+        """Return CommandStats for a device and command, creating it if needed - call with lock held"""
+        key = (device, command)
+        if key not in self.commands:
+            self.commands[key] = CommandStats()
+        return self.commands[key]
+
+    def record(self, device, command, latency=None, bytes_out=0, bytes_in=0):
+        """Record one round trip: latency / s (None if not timed) and bytes written and read"""
+        with self.lock:
+            stats = self.command(device, command)
+            if latency is not None:
+                stats.add_time(latency)
+            if bytes_out:
+                stats.sent += 1
+            stats.bytes_out += bytes_out
+            stats.bytes_in += bytes_in
+
+    def add_bytes_in(self, device, command, bytes_in):
+        with self.lock:
+            self.command(device, command).bytes_in += bytes_in
+
+    def retry(self, device, command):
+        with self.lock:
+            self.command(device, command).retries += 1
+
+    def timeout(self, device, command):
+        with self.lock:
+            self.command(device, command).timeouts += 1
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.started = time.time()
+
+    def as_dict(self):
+        with self.lock:
+            return {'started': self.started, 'elapsed': time.time() - self.started,
+                    'commands': {'{} {}'.format(device, command): stats.as_dict()
+                                 for (device, command), stats in self.commands.items()}}
+
+    def report(self):
+        """Return table of commands, slowest total time first"""
+        with self.lock:
+            items = sorted(self.commands.items(), key=lambda item: item[1].total_time, reverse=True)
+            elapsed = time.time() - self.started
+            row = '{:<8} {:<20} {:>7} {:>9} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}'
+            lines = ['Serial statistics over {:.1f} s'.format(elapsed),
+                     row.format('device', 'command', 'count', 'total/s', '%', 'mean/ms', 'p50/ms', 'p95/ms', 'max/ms',
+                                'bytes in', 'retries', 'timeouts')]
+            for (device, command), stats in items:
+                mean = stats.total_time / stats.count if stats.count else 0
+                p50, p95 = ('-', '-') if stats.count == 0 else \
+                    ('<={:g}'.format(1E3 * stats.percentile(0.5)), '<={:g}'.format(1E3 * stats.percentile(0.95)))
+                lines.append(row.format(
+                    device, command, stats.count or stats.sent, '{:.2f}'.format(stats.total_time),
+                    '{:.1f}'.format(100 * stats.total_time / elapsed if elapsed else 0), '{:.2f}'.format(1E3 * mean),
+                    p50, p95, '{:.2f}'.format(1E3 * stats.max_time), stats.bytes_in, stats.retries, stats.timeouts))
+        return '\n'.join(lines)
+
+    def dump(self, filename):
+        """Write statistics to file - JSON if filename ends .json, otherwise a text table"""
+        with open(filename, 'w') as f:
+            if filename.endswith('.json'):
+                json.dump(self.as_dict(), f, indent=2)
+            else:
+                f.write(self.report() + '\n')
+
+
+class InstrumentedSerial:
+    """Wrapper around a serial port which records commands written to a teslameter and the replies read back.
+
+    Bytes read are charged to the last command written. Latency is the time from writing a command to the first
+    byte of reply, so commands without a reply (e.g. "S") are counted but not timed."""
+
+    def __init__(self, ser, device):
+        object.__setattr__(self, 'ser', ser)
+        object.__setattr__(self, 'device', device)
+        object.__setattr__(self, 'last_command', None)  # name of last command written
+        object.__setattr__(self, 'written_at', None)  # time last command was written, until its reply starts
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.ser, name, value)  # e.g. baudrate, timeout
+
+    def write(self, data):
+        command = probe_name(data)
+        object.__setattr__(self, 'last_command', command)
+        object.__setattr__(self, 'written_at', time.perf_counter())
+        if stats is not None:
+            stats.record(self.device, command, bytes_out=len(data))
+        return self.ser.write(data)
+
+    def received(self, count, wanted=None):
+        """Record count bytes read in answer to the last command; a read short of wanted bytes timed out"""
+        if stats is None or self.last_command is None:
+            return
+        if count and self.written_at is not None:
+            stats.record(self.device, self.last_command, time.perf_counter() - self.written_at)
+            object.__setattr__(self, 'written_at', None)
+        if count:
+            stats.add_bytes_in(self.device, self.last_command, count)
+        if wanted is not None and count < wanted:
+            stats.timeout(self.device, self.last_command)
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        self.received(len(data), size)
+        return data
+
+    def readinto(self, b):
+        n = self.ser.readinto(b)
+        self.received(n or 0, len(b))
+        return n
+
+    def read_until(self, expected=b'\n', size=None):
+        data = self.ser.read_until(expected, size)
+        self.received(len(data), len(data) + (0 if data.endswith(expected) or len(data) == size else 1))
+        return data
+
+    def read_all(self):
+        data = self.ser.read_all()
+        self.received(len(data))
+        return data
+
+    def readall(self):
+        data = self.ser.readall()  # reads until port timeout, so a short read is expected
+        self.received(len(data))
+        return data
+
+
+class InstrumentedLibrary:
+    """Wrapper around the 3MTS software library which records the time taken by each function call"""
+
+    def __init__(self, lib, device):
+        self.lib = lib
+        self.device = device
+
+    def __getattr__(self, name):
+        function = getattr(self.lib, name)
+
+        def timed(*args):
+            started = time.perf_counter()
+            try:
+                return function(*args)
+            finally:
+                if stats is not None:
+                    stats.record(self.device, name, time.perf_counter() - started)
+        return timed
+
+
+stats = None  # SerialStats being collected, or None when instrumentation is off
+
+
+def enable():
+    """Start collecting serial statistics (if not already) and return the live SerialStats object"""
+    global stats
+    if stats is None:
+        stats = SerialStats()
+    return stats
+
+
+def disable():
+    """Stop collecting serial statistics and return what was collected"""
+    global stats
+    collected, stats = stats, None
+    return collected
+
+
+def instrument(port, device):
+    """Return serial port (or 3MTS library) wrapped to record statistics if instrumentation is on, otherwise unchanged"""
+    if stats is None:
+        return port
+    if device == '3MTS':
+        return InstrumentedLibrary(port, device)
+    return InstrumentedSerial(port, device)
+
+
+def save_scan_stats(filename):
+    """Write statistics next to a scan data file, e.g. scan.csv -> scan_serial_stats.txt, if instrumentation is on"""
+    if stats is not None:
+        stats_file = os.path.splitext(filename)[0] + '_serial_stats.txt'
+        stats.dump(stats_file)
+        print('Serial statistics saved to', stats_file)
+
+
+# Opt in from the environment, e.g. HP_BENCH_SERIAL_STATS=stats.json, to collect statistics and save them on exit
+if os.environ.get('HP_BENCH_SERIAL_STATS'):
+    enable()
+    atexit.register(lambda: stats is not None and stats.dump(os.environ['HP_BENCH_SERIAL_STATS']))
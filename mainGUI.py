@@ -22,23 +22,24 @@ import serial
 import pyqtgraph as pg
 from random import randint
 
-mutex = QMutex
-from os.path import exists
-from FieldsWorker import FieldsWorker
-from PositionsWorker import PositionsWorker
+from os.path import exists, isdir
 from RelativeMoveWorker import RelativeMoveWorker
 from GlobalMoveWorker import GlobalMoveWorker
 from ScanWorker import ScanWorker
 from ScanWorker_pointbypoint import ScanWorker_pointbypoint
+import scan_plan
+import scan_planner
 from ScanWorker_onthefly import ScanWorker_onthefly
 from ScanWorker_boundary import ScanWorker_boundary
 from ScanWorker_random_sample import ScanWorker_random_sample
+from ScanWorker_adaptive import ScanWorker_adaptive
 from MultipoleScanWorker import MultipoleScanWorker
-from ProbeSettingsWorker import ProbeSettingsWorker
 from setProbeSettingsWorker import setProbeSettingsWorker
 from MotorSettingsWorker import MotorSettingsWorker
 from setMotorSettingsWorker import setMotorSettingsWorker
 from ResetAxesWorker import ResetAxesWorker
+from monitor_service import MonitorService
+import device_broker
 
 # HP = teslameter_3MH6('COM3')  # create Hall probe class and open serial port
 # HP = teslameter_3MTS()
@@ -65,26 +66,6 @@ class mywindow(QtWidgets.QMainWindow):
 
         self.ui.tabWidget.tabBarClicked.connect(self.sleepGUI)  # sleep GUI
 
-        # Infinite Loop for continuously updating probe position and field measurements
-        self.timer = QtCore.QTimer(self)
-        self.timer.setSingleShot(False)
-        self.timer.setInterval(100)  # in milliseconds, so 5000 = 5 seconds
-        # self.timer.timeout.connect(self.update_current_measurements)
-        if self.HP.type() != 'blank':
-            self.timer.timeout.connect(self.ReadFields)  # connect timer to read fields function
-        self.timer.timeout.connect(self.ReadPositions)  # connect timer to read positions function
-        self.timer.start()
-
-        # Second timer for updating settings
-        self.timer2 = QtCore.QTimer(self)
-        self.timer2.setSingleShot(False)
-        self.timer2.setInterval(5000)  # in milliseconds, so 5000 = 5 seconds
-        if self.HP.type() != 'blank':
-            self.timer2.timeout.connect(self.ReadProbeSettings)  # connect timer to read probe settings function
-        # self.timer2.timeout.connect(self.ReadMotorSettings)  ###Connect timer to read motor settings function
-        # self.timer2.timeout.connect(self.ReadPositions)
-        self.timer2.start()
-
         # Connect Radio buttons on movement tab to MovementRadio function
         self.ui.relativeRadio.toggled.connect(self.movement_radio)  # connect relative movement radio button to function
         self.ui.globalRadio.toggled.connect(self.movement_radio)  # connect global movement radio button to function
@@ -103,6 +84,13 @@ class mywindow(QtWidgets.QMainWindow):
         # self.ui.boundary_data_radioButton.toggled.connect(self.sleepGUI)
         self.ui.random_points_checkBox.toggled.connect(self.random_points_check)
 
+        # Check box for adaptive scans - coarse grid refined where the field changes fastest
+        self.adaptive_checkBox = QtWidgets.QCheckBox('Adaptive Refinement', self.ui.groupBox_3)
+        self.adaptive_checkBox.setGeometry(QtCore.QRect(320, 130, 211, 31))
+        self.adaptive_checkBox.setFont(self.ui.boundary_data_checkBox.font())
+        self.adaptive_checkBox.setToolTip("Scan grid as a coarse grid, then add points where interpolation error is "
+                                          "too large")
+
         # Connect Push Buttons on Movement Tab to functions to execute movement
         self.ui.relativemoveButton.clicked.connect(
             self.relative_move_click)  # Connect relative move push button to function
@@ -112,6 +100,7 @@ class mywindow(QtWidgets.QMainWindow):
         # Connect select file Push button to file dialog
         self.ui.selectfileButton.clicked.connect(self.select_file_click)
 
+        self.ui.scanorder_Combo.addItem('Auto (fastest)')  # let scan planner choose quickest order
         self.ui.scanorder_Combo.currentIndexChanged.connect(self.sleepGUI)
         self.ui.samplerateCombo.currentIndexChanged.connect(self.sleepGUI)
         self.ui.rangeCombo.currentIndexChanged.connect(self.sleepGUI)
@@ -215,6 +204,18 @@ class mywindow(QtWidgets.QMainWindow):
         print('max thread count after = ', self.pool.maxThreadCount())
         print('active threads= ', self.pool.activeThreadCount())
         self.worker = None  # initial global worker
+
+        # Broker arbitrates use of motor controller and probe between workers and the background monitor, which
+        # continuously reads probe position, fields and probe settings; the display timer shows the latest values
+        self.broker = device_broker.DeviceBroker(mc, self.HP)
+        self.monitor = MonitorService(self.HP, mc, self.averages, broker=self.broker)
+        self.monitor.start()
+        self.displayed = {}  # host time each monitor value shown was read
+        self.display_timer = QtCore.QTimer(self)
+        self.display_timer.setSingleShot(False)
+        self.display_timer.setInterval(200)  # in milliseconds
+        self.display_timer.timeout.connect(self.show_monitor)
+        self.display_timer.start()
         print('all good so far')
 
     def sleepGUI(self):
@@ -352,30 +353,11 @@ class mywindow(QtWidgets.QMainWindow):
         self.worker = None  # reset worker class to none - does this help prevent GUI crashing between scans?
         print('now current worker = ', self.worker)
         self.sleepGUI()
-        try:  # restart timers if they been paused for running the thread
-            self.timer.start()
-            self.timer2.start()
-            print('timers restarted')
-        except:
-            print('timers not restarted')
-            pass
         try:
             self.progress.close()  # close progress bar if open
         except:
             print('Progress bar not closed')
 
-    def pause_timers(self):
-        """Pause timers to allow methods to be run"""
-        # Stop timers
-        self.timer.stop()  # stop timers to recurring threads
-        self.timer2.stop()
-        time.sleep(0.1)
-        count0 = self.pool.activeThreadCount()  # number of active threads when program termination started
-        self.pool.clear()  # clear thread pool
-        time.sleep(0.2)
-        while self.pool.activeThreadCount() > 0:  # wait until thread count is 0
-            count_i = self.pool.activeThreadCount()  # current number of active threads
-
     def UpdateFields(self, fields):
         """Update fields labels on GUI"""
         self.ui.BxLabel.setText('Bx = ' + fields[0] + ' mT')
@@ -383,13 +365,6 @@ class mywindow(QtWidgets.QMainWindow):
         self.ui.BzLabel.setText('Bz = ' + fields[2] + ' mT')
         self.ui.tempLabel.setText('Temperature = ' + fields[3] + ' degrees C')
 
-    def ReadFields(self):
-        """Read fields using QThread Object"""
-        worker = FieldsWorker(self.HP, self.averages)  # connect to FieldsWorker object
-        worker.setAutoDelete(True)  # make worker auto-deletable so can be cleared
-        worker.signals.result.connect(self.UpdateFields)
-        self.pool.start(worker)  # start the FieldsWorker object
-
     def UpdatePositions(self, positions):
         """Update position labels on GUI"""
         self.ui.xposLabel.setText('x = ' + positions[
@@ -397,18 +372,22 @@ class mywindow(QtWidgets.QMainWindow):
         self.ui.yposLabel.setText('y = ' + positions[1] + ' mm')
         self.ui.zposLabel.setText('z = ' + positions[2] + ' mm')
 
-    def ReadPositions(self):
-        """Read position using QThread Object"""
-        # print('read positions now')
-        worker = PositionsWorker(mc)  # connect to FieldsWorker object
-        worker.signals.result.connect(self.UpdatePositions)
-        worker.setAutoDelete(True)  # make worker auto-deletable so can be cleared
-        self.pool.start(worker)
+    def show_monitor(self):
+        """Update GUI with any new values read by the monitor"""
+        for name, (value, updated) in self.monitor.snapshot().items():
+            if self.displayed.get(name) == updated:
+                continue  # already shown
+            self.displayed[name] = updated
+            if name == 'positions':
+                self.UpdatePositions(["{:.3f}".format(position) for position in value])
+            elif name == 'fields':
+                self.UpdateFields(["{:.3f}".format(value[i]) for i in (0, 1, 2, 6)])  # bx, by, bz, temperature
+            elif name == 'settings':
+                self.UpdateProbeSettings(value)
 
     def relative_move_click(self):
         """Function to be executed when relative movement button is clicked"""
         print('Selected Relative Movement')
-        self.pause_timers()  # pause timers for updating GUI whilst function is executed
 
         x = (self.ui.xrelativeEdit.text())  # x value is current value in line Edit
         y = (self.ui.yrelativeEdit.text())  # y value is current value in line Edit
@@ -453,8 +432,6 @@ class mywindow(QtWidgets.QMainWindow):
 
     def global_move_click(self):
         """Function to be executed when global movement button is clicked"""
-        self.pause_timers()  # pause timers for updating GUI to avoid interfering with movement
-
         x1 = self.ui.xglobalEdit.text()  # x value is current value in line Edit
         y1 = self.ui.yglobalEdit.text()  # y value is current value in line Edit
         z1 = self.ui.zglobalEdit.text()  # z value is current value in line Edit
@@ -490,8 +467,6 @@ class mywindow(QtWidgets.QMainWindow):
 
     def reset_axes_click(self):
         """Function to be executed when reset axes button is clicked"""
-        self.pause_timers()  # pause timers for updating GUI so that the function can be executed
-
         # Create worker thread to handle sending reset command to motor axes
         self.worker = ResetAxesWorker(mc)  # connect to QRunnable object
         self.worker.setAutoDelete(True)
@@ -508,12 +483,10 @@ class mywindow(QtWidgets.QMainWindow):
         """Function to select file name and location to save scan data"""
         self.sleepGUI()
 
-        self.pause_timers()  # pause timers for updating GUI so not to interfere with this function
-
         # Create FileDialog widget for selecting file name and location
         filedialog = QtWidgets.QFileDialog(self)
         filedialog.setDefaultSuffix("csv")
-        filedialog.setNameFilter("Text Files (*.csv);;All files (*.*)")
+        filedialog.setNameFilter("Text Files (*.csv);;Binary columns (*.npycols);;All files (*.*)")
         filedialog.setAcceptMode(QtWidgets.QFileDialog.AcceptSave)
         filedialog.DontUseNativeDialog
         time.sleep(0.5)  # try adding short pause before executing file??
@@ -529,12 +502,10 @@ class mywindow(QtWidgets.QMainWindow):
         """Function to select file name and location to save multipole scan data"""
         self.sleepGUI()
 
-        self.pause_timers()  # pause timers for updating GUI so not to interfere with this function
-
         # Create FileDialog widget for selecting file name and location
         filedialog = QtWidgets.QFileDialog(self)
         filedialog.setDefaultSuffix("csv")
-        filedialog.setNameFilter("Text Files (*.csv);;All files (*.*)")
+        filedialog.setNameFilter("Text Files (*.csv);;Binary columns (*.npycols);;All files (*.*)")
         filedialog.setAcceptMode(QtWidgets.QFileDialog.AcceptSave)
         filedialog.DontUseNativeDialog
         time.sleep(0.5)  # try adding short pause before executing file??
@@ -571,9 +542,6 @@ class mywindow(QtWidgets.QMainWindow):
 
     def scan_click(self):
         """Function to be executed when scan button pressed"""
-
-        self.pause_timers()  # Pause timers for updating GUI so not to interfere with running this function
-
         # Retrieve values stored in line edits
         x0 = self.ui.scan_x0Edit.text()  # Get x0 value
         if self.ui.xplaneRadio.isChecked():  # if fixed x point
@@ -613,18 +581,65 @@ class mywindow(QtWidgets.QMainWindow):
 
         check_values = self.check_float(values, edits)  # check if entered values were floats
 
-        if check_values is not None:  # if values are floats, execute scan
+        if check_values is not None and min(check_values[2], check_values[5], check_values[8]) <= 0:
+            for i in (2, 5, 8):  # steps divide the ranges into points, so must be positive
+                if check_values[i] <= 0:
+                    edits[i].setStyleSheet('background-color: rgb(255, 0, 0);')  # set line edit colour to red
+            warning = QtWidgets.QMessageBox.warning(self, 'Invalid Steps', "Please type steps greater than zero",
+                                                    QtWidgets.QMessageBox.Ok)  # Create warning message box to user
+            check_values = None
+
+        if check_values is not None:  # if values are valid, execute scan
 
             order = self.ui.scanorder_Combo.currentIndex()  # get axis order from combo box
             filename = self.ui.filenameEdit.text()  # get filename from filename edit
             on_the_fly = self.ui.on_the_fly_radioButton.isChecked()  # boolean to represent on-the-fly scanning choice
             boundary_data = self.ui.boundary_data_checkBox.isChecked()  # boolean to represent boundary data scan choice
             random_points = self.ui.random_points_checkBox.isChecked()  # boolean to represent random sample points choice
+            adaptive = self.adaptive_checkBox.isChecked()  # boolean to represent adaptive refinement choice
+
+            # Estimate travel time of grid scan, choosing the quickest order if Auto selected
+            grid = [float(value) for value in values[:9]]
+            kinematics = scan_planner.axis_kinematics(mc)
+            pattern = 'serpentine'  # order of points within grid
+            if on_the_fly or boundary_data or random_points or adaptive:
+                patterns = ('serpentine',)  # only point by point scans can raster
+            else:
+                patterns = ('serpentine', 'raster')
+            if order == len(scan_plan.scan_axes):  # Auto (fastest)
+                order, pattern, estimate = scan_planner.fastest_grid_order(*grid, kinematics, patterns=patterns)
+            else:
+                estimate = scan_planner.path_time(scan_plan.GridPlan(*grid, order).points, kinematics)
+            if on_the_fly:  # lines at scan speed, not stopping at each point
+                estimate = scan_planner.line_scan_time(scan_plan.GridPlan(*grid, order, pattern), float(scan_speed),
+                                                       kinematics)
+            if adaptive and not (boundary_data or random_points):
+                # Ask for accuracy wanted and most points to spend reaching it
+                tolerance, ok = QtWidgets.QInputDialog.getDouble(
+                    self, 'Adaptive Scan', 'Acceptable interpolation error / mT:', 0.05, 0.001, 1000, 3)
+                if ok:
+                    coarse_points = len(scan_plan.GridPlan(*grid, order))
+                    max_points, ok = QtWidgets.QInputDialog.getInt(
+                        self, 'Adaptive Scan', 'Most points to measure (coarse grid has {}):'.format(coarse_points),
+                        4 * coarse_points, 1)
+                if not ok:
+                    self.thread_complete()  # tidy up without scanning
+                    return
+            elif not (boundary_data or random_points):
+                answer = QtWidgets.QMessageBox.question(
+                    self, 'Scan Time Estimate',
+                    "Estimated scan time {} for {} points, scanning {} {}.\nStart scan?".format(
+                        scan_planner.format_duration(estimate), len(scan_plan.GridPlan(*grid, order)),
+                        scan_planner.order_names[order], pattern),
+                    QtWidgets.QMessageBox.Ok | QtWidgets.QMessageBox.Cancel)
+                if answer == QtWidgets.QMessageBox.Cancel:
+                    self.thread_complete()  # tidy up without scanning
+                    return
 
             # Check if file can be written to
             try:
                 print(exists(filename))
-                if exists(filename):
+                if exists(filename) and not isdir(filename):  # .npycols output is a directory
                     my_file = open(filename, "r+")
             except:
                 warning = QtWidgets.QMessageBox.warning(self, 'Cannot Access File',
@@ -640,13 +655,28 @@ class mywindow(QtWidgets.QMainWindow):
                 elif random_points:
                     self.worker = ScanWorker_random_sample(self.HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order,
                                                           filename, self.averages, number_points)
+                elif adaptive:
+                    self.worker = ScanWorker_adaptive(self.HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order,
+                                                      filename, self.averages, tolerance, max_points)
                 else: # can this be an elif block?
                     if on_the_fly:
                         self.worker = ScanWorker_onthefly(self.HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order, filename,
                                                           self.averages, scan_speed)
                     else:
+                        resume = False  # carry on from points already saved in file
+                        if exists(filename):
+                            answer = QtWidgets.QMessageBox.question(
+                                self, 'Resume Scan?',
+                                "File already exists - resume the scan from the next unmeasured point?\n"
+                                "Choose No to start again and overwrite the file.",
+                                QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No | QtWidgets.QMessageBox.Cancel)
+                            if answer == QtWidgets.QMessageBox.Cancel:
+                                self.thread_complete()  # tidy up without scanning
+                                return
+                            resume = answer == QtWidgets.QMessageBox.Yes
                         self.worker = ScanWorker_pointbypoint(self.HP, mc, x0, x1, dx, y0, y1, dy, z0, z1, dz, order,
-                                                              filename, self.averages)
+                                                              filename, self.averages, resume)
+                        self.worker.pattern = pattern
                 print('created')
                 # worker.signals.result.connect(self.UpdateMotorSettings)
                 self.worker.setAutoDelete(True)
@@ -689,8 +719,6 @@ class mywindow(QtWidgets.QMainWindow):
         """Function to be executed when multipoles scan button pressed"""
         print('Multipoles Scan function selected')
 
-        self.pause_timers()
-
         # Retrieve values stored in line edits
         x0 = self.ui.multipole_x_Centre_Edit.text()  # Get x centre value
 
@@ -731,7 +759,7 @@ class mywindow(QtWidgets.QMainWindow):
             # Check if file can be written to
             try:
                 print(exists(filename))
-                if exists(filename):
+                if exists(filename) and not isdir(filename):  # .npycols output is a directory
                     my_file = open(filename, "r+")
             except:
                 print('cant write to file')
@@ -788,16 +816,8 @@ class mywindow(QtWidgets.QMainWindow):
         self.ui.rateLabel.setText("Sample Rate (Hz) = " + settings[1])
         self.ui.averageLabel.setText("Samples per average = " + str(self.averages))
 
-    def ReadProbeSettings(self):
-        """Read probe settings using QThread Object"""
-        worker = ProbeSettingsWorker(self.HP)  # connect to FieldsWorker object
-        worker.signals.result.connect(self.UpdateProbeSettings)
-        worker.setAutoDelete(True)  # make worker auto-deletable so can be cleared
-        self.pool.start(worker)
-
     def probe_settings_click(self):
         """Function to apply changes in probe settings"""
-        self.pause_timers()
         # Set measurement range
         if self.HP.type() == '3MH6':
             if self.ui.rangeCombo.currentIndex() == 0:  # if 500mT selected
@@ -826,6 +846,7 @@ class mywindow(QtWidgets.QMainWindow):
                                                     QtWidgets.QMessageBox.Ok)
         else:  # if no error in value
             self.averages = int(new_averages)
+            self.monitor.averages = self.averages
 
         worker = setProbeSettingsWorker(self.HP, new_range, rate)  # connect to setProbeSettingsWorker object
         worker.signals.result.connect(self.UpdateProbeSettings)
@@ -860,8 +881,6 @@ class mywindow(QtWidgets.QMainWindow):
 
     def motor_settings_click(self):
         """Function to be executed when motor settings are updated"""
-        self.pause_timers()  # pause timers for updating GUI whilst function is executed
-
         x_speed = self.ui.xspeedEdit.text()  # get x axis speed from GUI
         y_speed = self.ui.yspeedEdit.text()  # get y axis speed from GUI
         z_speed = self.ui.zspeedEdit.text()  # get z axis speed from GUI
@@ -958,9 +977,7 @@ class mywindow(QtWidgets.QMainWindow):
                                                 QtWidgets.QMessageBox.Yes | QtWidgets.QMessageBox.No)
 
         if choice == QtWidgets.QMessageBox.Yes:
-            self.timer.stop()  # stop timers to recurring threads
-            self.timer2.stop()
-            time.sleep(0.1)
+            self.display_timer.stop()
 
             count0 = self.pool.activeThreadCount()  # number of active threads when program termination started
 
@@ -983,6 +1000,7 @@ class mywindow(QtWidgets.QMainWindow):
                 self.track_progess(progress - 1)
 
             self.pool.waitForDone()  # wait for all active threads to be closed
+            self.monitor.stop().join(5)  # stop background reads of positions and fields before closing devices
 
             self.HP.close()  # close serial port connection with tesla-meter
             mc.close()  # close serial connection with motor controller
@@ -0,0 +1,151 @@
+import threading
+import time
+import traceback
+import numpy as np
+import device_broker
+from ProbeSettingsWorker import read_probe_settings
+
+
+class MonitorService:
+    """Long-lived background reader of stage positions, probe fields and probe settings for the GUI display.
+
+    Each device is read by its own thread at most once per interval. A tick which comes while the previous read is
+    still in flight is skipped rather than queued, so slow reads never pile up. Results are kept as a latest-value
+    snapshot which the GUI picks up at its own display rate. Probes which can stream are kept streaming and their
+    fields are taken from the newest samples in the stream's buffer, the same buffer scans read from.
+
+    Devices are only read under a shared session from the device broker. While a scan or move holds a device
+    exclusively the monitor doesn't touch it, and shows the positions and fields the scan is reading instead. Starting
+    and stopping the probe stream changes the probe for everyone, so is done under an exclusive session."""
+
+    def __init__(self, HP, mc, averages=1000, interval=0.1, settings_interval=5, stream=True, broker=None):
+        self.HP = HP
+        self.mc = mc
+        self.broker = broker or device_broker.broker(mc, HP)
+        self.averages = averages  # number of samples in displayed field averages
+        self.interval = interval  # time between position and field reads / s
+        self.settings_interval = settings_interval  # time between probe settings reads / s
+        self.stream = stream  # keep probe broadcasting if it can, so fields are read from its buffer
+        self.read_fields = HP.type() != 'blank'
+
+        self.condition = threading.Condition()
+        self.stopping = threading.Event()
+        self.latest = {}  # name: latest value read
+        self.updated = {}  # name: host time of latest value
+        self.reads = {}  # name: number of reads completed
+        self.skipped = {}  # name: number of ticks skipped because a read was still in flight
+        self.threads = []
+
+    def start(self):
+        """Start reader threads (and probe stream)"""
+        if self.threads:
+            return
+        self.stopping = threading.Event()  # new for each start, so threads still stopping from before stay stopped
+        readers = [('positions', 'stage', self.read_positions, self.interval, None)]
+        if self.read_fields:
+            readers.append(('probe', 'probe', self.read_probe, self.interval, self.start_stream))
+        for name, device, read, interval, prepare in readers:
+            thread = threading.Thread(target=self.poll, args=(name, device, read, interval, prepare, self.stopping),
+                                      daemon=True)
+            self.threads.append(thread)
+            thread.start()
+
+    def stop(self):
+        """Tell reader threads to stop and return at once, without waiting for devices.
+
+        A background thread waits for any read in flight and then stops the probe stream, once it can have the probe
+        exclusively. That thread is returned for callers which must wait for it, e.g. before closing the devices."""
+        self.stopping.set()
+        threads, self.threads = self.threads, []
+        stopper = threading.Thread(target=self.finish, args=(threads,), daemon=True)
+        stopper.start()
+        return stopper
+
+    def finish(self, threads):
+        """Wait for reader threads to end, then stop the probe stream - run in stopping thread"""
+        for thread in threads:
+            thread.join()
+        if self.stream and self.read_fields:
+            with self.broker.exclusive('monitor', ['probe']):
+                self.HP.stop_stream()
+
+    def start_stream(self):
+        """(Re)start probe stream if it isn't running, e.g. after a scan has stopped it - run in reader thread.
+
+        Needs the probe exclusively, so is left for a later tick while anyone else is using it."""
+        if not self.stream or getattr(self.HP, 'streaming', True) or self.broker.busy('probe'):
+            return
+        try:
+            session = self.broker.exclusive('monitor', ['probe'], priority=0, timeout=0)
+        except TimeoutError:
+            return
+        with session:
+            if not getattr(self.HP, 'streaming', True):
+                self.HP.start_stream()
+
+    def snapshot(self):
+        """Return dict of name: (value, host time read) for the latest value from each reader"""
+        with self.condition:
+            return {name: (value, self.updated[name]) for name, value in self.latest.items()}
+
+    def poll(self, name, device, read, interval, prepare, stopping):
+        """Call read once per interval until stopped, skipping ticks while a read overruns - run in reader thread.
+
+        prepare (if any) is called first, outside any session. read is told whether the monitor may use the device
+        (a shared session was granted) or must make do with what others have read."""
+        self.reads[name] = 0
+        self.skipped[name] = 0
+        next_tick = time.time()
+        while not stopping.is_set():
+            session = None
+            try:
+                if prepare is not None:
+                    prepare()
+                session = self.broker.shared('monitor', [device], block=False)
+                values = read(session is not None)
+            except:
+                traceback.print_exc()
+                values = {}
+            finally:
+                if session is not None:
+                    session.release()
+                with self.condition:
+                    now = time.time()
+                    for key, value in values.items():
+                        self.latest[key] = value
+                        self.updated[key] = now
+                    self.reads[name] += 1
+
+            next_tick += interval
+            late = time.time() - next_tick
+            if late > 0:  # read took longer than interval - drop the ticks missed
+                missed = int(late / interval) + 1
+                self.skipped[name] += missed
+                next_tick += missed * interval
+            stopping.wait(max(0.0, next_tick - time.time()))
+
+    def read_positions(self, own):
+        """Return dict with x, y, z positions / mm - read by someone else if not own"""
+        if not own:
+            positions = self.broker.latest_positions()
+            return {} if positions is None else {'positions': positions}
+        return {'positions': self.mc.get_positions(['x', 'y', 'z'])}
+
+    def read_probe(self, own):
+        """Return dict with fields (and probe settings, when due) - from the stream buffer if probe is streaming, or
+        from samples read by someone else if not own"""
+        values = {}
+        if own:
+            if time.time() - self.updated.get('settings', 0) >= self.settings_interval:
+                values['settings'] = read_probe_settings(self.HP)
+        if not own or getattr(self.HP, 'streaming', False):
+            block = self.broker.latest_samples(self.averages)
+            if block is None:
+                return values
+            columns = [self.HP.reject_outliers(block[:, i]) for i in range(4)]  # bx, by, bz, th
+            means = [np.mean(column) for column in columns]
+            deviations = [np.std(column) for column in columns]
+            values['fields'] = means[:3] + deviations[:3] + [means[3], deviations[3]]
+        else:
+            values['fields'] = self.HP.get_fields(self.averages)
+        return values
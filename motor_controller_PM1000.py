@@ -3,8 +3,15 @@ import datetime
 import serial
 from time import sleep, time
 import re
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
 from typing import Union
 
+import pm1000_simulator
+import instrumentation
+
 qa_pair = re.compile(r' {2,}(?![= \-\d])')
 pair_split = re.compile('[:=]')
 query_params = re.compile(r'\s+([\w\s]+?) *?[=:]\s*([\w\d-]+)')
@@ -14,15 +21,265 @@ name_map = {'actual pos': 'actual position', 'command pos': 'command position',
             'settling': 'settling time', 'settle time': 'settling time', 'tracking': 'tracking window'}
 
 
+binary_params = ('read port', 'last write')  # query all parameters given as binary values
+
+
+def parse_query_all(lines):
+    """Parse the lines of a "query all" reply (skipping the first line) into a dict of parameters."""
+    output_dict = {}
+    for line in lines[1:]:  # skip the first line
+        for pair in qa_pair.split(line.strip()):  # split the line into pairs of params (usu 2 but can be more)
+            pair_array = pair_split.split(pair)
+            if len(pair_array) < 2:  # no "=" or ":" found
+                pair_array = pair.rsplit(' ', maxsplit=1)  # Use only the last word as the value, and the rest as the name
+            name = pair_array[0].strip().lower()  # use lowercase names in the dict
+            name = name_map.get(name, name)  # try to standardise names across MC versions
+            value = pair_array[1].strip()
+            try:
+                out_value = int(value, 2 if name in binary_params else 10)  # try to interpret as an integer
+            except ValueError:
+                # try to interpret Enabled/Disabled/On/Off as True/False, otherwise just use the string value
+                out_value = truthy_dict.get(value.lower(), value.lower())
+            output_dict[name] = out_value
+    return output_dict
+
+
+status_busy = 3  # index of "axis busy" flag in "output status" reply, e.g. 03:10000000
+status_hard_limit = 5  # index of "hard limit" flag in "output status" reply
+
+
 class OutOfRangeException(Exception):
     """Raise when the user tries to set a parameter out of range."""
 
 
+def record_round_trip(send, lines, latency, line_end_length, timed_out=False):
+    """Add a command and its reply lines to the serial statistics."""
+    command = instrumentation.pm1000_name(send)
+    instrumentation.stats.record('PM1000', command, latency, len(send) + line_end_length,
+                                 sum(len(line) + line_end_length for line in lines))
+    if timed_out:
+        instrumentation.stats.timeout('PM1000', command)
+
+
+class CommandRequest:
+    """A command waiting to be written to the motor controller, or waiting for its reply."""
+
+    def __init__(self, send, prefix, echo, multi_line, timeout):
+        self.send = send  # command string as written, without line end
+        self.prefix = prefix  # prefix expected at the start of the reply, e.g. '03:'
+        self.echoed = not echo  # True once the command echo has been received (or if no echo expected)
+        self.multi_line = multi_line  # True if reply runs over several lines, e.g. "query all"
+        self.timeout = timeout  # maximum time to wait for the reply / s
+        self.lines = []  # reply lines received so far, including echo
+        self.future = Future()  # resolves to list of reply lines
+        self.submitted_at = time()  # time command was queued
+        self.sent_at = None  # time command was written
+        self.last_rx = None  # time last reply line was received
+        self.replied = False  # True once the reply line (after any echo) has been received
+        self.late_lines = []  # reply lines received after timing out, kept for a re-read by the caller
+        self.late_until = None  # time to stop waiting for a late reply after timing out
+
+
+class CommandQueue:
+    """Single I/O thread which owns the motor controller serial port.
+
+    Commands are submitted from any thread and answered through futures resolving to the list of reply lines.
+    Replies are matched to requests by command echo and axis prefix, so single-line queries to different axes are
+    written back-to-back instead of one round trip at a time. Multi-line commands (e.g. qa) are written on their own
+    once every other reply is in.
+
+    The controller can't tag replies, so each axis has at most one command outstanding and replies are taken strictly
+    in order: a reply line only counts once its command has been echoed. A command which times out still owns the
+    lines it is owed until they arrive or late_wait has passed, and no other command is written to that axis
+    meanwhile, so a late reply can never be taken as the answer to a newer command. Late replies are kept for the
+    caller's re-read (late_lines) and anything else unexpected is dropped.
+
+    The I/O thread holds lock while it changes the requests it tracks, as late_lines is called from other threads."""
+
+    def __init__(self, serial_port, line_end=b'\r\n', multi_line_idle=0.3, late_wait=3):
+        self.serial_port = serial_port
+        self.line_end = line_end
+        self.multi_line_idle = multi_line_idle  # multi-line reply complete when nothing received for this long / s
+        self.late_wait = late_wait  # time to keep waiting for the reply to a command which has timed out / s
+
+        self.requests = queue.Queue()  # requests submitted but not yet taken by I/O thread
+        self.waiting = deque()  # requests taken by I/O thread but not yet written
+        self.in_flight = []  # requests written and waiting for replies, oldest first
+        self.late = []  # requests which have timed out, still owed reply lines or holding late replies
+        self.replied = None  # request whose reply line was the last line received, not yet completed
+        self.dropped = 0  # number of reply lines which belonged to no request
+        self.rx = bytearray()  # received bytes not yet split into lines
+        self.lock = threading.Lock()  # guards late and running, which callers' threads also use
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, send, prefix, echo=True, multi_line=False, timeout=1):
+        """Queue command string for writing and return future resolving to list of reply lines"""
+        request = CommandRequest(send, prefix, echo, multi_line, timeout)
+        with self.lock:
+            if self.running and self.thread.is_alive():
+                self.requests.put(request)
+            else:  # nobody left to write it
+                request.future.set_exception(serial.SerialException('Motor controller command queue stopped'))
+        return request.future
+
+    def late_lines(self, send, prefix):
+        """Return and forget reply lines received after the last command send to an axis prefix timed out"""
+        with self.lock:
+            for request in self.late:
+                if request.send == send and request.prefix == prefix:
+                    self.late.remove(request)
+                    return request.late_lines
+        return []
+
+    def stop(self):
+        """Stop I/O thread, failing any requests still outstanding"""
+        self.running = False
+        self.thread.join()
+
+    def run(self):
+        """I/O loop - run in background thread"""
+        try:
+            while self.running:
+                self.take_requests(block=not (self.in_flight or self.waiting))
+                with self.lock:
+                    self.write_ready()
+                self.read_lines()
+                with self.lock:
+                    self.expire()
+        finally:
+            with self.lock:  # no more requests accepted once running is cleared
+                self.running = False
+                while not self.requests.empty():
+                    self.waiting.append(self.requests.get_nowait())
+                for request in list(self.waiting) + self.in_flight:
+                    request.future.set_exception(serial.SerialException('Motor controller command queue stopped'))
+
+    def take_requests(self, block):
+        """Move newly submitted requests onto the waiting list"""
+        try:
+            if block:  # nothing to do until a request arrives
+                self.waiting.append(self.requests.get(timeout=0.05))
+            while True:
+                self.waiting.append(self.requests.get_nowait())
+        except queue.Empty:
+            pass
+
+    def write_ready(self):
+        """Write every waiting command which can be told apart from the replies already expected"""
+        blocked = set()  # prefixes with an earlier request still waiting - keep commands to each axis in order
+        owed = [r for r in self.late if not r.replied]  # timed out requests still owed a reply
+        for request in list(self.waiting):
+            if self.in_flight and self.in_flight[0].multi_line:  # multi-line reply in progress - send nothing
+                break
+            if request.multi_line:
+                if not self.in_flight and not owed:  # send on its own once all other replies are in
+                    self.write(request)
+                break  # keep later requests waiting behind it
+            if request.prefix in blocked or any(r.prefix == request.prefix for r in self.in_flight + owed):
+                blocked.add(request.prefix)  # one request in flight per axis
+                continue
+            self.write(request)
+
+    def write(self, request):
+        self.waiting.remove(request)
+        self.serial_port.write(request.send.encode('utf-8') + self.line_end)
+        request.sent_at = time()
+        self.in_flight.append(request)
+
+    def read_lines(self):
+        """Read whatever has arrived and hand each complete line to the request it belongs to"""
+        pending = self.serial_port.in_waiting  # only read what has arrived, so writes are never held up
+        if pending:
+            self.rx += self.serial_port.read(pending)
+        elif self.in_flight:
+            sleep(0.001)  # waiting for replies - don't spin
+        now = time()
+        with self.lock:
+            while True:
+                end = self.rx.find(self.line_end)
+                if end < 0:
+                    break
+                line = self.rx[:end].decode('utf-8')
+                del self.rx[:end + len(self.line_end)]
+                self.route(line, now)
+            if self.replied is not None and not self.rx and not self.serial_port.in_waiting:
+                self.complete(self.replied)  # nothing more on its way - reply wasn't split over another line
+
+    def route(self, line, now):
+        """Append reply line to the request it belongs to, completing single-line requests"""
+        replied, self.replied = self.replied, None
+        for request in self.in_flight + self.late:
+            if not request.echoed and line == request.send:  # command echo
+                request.echoed = True
+                (request.late_lines if request in self.late else request.lines).append(line)
+                request.last_rx = now
+                if replied is not None:
+                    self.complete(replied)
+                return
+        for request in self.in_flight:
+            if request.multi_line:  # exclusive - every line belongs to it
+                request.lines.append(line)
+                request.last_rx = now
+                return
+        if replied is not None:
+            if not any(line.startswith(r.prefix) for r in self.in_flight + self.late if r.prefix):
+                (replied.late_lines if replied in self.late else replied.lines).append(line)  # rest of split reply
+                self.replied = replied
+                return
+            self.complete(replied)
+        for request in self.in_flight + self.late:
+            if request.prefix and line.startswith(request.prefix) and request.echoed and not request.replied:
+                request.replied = True
+                request.last_rx = now
+                if request in self.late:
+                    request.late_lines.append(line)
+                else:
+                    request.lines.append(line)
+                self.replied = request  # completed once any continuation line has arrived
+                return
+        self.dropped += 1
+        print('Dropped unexpected reply from motor controller: "{}"'.format(line))
+
+    def complete(self, request, timed_out=False):
+        """Resolve future of request with its reply lines - on timeout keep it to collect its late reply"""
+        if self.replied is request:
+            self.replied = None
+        if request in self.late:  # late reply complete - kept until the caller re-reads it or it expires
+            return
+        self.in_flight.remove(request)
+        if instrumentation.stats is not None:
+            record_round_trip(request.send, request.lines, time() - request.submitted_at, len(self.line_end),
+                              timed_out)
+        if timed_out:
+            request.late_until = time() + self.late_wait
+            self.late.append(request)
+        request.future.set_result(request.lines)
+
+    def expire(self):
+        """Complete multi-line replies once the controller goes quiet, and requests which have timed out"""
+        now = time()
+        for request in list(self.in_flight):
+            if request is self.replied:
+                continue
+            if request.multi_line and request.echoed and len(request.lines) > 1 and \
+                    now - request.last_rx > self.multi_line_idle:
+                self.complete(request)
+            elif now - request.sent_at > request.timeout:
+                self.complete(request, timed_out=True)  # return what has been received - caller checks the reply
+        for request in list(self.late):
+            if now > request.late_until:  # reply lost, or never re-read by caller
+                self.late.remove(request)
+
+
 class Axis:
     def __init__(self, serial_port, axis_id, scale_factor, max_speed, acceleration, axis_type='linear',
-                 version='PM1000'):
+                 version='PM1000', command_queue=None):
         """Initialise axis with some parameters."""
         self.serial_port = serial_port
+        self.command_queue = command_queue  # CommandQueue owning the serial port, or None to use the port directly
         self.id = axis_id  # axis id number starting with 1
         self.scale_factor = scale_factor  # steps per mm or steps per degree
         self.max_speed = max_speed  # mm/s or deg/s
@@ -40,27 +297,31 @@ class Axis:
         self.line_end = b'\r' if version == 'SCL' else b'\r\n'  ###carriage return value
         self.echo = True if self.version == 'PM1000' else False  # version != 'SCL'
 
-    def talk(self, command: str, parameter: Union[str, int, float] = '',
-             multi_line: bool = False, check_ok: bool = False):
-        """Send a command to the motor controller and wait for a response."""
+        self.cache_ttl = 60  # time to keep "query all" results before asking the controller again / s
+        self.query_cache = {}  # command: (time queried, parameter dict) of recent "query all" replies
+        self.last_position = None  # (time read, position) of latest position query, for monitors to reuse
+        self.queue_timeout = 30  # longest wait for the command queue to answer a command, e.g. if it has died / s
+
+    def submit(self, command: str, parameter: Union[str, int, float] = '', multi_line: bool = False):
+        """Write a command through the command queue without waiting; return the string sent and a future reply."""
         command = command.upper()  # need upper for SCL, other versions don't care
         # Coerce floats to ints (assuming there aren't any float-type commands!)
         if isinstance(parameter, float):
             parameter = round(parameter)
         send = '{}{}{}'.format(self.id, command, parameter)
-        self.serial_port.write(send.encode('utf-8') + self.line_end)
+        timeout = 3 if command.lower() in ('qa', '__qa') else 1  # long replies take longer to arrive
+        future = self.command_queue.submit(send, self.prefix, echo=self.echo, multi_line=multi_line, timeout=timeout)
+        return send, future
 
-        if command.lower() == 'qa':
-            sleep(1)
-
-        # Old read method - some data loss
-        # reply = ''
-        # while reply.count(self.line_end.decode('utf-8')) < (1):
-        #     sleep(2 if command.lower() in ('qa', 'he', 'hc') else 0.2)  # longer for certain commands
-        #     reply += self.serial_port.read_all().decode('utf-8')
-        # lines = reply.splitlines()
-        # print(lines)
+    def wait_reply(self, send, future):
+        """Return reply lines of a command submitted through the command queue, once they are in."""
+        try:
+            return list(future.result(self.queue_timeout))
+        except FutureTimeoutError:  # the queue times out replies itself, so it has stopped answering
+            raise serial.SerialException('No answer from motor controller command queue to {}'.format(send))
 
+    def read_reply(self):
+        """Read lines from the serial port until the receive buffer is empty."""
         ##New read method - needs to set timeout = 1 s
         # print('Read from serial port - ', datetime.datetime.now())
 
@@ -76,7 +337,42 @@ class Axis:
             else:
                 break
         rx_data = ''.join(rx_buf)  # Join the chunks, to get a string of serial data.
-        lines = rx_data.splitlines()  # split data into lines
+        return rx_data.splitlines()  # split data into lines
+
+    def talk(self, command: str, parameter: Union[str, int, float] = '',
+             multi_line: bool = False, check_ok: bool = False):
+        """Send a command to the motor controller and wait for a response."""
+        if self.command_queue is not None:  # round trip recorded by the command queue
+            send, future = self.submit(command, parameter, multi_line)
+            lines = self.wait_reply(send, future)
+        else:
+            started = time()
+            command = command.upper()  # need upper for SCL, other versions don't care
+            # Coerce floats to ints (assuming there aren't any float-type commands!)
+            if isinstance(parameter, float):
+                parameter = round(parameter)
+            send = '{}{}{}'.format(self.id, command, parameter)
+            self.serial_port.write(send.encode('utf-8') + self.line_end)
+
+            if command.lower() == 'qa':
+                sleep(1)
+
+            # Old read method - some data loss
+            # reply = ''
+            # while reply.count(self.line_end.decode('utf-8')) < (1):
+            #     sleep(2 if command.lower() in ('qa', 'he', 'hc') else 0.2)  # longer for certain commands
+            #     reply += self.serial_port.read_all().decode('utf-8')
+            # lines = reply.splitlines()
+            # print(lines)
+
+            lines = self.read_reply()
+            if instrumentation.stats is not None:
+                record_round_trip(send, lines, time() - started, len(self.line_end),
+                                  timed_out=len(lines) < (2 if self.echo else 1))  # no reply after echo
+        return self.check_reply(send, lines, multi_line, check_ok)
+
+    def check_reply(self, send, lines, multi_line=False, check_ok=False):
+        """Check command echo and OK response of reply lines and return the reply."""
         lines[1: 3] = [''.join(lines[1: 3])]
 
         if self.echo:
@@ -87,19 +383,17 @@ class Axis:
 
         if check_ok and not lines[0] == self.prefix + ('%' if self.version == 'SCL' else 'OK'):
             print('Initial error response on command "{}": received "{}"'.format(send, lines[0]))
+            if instrumentation.stats is not None:
+                instrumentation.stats.retry('PM1000', instrumentation.pm1000_name(send))
 
             # Try re-reading buffer after slight pause to check buffer has been read
             sleep(2)  # pause, give buffer chance to fill
-            rx_buf = [self.serial_port.read_until(b'\r\n').decode('utf-8')]  # read until end of line character
-            while True:  # Loop to read remaining data, to end of receive buffer.
-                pending = self.serial_port.inWaiting()
-                if pending:  # if pending data to read,
-                    rx_buf.append(
-                        self.serial_port.read_until(b'\r\n').decode('utf-8'))  # Append read lines to the list.
-                else:
-                    break
-            rx_data = ''.join(rx_buf)  # Join the chunks, to get a string of serial data.
-            lines = rx_data.splitlines()  # split data into lines
+            if self.command_queue is not None:
+                lines = self.command_queue.late_lines(send, self.prefix)  # late reply to this command only
+                if lines and lines[0] == send:
+                    lines.pop(0)  # echo
+            else:
+                lines = self.read_reply()
             lines[1: 3] = [''.join(lines[1: 3])]
 
             print('Response lines after re-read = ', lines)
@@ -112,44 +406,57 @@ class Axis:
 
     def get_position(self, set_value=True):  # ask for the set value by default, otherwise the read value
         """Query the motor controller for the axis position (set or read)."""
-        if self.version == 'SCL':
-            command = 'ie'  # TODO: set position?
-        else:
-            command = 'oc' if set_value else 'oa'  # "output command", "output actual"
-
         while True:
             try:
-                reply = self.talk(command)  # "output command", "output actual"
-                # print(reply)
-                # reply should begin either CP=, AP= or 01#, 02#, ...
-                if self.version == 'PM304':
-                    prefix = 'CP=' if set_value else 'AP='
-                else:
-                    prefix = self.prefix
-                if not reply.startswith(prefix):
-                    raise ValueError('Bad reply from axis {}: "{}" does not begin "{}"'.format(self.id, reply, prefix))
-                if self.version == 'SCL':
-                    answer = reply[4:]
-                else:
-                    answer = reply[3:]
-                try:
-                    value = int(answer)
-                except ValueError:
-                    value = 0
-                # print('value = ', value)
-                # print('scale factor = ', self.scale_factor)
-                return value / self.scale_factor
+                reply = self.talk(self.position_command(set_value))  # "output command", "output actual"
+                return self.parse_position(reply, set_value)
+            except serial.SerialException:  # port or command queue gone - retrying can't help
+                raise
             except:
                 print('was a value error - try again')
-                pass
+                if instrumentation.stats is not None:
+                    instrumentation.stats.retry('PM1000', self.position_command(set_value))
+
+    def position_command(self, set_value=True):
+        """Return the command which queries the axis position (set or read)."""
+        if self.version == 'SCL':
+            return 'ie'  # TODO: set position?
+        return 'oc' if set_value else 'oa'  # "output command", "output actual"
+
+    def parse_position(self, reply, set_value=True):
+        """Convert reply to a position query into a position in mm or degrees."""
+        # print(reply)
+        # reply should begin either CP=, AP= or 01#, 02#, ...
+        if self.version == 'PM304':
+            prefix = 'CP=' if set_value else 'AP='
+        else:
+            prefix = self.prefix
+        if not reply.startswith(prefix):
+            raise ValueError('Bad reply from axis {}: "{}" does not begin "{}"'.format(self.id, reply, prefix))
+        if self.version == 'SCL':
+            answer = reply[4:]
+        else:
+            answer = reply[3:]
+        try:
+            value = int(answer)
+        except ValueError:
+            value = 0
+        # print('value = ', value)
+        # print('scale factor = ', self.scale_factor)
+        self.last_position = (time(), value / self.scale_factor)
+        return value / self.scale_factor
 
     def move(self, position, relative=False, wait=False, tolerance=0.01, timeout='auto'):
         """Instruct the motor controller to move the axis by the specified amount."""
         init_pos = self.get_position()
         final_pos = position + (init_pos if relative else 0)
-        if wait and timeout == 'auto':
-            timeout = abs(final_pos - init_pos) / self.max_speed + 60  # allow extra time  # TODO: should query speed
 
+        self.send_move(position, relative)
+        if wait:
+            self.wait_for_move(final_pos, abs(final_pos - init_pos), tolerance, timeout)
+
+    def send_move(self, position, relative=False):
+        """Send the move command without waiting for the axis to arrive."""
         steps = int(position * self.scale_factor)
         if self.version == 'SCL':
             command = 'fl' if relative else 'fp'  # "feed to length", "feed to position"
@@ -158,16 +465,47 @@ class Axis:
         # print('sending move command')
         self.talk(command, steps, check_ok=True)
         # print('sent move command')
-        if wait:
-            start = time()
-            sleep(0.1)
-            while abs(self.get_position() - final_pos) > tolerance:
-                # print(self.get_position())
-                sleep(0.1)
-                if time() - start > timeout:
-                    print('Timeout error here! moving to position ', position)
-                    raise TimeoutError('Timed out waiting for axis {} to reach position {}'.format(self.id, final_pos))
-            # sleep(0.2)  # extra delay so we don't confuse the controller
+
+    def move_time(self, distance):
+        """Return time in s for a move of given distance, from the trapezoidal speed profile."""
+        ramp = self.max_speed ** 2 / self.acceleration  # distance taken to reach full speed and stop again
+        if distance < ramp:  # triangular profile - never reaches full speed
+            return 2 * (distance / self.acceleration) ** 0.5
+        return distance / self.max_speed + self.max_speed / self.acceleration
+
+    def is_busy(self):
+        """Return True if the controller reports the axis is still moving, or None if the status can't be read."""
+        try:
+            reply = self.talk('os')  # "output status"
+            return reply[status_busy] == '1'
+        except (ValueError, IndexError):
+            return None
+
+    def wait_for_move(self, final_pos, distance, tolerance=0.01, timeout='auto', poll_interval=0.02,
+                      settle_readings=2):
+        """Wait until the axis has stopped at final_pos.
+
+        Sleeps through most of the predicted move time, then polls the axis status at a short interval and
+        returns once it is idle and settle_readings consecutive positions are all within tolerance of final_pos."""
+        predicted = self.move_time(distance)
+        if timeout == 'auto':
+            timeout = predicted + 60  # allow extra time  # TODO: should query speed
+        start = time()
+        sleep(max(0.0, predicted - 0.05))  # wake shortly before predicted arrival
+        stable = 0  # number of consecutive readings at final position
+        while True:
+            if self.is_busy():
+                stable = 0
+            elif abs(self.get_position(set_value=False) - final_pos) <= tolerance:
+                stable += 1
+                if stable >= settle_readings:
+                    return
+            else:
+                stable = 0
+            if time() - start > timeout:
+                print('Timeout error here! moving to position ', final_pos)
+                raise TimeoutError('Timed out waiting for axis {} to reach position {}'.format(self.id, final_pos))
+            sleep(poll_interval)
 
     def stop(self):
         """Stop the motor immediately."""
@@ -191,9 +529,11 @@ class Axis:
                 print('Cannot turn soft limits off')
                 return
             else:
+                self.invalidate_cache()
                 self.talk('il', check_ok=True)  # "inhibit limits"
                 return
         print(limits)
+        self.invalidate_cache()
         lower_limit = min(limits) * self.scale_factor
         upper_limit = max(limits) * self.scale_factor
         if self.version != 'PM600' and self.version != 'PM1000':
@@ -220,50 +560,37 @@ class Axis:
             speed = self.max_speed
         elif speed > self.max_speed:
             raise OutOfRangeException(f'Requested speed {speed} mm/s is higher than maximum {self.max_speed} mm/s.')
+        self.invalidate_cache()
         self.talk('sv', speed * self.scale_factor, check_ok=True)
 
     def queryAll(self):
         """Query all axis parameters and return the result as a dict."""
         while True:  # loop until dictionary output is successful
             try:
-                # print('talk')
-                reply = self.talk('qa', multi_line=True)  # "query all"
-                sleep(0.1)
-                output_dict = {}
-                for line in reply[1:]:  # skip the first line
-                    # print('line =', line)
-                    pairs = qa_pair.split(line.strip())  # split the line into pairs of params (usu 2 but can be more)
-                    # print('pairs = ', pairs)
-                    for pair in pairs:
-                        pair_array = pair_split.split(pair)
-                        # print('pair_array = ', pair_array)
-                        if len(pair_array) < 2:  # no "=" or ":" found
-                            pair_array = pair.rsplit(' ',
-                                                     maxsplit=1)  # Use only the last word as the value, and the rest as the name
-                        name = pair_array[0].strip().lower()  # use lowercase names in the dict
-                        try:
-                            name = name_map[name]  # try to standardise names across MC versions
-                        except KeyError:
-                            pass  # no translation? just use the name as provided
-                        # print(pair_array)
-                        value = pair_array[1].strip()
-                        try:
-                            base = 2 if name in ('read port', 'last write') else 10  # these two are binary values
-                            out_value = int(value, base)  # try to interpret as an integer
-                        except ValueError:
-                            try:
-                                out_value = truthy_dict[
-                                    value.lower()]  # try to interpret Enabled/Disabled/On/Off as True/False
-                            except KeyError:
-                                out_value = value.lower()  # just use the string value
-                        output_dict[name] = out_value
-                # print('That worked!')
-                # print(output_dict)
-                return output_dict
+                return self.query('qa')  # "query all"
             except:
                 # print('error here')
                 pass
 
+    def query(self, command, max_age=None):
+        """Send a "query all" type command and return the parsed parameters, reusing a recent reply if possible.
+
+        Cached replies are kept for up to cache_ttl seconds (or max_age if given) and dropped whenever a setting is
+        changed. Positions in the reply will be out of date - use get_position for those."""
+        max_age = self.cache_ttl if max_age is None else max_age
+        cached = self.query_cache.get(command)
+        if cached is not None and time() - cached[0] < max_age:
+            return dict(cached[1])
+        output_dict = parse_query_all(self.talk(command, multi_line=True))
+        if not output_dict:
+            raise ValueError('Empty reply to "{}" from axis {}'.format(command, self.id))
+        self.query_cache[command] = (time(), output_dict)
+        return dict(output_dict)
+
+    def invalidate_cache(self):
+        """Forget cached "query all" replies, e.g. after changing a setting."""
+        self.query_cache.clear()
+
     def getLimits(self):
         """Return the soft limits, or None if they are off."""
         while True:  # loop until limits returned successfully
@@ -276,57 +603,26 @@ class Axis:
                     return None
             except:
                 print('name error')
-                pass
+                self.invalidate_cache()  # re-query rather than retrying the same cached reply
 
     def hardLimits(self):
         """Return True if axis is at hard limit"""
         reply = self.talk('os')  # send "output status" command to controller
-        if reply[5] == '0':
+        if reply[status_hard_limit] == '0':
             return False  # axis not at hard limit
-        elif reply[5] == '1':
+        elif reply[status_hard_limit] == '1':
             return True  # axis is at hard limit
 
     def reset(self):
         """Reset motor after abort condition"""
+        self.invalidate_cache()
         self.talk('rs')
 
     def queryAll_hidden(self):
         """Query all hidden commands and output results as dictionary"""
         while True:  # loop until dictionary output is successful
             try:
-                reply = self.talk('__qa', multi_line=True)  # "query all hidden commands"
-                sleep(0.1)
-                output_dict = {}
-                for line in reply[1:]:  # skip the first line
-                    # print('line =', line)
-                    pairs = qa_pair.split(line.strip())  # split the line into pairs of params (usu 2 but can be more)
-                    # print('pairs = ', pairs)
-                    for pair in pairs:
-                        pair_array = pair_split.split(pair)
-                        # print('pair_array = ', pair_array)
-                        if len(pair_array) < 2:  # no "=" or ":" found
-                            pair_array = pair.rsplit(' ',
-                                                     maxsplit=1)  # Use only the last word as the value, and the rest as the name
-                        name = pair_array[0].strip().lower()  # use lowercase names in the dict
-                        try:
-                            name = name_map[name]  # try to standardise names across MC versions
-                        except KeyError:
-                            pass  # no translation? just use the name as provided
-                        # print(pair_array)
-                        value = pair_array[1].strip()
-                        try:
-                            base = 2 if name in ('read port', 'last write') else 10  # these two are binary values
-                            out_value = int(value, base)  # try to interpret as an integer
-                        except ValueError:
-                            try:
-                                out_value = truthy_dict[
-                                    value.lower()]  # try to interpret Enabled/Disabled/On/Off as True/False
-                            except KeyError:
-                                out_value = value.lower()  # just use the string value
-                        output_dict[name] = out_value
-                # print('That worked!')
-                # print(output_dict)
-                return output_dict
+                return self.query('__qa')  # "query all hidden commands"
             except:
                 # print('error here')
                 pass
@@ -334,6 +630,7 @@ class Axis:
     def set_pulse_modulus(self, distance):
         """Set the modulus distance between trigger pulse outputs"""
         steps = int(distance * self.scale_factor)  # scale distance from mm to steps
+        self.invalidate_cache()
         reply = self.talk('__EMOM', steps, check_ok=True)
 
     def get_pulse_modulus(self):
@@ -344,11 +641,12 @@ class Axis:
                 return qa['encoder pulse output modulus'] / self.scale_factor
             except:
                 print('name error')
-                pass
+                self.invalidate_cache()  # re-query rather than retrying the same cached reply
 
     def set_pulse_offset(self, position):
         """Set the offset (from zero) of the base position where a trigger pulse is generated"""
         steps = int(position * self.scale_factor)  # scale distance from mm to steps
+        self.invalidate_cache()
         reply = self.talk('__EMOO', steps, check_ok=True)
 
     def get_pulse_offset(self):
@@ -359,10 +657,11 @@ class Axis:
                 return qa['encoder pulse output offset'] / self.scale_factor
             except:
                 print('name error')
-                pass
+                self.invalidate_cache()  # re-query rather than retrying the same cached reply
 
     def set_output_port(self, port):
         """Set the Write Port output number"""
+        self.invalidate_cache()
         reply = self.talk('__EMOP', port, check_ok=True)
 
     def get_output_port(self):
@@ -373,10 +672,11 @@ class Axis:
                 return qa['encoder pulse output port number']
             except:
                 print('name error')
-                pass
+                self.invalidate_cache()  # re-query rather than retrying the same cached reply
 
     def set_output_time(self, time):
         """Set minimum on time for trigger output in milliseconds"""
+        self.invalidate_cache()
         reply = self.talk('__EMOT', time, check_ok=True)
 
     def get_output_time(self):
@@ -387,7 +687,7 @@ class Axis:
                 return qa['encoder pulse output min on time']
             except:
                 print('name error')
-                pass
+                self.invalidate_cache()  # re-query rather than retrying the same cached reply
 
     def initialiseTrigger(self, start, step, on_time=50, port=1):
         """Initialise output port settings for triggering measurements"""
@@ -443,15 +743,18 @@ class Axis:
 
 
 class MotorController:
-    def __init__(self):
-        serial_port = serial.Serial()
+    def __init__(self, port='COM1'):
+        """Open the controller on a serial port, pyserial URL (e.g. a pty) or simulated controller (sim://)."""
+        if port.startswith('sim://'):
+            serial_port = pm1000_simulator.SimulatedSerial(port)
+        else:
+            serial_port = serial.serial_for_url(port, do_not_open=True)
+            serial_port.bytesize = 7
+            serial_port.parity = serial.PARITY_EVEN
+            serial_port.baudrate = 38400
+            serial_port.timeout = 1  # returns all bytes received until timeout - small number = quick response
+            serial_port.open()
         self.serial_port = serial_port
-        serial_port.port = 'COM1'
-        serial_port.bytesize = 7
-        serial_port.parity = serial.PARITY_EVEN
-        serial_port.baudrate = 38400
-        serial_port.timeout = 1  # returns all bytes received until timeout - small number = quick response
-        serial_port.open()
 
         hpx = Axis(serial_port, 3, 3200, 6,
                    0.5)  # serial_port, axis_id, scale_factor, max_speed, acceleration, axis_type='linear', version='PM341'
@@ -471,8 +774,69 @@ class MotorController:
                      'px': Axis(serial_port, 1, 3200, 6, 6),
                      'fc z2': Axis(serial_port, 10, 4000, 6, 2)}
 
+        # Single I/O thread owns the port so queries to different axes can be pipelined
+        self.command_queue = CommandQueue(serial_port)
+        for axis in self.axis.values():
+            axis.command_queue = self.command_queue
+
+    def get_positions(self, names, set_value=True):
+        """Query the positions of several axes at once and return them as a list in the same order as names.
+
+        Axes can be given by name or as Axis objects. All queries are written back-to-back before waiting for the
+        replies, so reading three axes costs about one round trip instead of three."""
+        axes = [self.axis[name] if isinstance(name, str) else name for name in names]
+        if getattr(self, 'command_queue', None) is None:
+            return [axis.get_position(set_value) for axis in axes]
+        pending = [(axis,) + axis.submit(axis.position_command(set_value)) for axis in axes]
+        positions = []
+        for axis, send, future in pending:
+            try:
+                reply = axis.check_reply(send, axis.wait_reply(send, future))
+                positions.append(axis.parse_position(reply, set_value))
+            except (ValueError, IndexError):  # bad or missing reply - query this axis on its own until it answers
+                if instrumentation.stats is not None:
+                    instrumentation.stats.retry('PM1000', axis.position_command(set_value))
+                positions.append(axis.get_position(set_value))
+        return positions
+
+    def move_to(self, positions, tolerance=0.01, timeout='auto'):
+        """Move several axes together and wait until they have all arrived.
+
+        positions is a dict of axis (name or Axis object): absolute position. All move commands are sent before
+        waiting, so a diagonal step takes as long as the slowest axis rather than the sum of all of them. Axes
+        already within tolerance of their target are not moved.
+
+        If a move command fails, the axes already sent one (and the failing axis, whose OK may only have been late)
+        are still waited for before the error is raised, so callers never measure while the stage is moving."""
+        axes = [self.axis[name] if isinstance(name, str) else name for name in positions]
+        targets = list(positions.values())
+        moving = []  # (axis, target) of axes sent a move command
+        predicted = 0  # longest predicted move time / s
+        failed = None  # axis whose move command raised
+        try:
+            for axis, target, current in zip(axes, targets, self.get_positions(axes)):
+                if abs(target - current) > tolerance:
+                    failed = axis
+                    axis.send_move(target)
+                    failed = None
+                    moving.append((axis, target))
+                    predicted = max(predicted, axis.move_time(abs(target - current)))
+        finally:
+            if timeout == 'auto':
+                timeout = predicted + 60  # allow extra time
+            start = time()
+            if moving:
+                sleep(max(0.0, predicted - 0.05))  # all axes move at once - wake shortly before slowest should arrive
+            for axis, target in moving:
+                axis.wait_for_move(target, 0, tolerance, max(0.0, timeout - (time() - start)))
+            while failed is not None and failed.is_busy() and time() - start < timeout:
+                sleep(0.02)  # may be moving after all - let it stop
+
     def close(self):
         """Close the serial port - we're finished with it."""
+        if getattr(self, 'command_queue', None) is not None:
+            self.command_queue.stop()
+            self.command_queue = None
         self.serial_port.close()
 
     def __del__(self):
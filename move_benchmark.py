@@ -0,0 +1,44 @@
+import time
+import numpy as np
+import motor_controller_PM1000
+
+
+def move_sequential(mc, point):
+    """Move x, then y, then z, waiting for each axis - the old scan worker behaviour"""
+    for name, position in zip('xyz', point):
+        mc.axis[name].move(position, wait=True)
+
+
+def move_together(mc, point):
+    """Move all axes at once with move_to"""
+    mc.move_to(dict(zip('xyz', point)))
+
+
+def benchmark(points, repeats=1):
+    """Return total time in s to visit points with each move method"""
+    mc = motor_controller_PM1000.MotorController('sim://')  # simulated PM1000 with realistic moves and latency
+    results = {}
+    try:
+        for method in (move_sequential, move_together):
+            mc.move_to({'x': 0, 'y': 0, 'z': 0})
+            start = time.time()
+            for _ in range(repeats):
+                for point in points:
+                    method(mc, point)
+            results[method.__name__] = time.time() - start
+    finally:
+        mc.close()
+    return results
+
+
+if __name__ == '__main__':
+    rng = np.random.default_rng(0)
+    random_points = np.round(rng.uniform([0, 0, 0], [2, 2, 20], size=(5, 3)), 2)  # random scan, mm
+    theta = np.linspace(0, 2 * np.pi, 8, endpoint=False)
+    circle_points = np.column_stack([1 + np.cos(theta), 1 + np.sin(theta), np.zeros_like(theta)])  # multipole scan
+
+    for name, points in (('random points', random_points), ('multipole circle', circle_points)):
+        results = benchmark(points)
+        print('{}: sequential {:.2f} s, together {:.2f} s, speed up x{:.2f}'.format(
+            name, results['move_sequential'], results['move_together'],
+            results['move_sequential'] / results['move_together']))
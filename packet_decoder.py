@@ -0,0 +1,72 @@
+import numpy as np
+
+
+class FrameDecoder:
+    """Class to find fixed-length data frames in a stream of bytes and decode them all at once with a numpy dtype"""
+
+    def __init__(self, dtype, start_byte, end_byte):
+        self.dtype = np.dtype(dtype)  # structured dtype describing one whole frame, including start and end bytes
+        self.frame_length = self.dtype.itemsize  # number of bytes per frame
+        self.start_byte = start_byte  # expected value of first byte of each frame
+        self.end_byte = end_byte  # expected value of last byte of each frame
+
+        self.bytes_dropped = 0  # total number of bytes discarded while searching for the start of a frame
+        self.frames_dropped = 0  # total number of frames discarded due to incorrect start or end character
+        self._leftover = b''  # incomplete frame carried over to the next call to decode
+
+    def reset(self):
+        """Discard any partial frame left over from previous data, e.g. after broadcast is restarted"""
+        self._leftover = b''
+
+    def _find_start(self, data, offset):
+        """Return index of the first valid frame at or after offset, or None if no whole frame is found"""
+        last = data.size - self.frame_length + 1  # last index a whole frame could start at
+        if last <= offset:
+            return None
+        candidates = np.flatnonzero((data[offset:last] == self.start_byte) &
+                                    (data[offset + self.frame_length - 1:] == self.end_byte))
+        if candidates.size == 0:
+            return None
+        return offset + candidates[0]
+
+    def decode(self, data):
+        """Decode all whole frames in data and return them as a structured array.
+
+        Bytes after the last whole frame are kept and prepended to the data given in the next call. The returned
+        array may share memory with data, so copy the values out before data is overwritten."""
+        if self._leftover:
+            data = self._leftover + bytes(data)  # join partial frame from previous call onto new data
+        buffer = np.frombuffer(data, dtype=np.uint8)  # view bytes as array without copying
+        length = self.frame_length
+
+        blocks = []  # list of arrays of consecutive valid frames
+        offset = 0  # index of next byte to be decoded
+        while buffer.size - offset >= length:
+            start = self._find_start(buffer, offset)
+            if start is None:  # no whole frames left - keep tail for next call
+                tail = max(offset, buffer.size - length + 1)
+                self.bytes_dropped += tail - offset
+                offset = tail
+                break
+            self.bytes_dropped += start - offset
+
+            count = (buffer.size - start) // length  # number of whole frames available from this start byte
+            frames = buffer[start:start + count * length].reshape(count, length)
+            valid = (frames[:, 0] == self.start_byte) & (frames[:, -1] == self.end_byte)
+            invalid = np.flatnonzero(~valid)
+            good = count if invalid.size == 0 else invalid[0]  # number of valid frames before first bad frame
+
+            blocks.append(np.frombuffer(data, dtype=self.dtype, count=good, offset=start))
+            offset = start + good * length
+            if invalid.size != 0:  # bad frame - skip its first byte and search for the next start character
+                self.frames_dropped += 1
+                self.bytes_dropped += 1
+                offset += 1
+
+        self._leftover = bytes(buffer[offset:])  # keep incomplete frame for next call
+
+        if len(blocks) == 1:
+            return blocks[0]
+        elif len(blocks) == 0:
+            return np.empty(0, dtype=self.dtype)
+        return np.concatenate(blocks)
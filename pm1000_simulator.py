@@ -0,0 +1,367 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse, parse_qs
+
+# Axes in the McLennan rack: axis id: (steps per mm or degree, slew speed mm/s, acceleration mm/s/s)
+# Same values as the Axis definitions in motor_controller_PM1000.MotorController
+default_axes = {1: (3200, 6, 6), 2: (3200, 6, 6), 3: (3200, 6, 0.5), 4: (3200, 6, 0.75), 5: (1000, 50, 10),
+                6: (3200, 5, 2.5), 7: (3200, 3, 1.5), 8: (3200, 5, 2.5), 9: (3200, 3, 1.5), 10: (4000, 6, 2),
+                11: (1048576 / 360, 12, 30), 12: (1048576 / 360, 12, 30)}
+
+command_format = re.compile(r'(\d+)([A-Za-z_]+)(-?\d*)')  # axis id, command, parameter
+
+
+class SimulatedAxis:
+    """One axis of the simulated PM1000 - trapezoidal moves in steps, soft limits and trigger output settings"""
+
+    def __init__(self, axis_id, slew_speed, acceleration, hard_limits=(-10 ** 9, 10 ** 9)):
+        self.id = axis_id
+        self.slew_speed = int(slew_speed)  # steps/s
+        self.acceleration = int(acceleration)  # steps/s/s
+        self.lower_limit = -10 ** 8  # lower soft limit / steps
+        self.upper_limit = 10 ** 8  # upper soft limit / steps
+        self.hard_limits = hard_limits  # travel range of the stage / steps
+        self.at_hard_limit = False
+
+        # Current move: start position, end position, start time, and speed profile used
+        self.start = 0
+        self.end = 0
+        self.t0 = 0
+        self.speed = self.slew_speed
+        self.accel = self.acceleration
+        self.offset = 0  # actual position - command position, set by "ap"
+
+        # Trigger output (hidden __EMO* commands)
+        self.pulse_modulus = 0  # steps between trigger pulses, 0 = off
+        self.pulse_offset = 0  # position of first trigger pulse / steps
+        self.pulse_port = 0  # write port bit used for trigger pulses, 0 = not assigned
+        self.pulse_time = 50  # minimum on time of trigger pulse / ms
+
+    def duration(self):
+        """Return total time of current move / s"""
+        distance = abs(self.end - self.start)
+        ramp = self.speed ** 2 / self.accel  # distance taken to reach full speed and stop again
+        if distance < ramp:
+            return 2 * (distance / self.accel) ** 0.5
+        return distance / self.speed + self.speed / self.accel
+
+    def travelled(self, elapsed):
+        """Return distance in steps covered elapsed s after the start of the current move"""
+        distance = abs(self.end - self.start)
+        total = self.duration()
+        if elapsed >= total:
+            return distance
+        if elapsed <= 0:
+            return 0
+        ramp = min(self.speed / self.accel, total / 2)  # time spent accelerating
+        if elapsed < ramp:
+            return self.accel * elapsed ** 2 / 2
+        if elapsed < total - ramp:
+            return self.accel * ramp ** 2 / 2 + self.accel * ramp * (elapsed - ramp)
+        return distance - self.accel * (total - elapsed) ** 2 / 2
+
+    def position(self, t):
+        """Return command position in steps at time t"""
+        direction = 1 if self.end >= self.start else -1
+        return int(round(self.start + direction * self.travelled(t - self.t0)))
+
+    def busy(self, t):
+        return t - self.t0 < self.duration()
+
+    def move(self, target, t):
+        """Start a move to target steps; return error text or None"""
+        if not self.lower_limit <= target <= self.upper_limit:
+            return '!SOFT LIMIT'
+        self.start = self.position(t)
+        self.end = target
+        self.t0 = t
+        self.speed = self.slew_speed
+        self.accel = self.acceleration
+        self.at_hard_limit = False
+        if not self.hard_limits[0] <= target <= self.hard_limits[1]:  # run into end stop
+            self.end = min(max(target, self.hard_limits[0]), self.hard_limits[1])
+            self.at_hard_limit = True
+        return None
+
+    def stop(self, t):
+        self.start = self.end = self.position(t)
+        self.t0 = t
+
+    def trigger(self, t):
+        """Return True if the trigger output is on at time t"""
+        if not self.pulse_modulus or not self.pulse_port:
+            return False
+        earlier = max(t - self.pulse_time / 1000, self.t0)  # start of window in which a pulse would still be on
+        before, now = self.position(earlier), self.position(t)
+        if before == now:  # not moving
+            return False
+        # trigger positions crossed after leaving "before", up to and including "now"
+        first, last = (before + 1, now) if now > before else (now, before - 1)
+        n = -(-(first - self.pulse_offset) // self.pulse_modulus)  # ceiling division
+        return self.pulse_offset + n * self.pulse_modulus <= last
+
+    def status(self, t):
+        """Return 8 character "output status" flags - busy first, hard limit third"""
+        return '{:d}0{:d}00000'.format(self.busy(t), self.at_hard_limit)
+
+    def query_all(self, t):
+        """Return lines of "query all" reply"""
+        mode = 'Moving' if self.busy(t) else 'Idle'
+        command = self.position(t)
+        return ['Mclennan Digiloop Motor Controller V2.0',
+                'Simulated axis {}'.format(self.id),
+                'Mode = {}  Slew speed = {}'.format(mode, self.slew_speed),
+                'Accel = {}  Decel = {}'.format(self.acceleration, self.acceleration),
+                'Command pos = {}  Actual pos = {}'.format(command, command + self.offset),
+                'Lower limit = {}  Upper limit = {}'.format(self.lower_limit, self.upper_limit),
+                'Soft limits = Enabled  Creep speed = 400',
+                'Read port = 00000000  Last write = {}'.format(self.write_port(t))]
+
+    def query_hidden(self):
+        """Return lines of hidden "query all" reply"""
+        return ['Mclennan Digiloop Motor Controller V2.0',
+                'Hidden parameters axis {}'.format(self.id),
+                'Encoder pulse output modulus = {}  Encoder pulse output offset = {}'.format(self.pulse_modulus,
+                                                                                             self.pulse_offset),
+                'Encoder pulse output port number = {}  Encoder pulse output min on time = {}'.format(
+                    self.pulse_port, self.pulse_time)]
+
+    def write_port(self, t):
+        """Return 8 character write port state, port 1 last"""
+        bits = ['0'] * 8
+        if self.trigger(t):
+            bits[-self.pulse_port] = '1'
+        return ''.join(bits)
+
+
+class PM1000Simulator:
+    """Command interpreter for a simulated McLennan PM1000 rack"""
+
+    def __init__(self, axes=None):
+        axes = default_axes if axes is None else axes
+        self.axes = {axis_id: SimulatedAxis(axis_id, scale * speed, scale * acceleration)
+                     for axis_id, (scale, speed, acceleration) in axes.items()}
+        self.lock = threading.Lock()
+
+    def handle(self, send, t=None):
+        """Return the reply lines (including echo) to one command line"""
+        t = time.time() if t is None else t
+        match = command_format.fullmatch(send.strip())
+        if match is None:
+            return [send]  # garbled command - echo only
+        axis_id, command, parameter = int(match.group(1)), match.group(2).lower(), match.group(3)
+        prefix = '{:02d}:'.format(axis_id)
+        axis = self.axes.get(axis_id)
+        if axis is None:
+            return [send]  # no such axis - nothing answers
+        value = int(parameter) if parameter else None
+        with self.lock:
+            reply = self.command(axis, command, value, t)
+        if isinstance(reply, list):  # multi-line reply
+            return [send, prefix + reply[0]] + reply[1:]
+        return [send, prefix + reply]
+
+    def command(self, axis, command, value, t):
+        if command in ('ma', 'mr'):
+            target = value + (axis.position(t) if command == 'mr' else 0)
+            return axis.move(target, t) or 'OK'
+        elif command == 'oc':
+            return str(axis.position(t))
+        elif command == 'oa':
+            return str(axis.position(t) + axis.offset)
+        elif command == 'os':
+            return axis.status(t)
+        elif command == 'ow':
+            return axis.write_port(t)
+        elif command == 'st':
+            axis.stop(t)
+            return 'OK'
+        elif command == 'rs':
+            axis.stop(t)
+            axis.at_hard_limit = False
+            return 'OK'
+        elif command == 'cp':
+            if axis.busy(t):
+                return '!BUSY'
+            axis.start = axis.end = value
+            return 'OK'
+        elif command == 'ap':
+            axis.offset = value - axis.position(t)
+            return 'OK'
+        elif command == 'sv':
+            if not value or value <= 0:
+                return '!OUT OF RANGE'
+            axis.slew_speed = value
+            return 'OK'
+        elif command == 'sa':
+            axis.acceleration = value
+            return 'OK'
+        elif command == 'll':
+            axis.lower_limit = value
+            return 'OK'
+        elif command == 'ul':
+            axis.upper_limit = value
+            return 'OK'
+        elif command == 'qa':
+            return axis.query_all(t)
+        elif command == '__qa':
+            return axis.query_hidden()
+        elif command == '__emom':
+            axis.pulse_modulus = abs(value)
+            return 'OK'
+        elif command == '__emoo':
+            axis.pulse_offset = value
+            return 'OK'
+        elif command == '__emop':
+            if not 0 <= value <= 8:
+                return '!OUT OF RANGE'
+            axis.pulse_port = value
+            return 'OK'
+        elif command == '__emot':
+            axis.pulse_time = value
+            return 'OK'
+        return '!UNKNOWN COMMAND'
+
+
+class SimulatedSerial:
+    """pyserial-like port connected to a PM1000Simulator, with reply latency and transmission time at the baud rate.
+
+    Open with a URL: sim://?latency=0.005&baudrate=38400"""
+
+    def __init__(self, url='sim://', simulator=None):
+        options = {key: values[0] for key, values in parse_qs(urlparse(url).query).items()}
+        self.port = url
+        self.simulator = PM1000Simulator() if simulator is None else simulator
+        self.latency = float(options.get('latency', 0.005))  # time taken by controller to start replying / s
+        self.baudrate = int(options.get('baudrate', 38400))
+        self.bytesize = 7
+        self.parity = 'E'
+        self.timeout = 1
+        self.is_open = True
+
+        self.condition = threading.Condition()
+        self.rx_line = bytearray()  # command being written, up to line end
+        self.pending = deque()  # (time available, bytes) of replies in transit
+        self.rx = bytearray()  # reply bytes arrived and waiting to be read
+        self.last_delivery = 0  # time last pending reply finishes arriving
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def write(self, data):
+        now = time.time()
+        with self.condition:
+            self.rx_line += data
+            while True:
+                end = self.rx_line.find(b'\r')
+                if end < 0:
+                    break
+                send = self.rx_line[:end].decode('utf-8')
+                del self.rx_line[:end + 1]
+                if self.rx_line.startswith(b'\n'):
+                    del self.rx_line[:1]
+                if send:
+                    reply = ''.join(line + '\r\n' for line in self.simulator.handle(send, now)).encode('utf-8')
+                    # reply arrives after latency, at the baud rate (10 bits per byte), after any earlier replies
+                    start = max(now + self.latency, self.last_delivery)
+                    self.last_delivery = start + len(reply) * 10 / self.baudrate
+                    self.pending.append((self.last_delivery, reply))
+            self.condition.notify_all()
+        return len(data)
+
+    def collect(self):
+        """Move replies which have finished arriving into the receive buffer; return time next one arrives"""
+        now = time.time()
+        while self.pending and self.pending[0][0] <= now:
+            self.rx += self.pending.popleft()[1]
+        return self.pending[0][0] if self.pending else None
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self.collect()
+            return len(self.rx)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def read(self, size=1):
+        deadline = time.time() + (self.timeout if self.timeout is not None else 1e9)
+        with self.condition:
+            while True:
+                next_arrival = self.collect()
+                if self.rx:
+                    data = bytes(self.rx[:size])
+                    del self.rx[:size]
+                    return data
+                now = time.time()
+                if now >= deadline:
+                    return b''
+                wait = deadline - now if next_arrival is None else min(deadline, next_arrival) - now
+                self.condition.wait(max(wait, 0))
+
+    def read_until(self, expected=b'\n', size=None):
+        data = bytearray()
+        while not data.endswith(expected) and (size is None or len(data) < size):
+            byte = self.read(1)
+            if not byte:
+                break
+            data += byte
+        return bytes(data)
+
+    def read_all(self):
+        return self.read(self.in_waiting) if self.in_waiting else b''
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.collect()
+            self.rx.clear()
+
+    def flush(self):
+        pass
+
+
+def open_pty(simulator=None):
+    """Serve a simulated PM1000 on a pseudo-terminal and return its device name (Linux/macOS only)"""
+    import tty
+    simulator = PM1000Simulator() if simulator is None else simulator
+    master, slave = os.openpty()
+    tty.setraw(master)
+    name = os.ttyname(slave)
+
+    def serve():
+        line = b''
+        while True:
+            try:
+                data = os.read(master, 1024)
+            except OSError:  # pty closed
+                return
+            line += data
+            while b'\r' in line:
+                send, line = line.split(b'\r', 1)
+                line = line[1:] if line.startswith(b'\n') else line
+                if send:
+                    time.sleep(0.005)
+                    reply = simulator.handle(send.decode('utf-8'))
+                    os.write(master, ''.join(reply_line + '\r\n' for reply_line in reply).encode('utf-8'))
+
+    threading.Thread(target=serve, daemon=True).start()
+    return name
+
+
+if __name__ == '__main__':
+    device = open_pty()
+    print('Simulated PM1000 on', device)
+    print('Connect with motor_controller_PM1000.MotorController({!r}) - Ctrl+C to stop'.format(device))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sys.exit()
@@ -0,0 +1,101 @@
+import numpy as np
+
+
+class MoveProfile:
+    """Commanded trapezoidal move of one axis - position / mm at any host time, as the PM1000 drives it"""
+
+    def __init__(self, start, end, t0, speed, acceleration):
+        self.start = float(start)  # position at start of move / mm
+        self.end = float(end)  # target position / mm
+        self.t0 = float(t0)  # host time move started / s
+        self.speed = float(speed)  # slew speed / mm/s
+        self.acceleration = float(acceleration)  # mm/s/s
+
+    def duration(self):
+        """Return total time of move / s"""
+        distance = abs(self.end - self.start)
+        ramp = self.speed ** 2 / self.acceleration  # distance taken to reach full speed and stop again
+        if distance < ramp:
+            return 2 * (distance / self.acceleration) ** 0.5
+        return distance / self.speed + self.speed / self.acceleration
+
+    def position(self, t, shift=0.0):
+        """Return positions / mm at host times t, with the move started shift s later than t0"""
+        distance = abs(self.end - self.start)
+        total = self.duration()
+        ramp = min(self.speed / self.acceleration, total / 2)  # time spent accelerating
+        a = self.acceleration
+        elapsed = np.clip(np.asarray(t, dtype=float) - self.t0 - shift, 0, total)
+        travelled = np.where(elapsed < ramp, a * elapsed ** 2 / 2,
+                             np.where(elapsed < total - ramp, a * ramp ** 2 / 2 + a * ramp * (elapsed - ramp),
+                                      distance - a * (total - elapsed) ** 2 / 2))
+        return self.start + np.copysign(1, self.end - self.start) * travelled
+
+
+def fit_shift(profile, times, positions, search=0.5, resolution=0.001):
+    """Return (shift / s, rms error / mm) of the start time which best fits profile to positions logged at times.
+
+    Shifts up to search s either way are tried, coarsely then around the best to the given resolution."""
+    times = np.asarray(times, dtype=float)
+    positions = np.asarray(positions, dtype=float)
+    if len(times) == 0:
+        return 0.0, np.nan
+    centre, width = 0.0, search
+    while True:
+        shifts = centre + np.linspace(-width, width, 201)
+        errors = np.sqrt(np.mean((profile.position(times[:, None], shifts[None, :]) - positions[:, None]) ** 2,
+                                 axis=0))
+        best = np.argmin(errors)
+        centre = shifts[best]
+        if width / 100 <= resolution:
+            return float(centre), float(errors[best])
+        width /= 50
+
+
+def reconstruct(times, log_times, log_positions, profile=None, tolerance=0.005):
+    """Return axis position / mm at host times from a log of (time, position) reads during a move.
+
+    With the commanded profile the reads only fix its timing, so sparse reads are enough. The reads are interpolated
+    directly instead if there is no profile or it doesn't fit them to within tolerance / mm."""
+    if profile is not None:
+        shift, error = fit_shift(profile, log_times, log_positions)
+        if error <= tolerance:
+            return profile.position(times, shift)
+        print('Move profile fits position log to only {:.4f} mm - interpolating log instead'.format(error))
+    return np.interp(times, log_times, log_positions)
+
+
+def fuse(sample_positions, sample_values, targets, window=10):
+    """Return (values, standard deviations) of streamed samples interpolated onto target positions along a line.
+
+    At each target a straight line is fitted to the window samples nearest in position and evaluated there, so
+    the field gradient across the window doesn't bias the result. The standard deviation is of the residuals about
+    that line. Targets outside the positions sampled give NaN."""
+    order = np.argsort(sample_positions, kind='stable')
+    positions = np.asarray(sample_positions, dtype=float)[order]
+    values = np.asarray(sample_values, dtype=float)[order]
+    targets = np.asarray(targets, dtype=float)
+    window = max(1, min(int(window), len(positions)))
+
+    # Indices of the window of samples nearest each target
+    first = np.clip(np.searchsorted(positions, targets) - window // 2, 0, len(positions) - window)
+    indices = first[:, None] + np.arange(window)
+    x = positions[indices] - targets[:, None]  # (targets, window) offsets from target / mm
+    y = values[indices]  # (targets, window, columns)
+
+    # Least squares straight line y = a + b x through each window, evaluated at x = 0
+    n = window
+    sx, sxx = x.sum(axis=1), (x ** 2).sum(axis=1)
+    sy, sxy = y.sum(axis=1), (x[:, :, None] * y).sum(axis=1)
+    determinant = n * sxx - sx ** 2
+    flat = np.abs(determinant) < 1E-12  # all samples at one position - use their mean
+    safe = np.where(flat, 1, determinant)[:, None]
+    intercept = np.where(flat[:, None], sy / n, (sxx[:, None] * sy - sx[:, None] * sxy) / safe)
+    slope = np.where(flat[:, None], 0, (n * sxy - sx[:, None] * sy) / safe)
+    residuals = y - intercept[:, None, :] - slope[:, None, :] * x[:, :, None]
+    deviation = np.sqrt(np.mean(residuals ** 2, axis=1))
+
+    outside = (targets < positions[0] - 1E-3) | (targets > positions[-1] + 1E-3)
+    intercept[outside] = np.nan
+    deviation[outside] = np.nan
+    return intercept, deviation
@@ -0,0 +1,257 @@
+import argparse
+import contextlib
+import datetime
+import functools
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import instrumentation
+import motor_controller_PM1000
+import scan_output
+import teslameter_simulator
+from teslameter_3MH6 import teslameter_3MH6
+from teslameter_3MH3 import teslameter_3MH3
+from teslameter_3MTS import teslameter_3MTS
+import ScanWorker_pointbypoint
+import ScanWorker_onthefly
+import ScanWorker_boundary
+import ScanWorker_random_sample
+import ScanWorker_adaptive
+import MultipoleScanWorker
+
+# Benchmark scans: name: (worker module, worker class name, arguments after HP and mc, before filename and averages)
+# Grid scans cover x 0-1 mm, y 0-1 mm in 0.5 mm steps and z 0-10 mm in 10 mm steps, x fastest (order 2)
+grid = (0, 1, 0.5, 0, 1, 0.5, 0, 10, 10, 2)
+scans = {'pointbypoint': (ScanWorker_pointbypoint, 'ScanWorker_pointbypoint', grid, ()),
+         'onthefly': (ScanWorker_onthefly, 'ScanWorker_onthefly', grid, (2,)),  # scan speed 2 mm/s
+         'boundary': (ScanWorker_boundary, 'ScanWorker_boundary', grid, ()),
+         'random_sample': (ScanWorker_random_sample, 'ScanWorker_random_sample', grid, (18,)),  # 18 points
+         'adaptive': (ScanWorker_adaptive, 'ScanWorker_adaptive', grid, (0.05, 30)),  # 0.05 mT, up to 30 points
+         'multipole': (MultipoleScanWorker, 'MultipoleScanWorker', (0, 0, 1, 8, 0, 10, 10), ())}  # r = 1 mm, 8 steps
+
+phases = ['motion', 'settling', 'limits/settings', 'position readback', 'serial flushing', 'field averaging',
+          'data writing', 'gui signalling', 'worker sleeps', 'other']
+
+
+class PhaseTimer:
+    """Accumulate exclusive wall time per phase - time in a nested call is charged to the inner phase only"""
+
+    def __init__(self):
+        self.totals = defaultdict(float)  # phase: time / s
+        self.calls = defaultdict(int)  # phase: number of calls
+        self.stack = []  # phases currently entered, innermost last
+        self.last = None  # time of last phase change
+        self.thread = None  # only calls from the worker thread are timed
+
+    def enter(self, phase):
+        now = time.perf_counter()
+        if self.stack:
+            self.totals[self.stack[-1]] += now - self.last
+        self.stack.append(phase)
+        self.calls[phase] += 1
+        self.last = now
+
+    def exit(self):
+        now = time.perf_counter()
+        self.totals[self.stack.pop()] += now - self.last
+        self.last = now
+
+    def wrap(self, function, phase):
+        """Return function wrapped so calls from the worker thread are charged to phase"""
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            if threading.get_ident() != self.thread:  # e.g. probe streaming thread
+                return function(*args, **kwargs)
+            self.enter(phase)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit()
+        return timed
+
+    def wrap_methods(self, instance, phase, names):
+        """Replace bound methods of instance with timed versions, so internal calls are timed too"""
+        for name in names:
+            if hasattr(instance, name):
+                setattr(instance, name, self.wrap(getattr(instance, name), phase))
+
+
+class ModuleProxy:
+    """Stand-in for a module inside a worker, with some attributes replaced"""
+
+    def __init__(self, module, **overrides):
+        self.module = module
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+
+class TimedWriter:
+    """Scan writer which times and counts rows written"""
+
+    def __init__(self, writer, timer):
+        self.writer = writer
+        self.rows = 0  # measurement rows written (notes such as 'Missed Trigger' not counted)
+        self.writerow = timer.wrap(self.count_row, 'data writing')
+        self.close = timer.wrap(writer.close, 'data writing')
+
+    def count_row(self, row, samples=None):
+        if len(row) > 1:
+            self.rows += 1
+        return self.writer.writerow(row, samples)
+
+    def __getattr__(self, name):
+        return getattr(self.writer, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class TimedSignal:
+    def __init__(self, timer, record=None):
+        self.emit = timer.wrap(record if record is not None else lambda *args: None, 'gui signalling')
+
+
+class TimedSignals:
+    """Stand-in for WorkerSignals which times emits and records errors, so no Qt event loop is needed"""
+
+    def __init__(self, timer):
+        self.errors = []
+        self.finished = TimedSignal(timer)
+        self.error = TimedSignal(timer, self.errors.append)
+        self.result = TimedSignal(timer)
+        self.progress = TimedSignal(timer)
+
+
+def open_probe(probe, mc, model):
+    """Return simulated teslameter of given type reading fields from model at the simulated stage position"""
+    position = teslameter_simulator.stage_position(mc)
+    if probe == '3MTS':
+        HP = teslameter_3MTS(teslameter_simulator.MockA3mtslib(model, position))
+        HP.open()
+        return HP
+    HP = teslameter_3MH6('sim://') if probe == '3MH6' else teslameter_3MH3('sim://')
+    HP.ser.model = model
+    HP.ser.position = position
+    HP.open()
+    return HP
+
+
+def run_scan(name, probe='3MH6', averages=10, verbose=False, output='.csv'):
+    """Run one benchmark scan headlessly against simulated hardware and return its timing breakdown"""
+    module, class_name, scan_args, extra_args = scans[name]
+    mc = motor_controller_PM1000.MotorController('sim://')
+    HP = open_probe(probe, mc, teslameter_simulator.QuadrupoleField(gradient=20))
+    timer = PhaseTimer()
+    writers = []
+
+    # Time calls made by the worker to the motor controller and probe
+    timer.wrap_methods(mc, 'motion', ['move_to'])
+    timer.wrap_methods(mc, 'position readback', ['get_positions'])
+    for axis_name in 'xyz':
+        axis = mc.axis[axis_name]
+        timer.wrap_methods(axis, 'motion', ['move', 'send_move', 'stop', 'waitforPulse'])
+        timer.wrap_methods(axis, 'settling', ['is_busy'])
+        timer.wrap_methods(axis, 'position readback', ['get_position'])
+        timer.wrap_methods(axis, 'limits/settings', ['getLimits', 'getSpeed', 'setSpeed', 'initialiseTrigger'])
+    timer.wrap_methods(HP, 'field averaging', ['get_fields'])
+    timer.wrap_methods(HP, 'serial flushing', ['stop_broadcast', 'start_stream', 'stop_stream'])
+
+    def open_scan_writer(*args, **kwargs):
+        timed = TimedWriter(scan_output.open_scan_writer(*args, **kwargs), timer)
+        writers.append(timed)
+        return timed
+
+    saved = getattr(module, 'time', None), module.scan_output
+    if saved[0] is not None:  # time any sleeps made by the worker
+        module.time = ModuleProxy(time, sleep=timer.wrap(time.sleep, 'worker sleeps'))
+    module.scan_output = ModuleProxy(scan_output, open_scan_writer=open_scan_writer)
+    filename = os.path.join(tempfile.mkdtemp(), name + output)
+    try:
+        output = sys.stdout if verbose else io.StringIO()  # workers print a lot
+        with contextlib.redirect_stdout(output):
+            worker = getattr(module, class_name)(HP, mc, *scan_args, filename, averages, *extra_args)
+            worker.signals = TimedSignals(timer)
+            timer.thread = threading.get_ident()
+            start = time.perf_counter()
+            worker.run()
+            wall = time.perf_counter() - start
+    finally:
+        if saved[0] is not None:
+            module.time = saved[0]
+        module.scan_output = saved[1]
+        HP.close()
+        mc.close()
+
+    points = sum(writer.rows for writer in writers)
+    breakdown = {phase: timer.totals[phase] for phase in phases[:-1]}
+    breakdown['other'] = wall - sum(breakdown.values())
+    return {'points': points, 'wall time': wall, 'points per hour': points / wall * 3600 if wall else 0,
+            'phases': breakdown, 'calls': dict(timer.calls),
+            'errors': [str(error[1]) for error in worker.signals.errors]}
+
+
+def report(name, result, baseline=None, tolerance=0.1):
+    """Print result of one scan, compared with baseline if given; return True if it has regressed"""
+    print('{}: {} points in {:.1f} s = {:.0f} points/hour'.format(
+        name, result['points'], result['wall time'], result['points per hour']))
+    for phase in phases:
+        seconds = result['phases'][phase]
+        print('    {:<18} {:8.2f} s {:5.1f} %'.format(phase, seconds, 100 * seconds / result['wall time']))
+    for error in result['errors']:
+        print('    error:', error)
+    if baseline is None:
+        return False
+    ratio = result['points per hour'] / baseline['points per hour']
+    regressed = ratio < 1 - tolerance
+    print('    {:.2f} x baseline{}'.format(ratio, ' - REGRESSION' if regressed else ''))
+    return regressed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time scan workers end to end against simulated hardware')
+    parser.add_argument('scans', nargs='*', default=list(scans), help='scans to run: ' + ', '.join(scans))
+    parser.add_argument('--probe', default='3MH6', choices=['3MH6', '3MH3', '3MTS'])
+    parser.add_argument('--averages', type=int, default=10, help='samples averaged per point')
+    parser.add_argument('--save', metavar='FILE', help='save results as a baseline JSON file')
+    parser.add_argument('--compare', metavar='FILE', help='compare results with a saved baseline')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='fractional slow down counted as regression')
+    parser.add_argument('--output', default='.csv', choices=['.csv', scan_output.columnar_suffix],
+                        help='scan data file type')
+    parser.add_argument('--verbose', action='store_true', help='show worker output')
+    parser.add_argument('--serial-stats', action='store_true', help='show per-command serial statistics of each scan')
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = {}
+    regressions = []
+    for name in args.scans:
+        if args.serial_stats:
+            instrumentation.enable().reset()
+        results[name] = run_scan(name, args.probe, args.averages, args.verbose, args.output)
+        if report(name, results[name], baseline.get(name), args.tolerance):
+            regressions.append(name)
+        if args.serial_stats:
+            print(instrumentation.stats.report())
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'created': str(datetime.datetime.now()), 'probe': args.probe, 'averages': args.averages,
+                       'results': results}, f, indent=2)
+    if regressions:
+        print('Regressions:', ', '.join(regressions))
+        sys.exit(1)
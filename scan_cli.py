@@ -0,0 +1,351 @@
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+
+import instrumentation
+import motor_controller_PM1000
+import scan_plan
+import scan_planner
+from ScanWorker_pointbypoint import ScanWorker_pointbypoint
+from ScanWorker_onthefly import ScanWorker_onthefly
+from ScanWorker_boundary import ScanWorker_boundary
+from ScanWorker_random_sample import ScanWorker_random_sample
+from ScanWorker_adaptive import ScanWorker_adaptive
+from MultipoleScanWorker import MultipoleScanWorker
+
+scan_types = ['grid', 'onthefly', 'boundary', 'random', 'adaptive', 'multipole']
+order_codes = {axes: order for order, axes in scan_plan.scan_axes.items()}  # e.g. 'zxy': 0
+device_options = ['batch', 'probe', 'port', 'motor_port', 'sim', 'serial_stats', 'log']  # command line only
+
+
+class Signal:
+    """Stand-in for a pyqtSignal which calls its slots directly, so workers can run without a Qt event loop"""
+
+    def __init__(self):
+        self.slots = []
+
+    def connect(self, slot):
+        self.slots.append(slot)
+
+    def emit(self, *args):
+        for slot in self.slots:
+            slot(*args)
+
+
+class ConsoleSignals:
+    """Stand-in for WorkerSignals"""
+
+    def __init__(self):
+        self.finished = Signal()
+        self.error = Signal()
+        self.result = Signal()
+        self.progress = Signal()
+
+
+class ProgressReporter:
+    """Print scan progress, the latest point and time remaining to stdout"""
+
+    def __init__(self, name, stream=sys.stdout, interval=1.0):
+        self.name = name
+        self.stream = stream
+        self.interval = interval  # shortest time between progress lines / s
+        self.start = time.time()
+        self.last_print = 0
+        self.percent = 0
+        self.points = 0
+        self.last_result = None
+        self.errors = []
+
+    def progress(self, percent):
+        self.percent = percent + 1  # workers emit one less than the percentage done
+        self.show()
+
+    def result(self, values):
+        self.points += 1
+        self.last_result = values
+        self.show()
+
+    def error(self, error):
+        self.errors.append(error)
+        print('{}: error: {}'.format(self.name, error[1]), file=self.stream, flush=True)
+
+    def show(self, force=False):
+        now = time.time()
+        if not force and now - self.last_print < self.interval:
+            return
+        self.last_print = now
+        elapsed = now - self.start
+        remaining = elapsed * (100 - self.percent) / self.percent if self.percent > 0 else None
+        line = '{}: {:3d}% {} points, {} elapsed, {} remaining'.format(
+            self.name, self.percent, self.points, scan_planner.format_duration(elapsed),
+            '?' if remaining is None else scan_planner.format_duration(remaining))
+        if self.last_result is not None:
+            x, y, z, bx, by, bz = self.last_result[:6]
+            line += ' | x={} y={} z={} mm B=({}, {}, {}) mT'.format(x, y, z, bx, by, bz)
+        print(line, file=self.stream, flush=True)
+
+
+def parse_axis(values, name, fixed_step=1):
+    """Return (start, stop, step) from one value (fixed coordinate) or three"""
+    if len(values) == 1:
+        return values[0], values[0], fixed_step
+    if len(values) == 3:
+        return tuple(values)
+    raise ValueError('--{} takes START STOP STEP or a single fixed value'.format(name))
+
+
+def parse_order(order):
+    """Return scan order code from a number, axis names fastest first (e.g. xyz) or auto"""
+    if order == 'auto':
+        return None
+    if order in order_codes:
+        return order_codes[order]
+    if order.isdigit() and int(order) in scan_plan.scan_axes:
+        return int(order)
+    raise ValueError('Unknown scan order "{}" - use auto, 0-5 or one of {}'.format(order, ', '.join(order_codes)))
+
+
+def make_worker(scan, HP, mc):
+    """Return (worker, description) for a scan description"""
+    averages = scan['averages']
+    filename = scan['output']
+    if scan['type'] == 'multipole':
+        x0, y0 = scan['centre']
+        z0, z1, dz = parse_axis(scan['z'], 'z')
+        worker = MultipoleScanWorker(HP, mc, x0, y0, scan['radius'], scan['steps'], z0, z1, dz, filename, averages)
+        points = int(scan['steps']) * len(scan_plan.axis_values(z0, z1, dz))
+        return worker, '{} points on r = {} mm circles'.format(points, scan['radius'])
+
+    grid = sum((parse_axis(scan[axis], axis) for axis in 'xyz'), ())
+    kinematics = scan_planner.axis_kinematics(mc)
+    order = parse_order(str(scan['order']))
+    patterns = ('serpentine', 'raster') if scan['type'] == 'grid' else ('serpentine',)  # only grid scans raster
+    pattern = scan['pattern'] if scan['pattern'] in patterns else patterns[0]
+    if order is None:  # quickest order of the grid, moving along an axis which isn't fixed
+        order, pattern, estimate = scan_planner.fastest_grid_order(*grid, kinematics, patterns=patterns)
+    else:
+        estimate = scan_planner.path_time(scan_plan.GridPlan(*grid, order, pattern).points, kinematics)
+    points = len(scan_plan.GridPlan(*grid, order))
+    description = '{} grid points, {} {}, estimated {}'.format(points, scan_planner.order_names[order], pattern,
+                                                                scan_planner.format_duration(estimate))
+
+    if scan['type'] == 'grid':
+        worker = ScanWorker_pointbypoint(HP, mc, *grid, order, filename, averages, scan['resume'])
+        worker.pattern = pattern
+    elif scan['type'] == 'onthefly':
+        worker = ScanWorker_onthefly(HP, mc, *grid, order, filename, averages, scan['speed'])
+        description = '{} grid points on the fly at {} mm/s'.format(points, scan['speed'])
+    elif scan['type'] == 'boundary':
+        worker = ScanWorker_boundary(HP, mc, *grid, order, filename, averages)
+        description = 'boundary of {} point grid'.format(points)
+    elif scan['type'] == 'random':
+        volume = sum((parse_axis(scan[axis], axis, 0) for axis in 'xyz'), ())  # points are drawn one step inside
+        worker = ScanWorker_random_sample(HP, mc, *volume, order, filename, averages, scan['points'])
+        description = '{} random points in grid volume'.format(scan['points'])
+    elif scan['type'] == 'adaptive':
+        max_points = scan['max_points'] or 4 * points
+        worker = ScanWorker_adaptive(HP, mc, *grid, order, filename, averages, scan['tolerance'], max_points)
+        description = 'from {} point grid to {} mT, at most {} points'.format(points, scan['tolerance'],
+                                                                                      max_points)
+    else:
+        raise ValueError('Unknown scan type "{}" - use one of {}'.format(scan['type'], ', '.join(scan_types)))
+    return worker, description
+
+
+def run_scan(scan, HP, mc, console=sys.stdout):
+    """Run one scan described by a dict, reporting progress on console; return True if it finished without errors.
+
+    Call with stdout redirected away from console, as workers print a lot."""
+    name = scan['name'] or scan['output']
+    worker, description = make_worker(scan, HP, mc)
+    print('{}: {} scan, {} -> {}'.format(name, scan['type'], description, scan['output']), file=console, flush=True)
+    if scan['estimate_only']:
+        return True
+
+    reporter = ProgressReporter(name, console, scan['progress_interval'])
+    worker.signals = ConsoleSignals()
+    worker.signals.progress.connect(reporter.progress)
+    worker.signals.result.connect(reporter.result)
+    worker.signals.error.connect(reporter.error)
+    if instrumentation.stats is not None:
+        instrumentation.stats.reset()  # statistics of this scan only
+
+    done = threading.Event()  # waited on rather than joining thread, as an interrupted join may not wait again
+
+    def run():
+        try:
+            worker.run()
+        except Exception as error:  # raised before the worker could report it
+            reporter.error((type(error), error, traceback.format_exc()))
+        finally:
+            done.set()
+
+    threading.Thread(target=run).start()  # so Ctrl-C reaches the main thread while the worker runs
+    try:
+        while not done.wait(0.2):
+            pass
+    except KeyboardInterrupt:  # stop the axes and end the scan cleanly, as the GUI STOP button does
+        print('{}: stopping...'.format(name), file=console, flush=True)
+        worker.isRun = False
+        done.wait()
+        reporter.show(force=True)
+        raise
+    reporter.show(force=True)
+    print('{}: finished in {} with {} errors'.format(name, scan_planner.format_duration(time.time() - reporter.start),
+                                                     len(reporter.errors)), file=console, flush=True)
+    return not reporter.errors
+
+
+def configure_probe(HP, scan, applied):
+    """Set the teslameter sample rate and range a scan asks for, unless already set (applied holds settings made).
+    Raises ValueError if the teslameter doesn't have them."""
+    settings = [('rate', 'Sample rate', HP.set_sample_rate), ('range', 'Measurement range', HP.set_range)]
+    for key, name, setter in settings:
+        value = scan[key]
+        if value is None or applied.get(key) == value:
+            continue
+        result = setter(value)
+        if result is None:  # drivers print the choices and return nothing
+            raise ValueError('{} {} not available on {} teslameter'.format(name.lower(), value, HP.type()))
+        applied[key] = value
+        print('{} set to {}'.format(name, result), flush=True)
+
+
+def open_devices(args):
+    """Return (teslameter, motor controller) given on the command line, or simulated ones"""
+    mc = motor_controller_PM1000.MotorController('sim://' if args.sim else args.motor_port)
+    if args.sim:
+        import scan_benchmark
+        import teslameter_simulator
+        return scan_benchmark.open_probe(args.probe, mc, teslameter_simulator.QuadrupoleField(gradient=20)), mc
+    if args.probe == '3MH6':
+        from teslameter_3MH6 import teslameter_3MH6
+        HP = teslameter_3MH6(args.port or 'COM3')
+    elif args.probe == '3MH3':
+        from teslameter_3MH3 import teslameter_3MH3
+        HP = teslameter_3MH3(args.port or 'COM4')
+    else:
+        from teslameter_3MTS import teslameter_3MTS
+        HP = teslameter_3MTS()
+    HP.open()
+    return HP, mc
+
+
+def parser():
+    parser = argparse.ArgumentParser(
+        description='Run Hall probe bench scans without the GUI, reporting progress on stdout',
+        epilog='Scans can also be described in JSON files - a dict or list of dicts with the same keys as the long '
+               'options (e.g. {"type": "grid", "x": [0, 10, 1], "rate": 100, "output": "map.csv"}) - which are run '
+               'in turn with the command line options as defaults. Device options (' +
+               ', '.join('--' + key.replace('_', '-') for key in device_options[1:]) +
+               ') can only be given on the command line.')
+    parser.add_argument('batch', nargs='*', help='JSON files of scan descriptions to run in turn')
+    parser.add_argument('--type', default='grid', choices=scan_types, help='kind of scan')
+    parser.add_argument('--x', type=float, nargs='+', default=[0], metavar='X', help='x START STOP STEP, or fixed x')
+    parser.add_argument('--y', type=float, nargs='+', default=[0], metavar='Y', help='y START STOP STEP, or fixed y')
+    parser.add_argument('--z', type=float, nargs='+', default=[0], metavar='Z', help='z START STOP STEP, or fixed z')
+    parser.add_argument('--order', default='auto',
+                        help='axes fastest first: auto (quickest), ' + ', '.join(order_codes) + ' or 0-5')
+    parser.add_argument('--pattern', default='serpentine', choices=['serpentine', 'raster'],
+                        help='point order within grid (grid scans)')
+    parser.add_argument('--averages', type=int, help='field samples averaged per point (default 1000, 3MH3 100)')
+    parser.add_argument('--rate', type=float, help='teslameter sample rate to set / Hz')
+    parser.add_argument('--range', type=int, help='teslameter measurement range code to set')
+    parser.add_argument('--output', help='scan data file (.csv, or .npycols for binary columns)')
+    parser.add_argument('--resume', action='store_true', help='carry on a grid scan already partly saved in output')
+    parser.add_argument('--speed', type=float, default=1, help='on the fly scan speed / mm/s')
+    parser.add_argument('--points', type=int, default=100, help='number of random points')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='adaptive scan interpolation error / mT')
+    parser.add_argument('--max-points', type=int, help='most points in adaptive scan (default 4 x grid points)')
+    parser.add_argument('--centre', type=float, nargs=2, default=[0, 0], metavar=('X', 'Y'),
+                        help='multipole scan centre / mm')
+    parser.add_argument('--radius', type=float, default=1, help='multipole scan radius / mm')
+    parser.add_argument('--steps', type=int, default=16, help='multipole scan points per circle')
+    parser.add_argument('--name', help='name shown in progress reports (default output file)')
+    parser.add_argument('--probe', default='3MH6', choices=['3MH6', '3MH3', '3MTS'])
+    parser.add_argument('--port', help='teslameter serial port (default COM3 for 3MH6, COM4 for 3MH3)')
+    parser.add_argument('--motor-port', default='COM1', help='PM1000 serial port')
+    parser.add_argument('--sim', action='store_true', help='use simulated stage and probe in a quadrupole field')
+    parser.add_argument('--log', help='file for worker diagnostics (default discarded)')
+    parser.add_argument('--progress-interval', type=float, default=1, help='shortest time between progress lines / s')
+    parser.add_argument('--estimate-only', action='store_true', help='describe scans without running them')
+    parser.add_argument('--serial-stats', action='store_true', help='save serial statistics alongside each scan')
+    return parser
+
+
+def scan_descriptions(args, parser):
+    """Return list of scan dicts from the batch files, or from the command line if none given"""
+    defaults = vars(args)
+    scans = []
+    for filename in args.batch:
+        with open(filename) as f:
+            loaded = json.load(f)
+        for scan in loaded if isinstance(loaded, list) else [loaded]:
+            scan = {key.replace('-', '_'): value for key, value in scan.items()}
+            unknown = set(scan) - set(defaults)
+            if unknown:
+                parser.error('{}: unknown keys {}'.format(filename, ', '.join(sorted(unknown))))
+            devices = set(scan).intersection(device_options)
+            if devices:
+                parser.error('{}: {} can only be given on the command line'.format(filename,
+                                                                                   ', '.join(sorted(devices))))
+            scans.append(dict(defaults, **scan))
+    if not args.batch:
+        scans.append(dict(defaults))
+    for scan in scans:
+        if not scan['output']:
+            parser.error('no output file given for a {} scan'.format(scan['type']))
+        if scan['type'] not in scan_types:
+            parser.error('unknown scan type "{}" - use one of {}'.format(scan['type'], ', '.join(scan_types)))
+        try:
+            parse_order(str(scan['order']))
+            for axis in 'xyz':
+                parse_axis(scan[axis], axis)
+        except ValueError as error:
+            parser.error(str(error))
+    return scans
+
+
+if __name__ == '__main__':
+    parser = parser()
+    args = parser.parse_args()
+    scans = scan_descriptions(args, parser)
+
+    if args.serial_stats:
+        instrumentation.enable()  # before ports are opened, so they are instrumented
+    HP, mc = open_devices(args)
+    console = sys.stdout
+    log = open(args.log, 'a') if args.log else open(os.devnull, 'w')
+    failed = []
+    applied = {}  # teslameter settings made so far
+    try:
+        for number, scan in enumerate(scans, 1):
+            if scan['averages'] is None:
+                scan['averages'] = 100 if HP.type() == '3MH3' else 1000  # as GUI
+            try:
+                configure_probe(HP, scan, applied)  # each scan may ask for its own rate and range
+            except ValueError as error:
+                print('{}: {} - not run'.format(scan['name'] or scan['output'], error), flush=True)
+                failed.append(scan['name'] or scan['output'])
+                continue
+            if not scan['estimate_only']:
+                print('{} starting scan {} of {}'.format(datetime.datetime.now(), number, len(scans)), flush=True)
+            with contextlib.redirect_stdout(log):
+                if not run_scan(scan, HP, mc, console):
+                    failed.append(scan['name'] or scan['output'])
+    except KeyboardInterrupt:
+        print('Scans cancelled')
+        failed.append('cancelled')
+    finally:
+        HP.close()
+        mc.close()
+        log.close()
+    if failed:
+        print('Scans with errors:', ', '.join(failed))
+        sys.exit(1)
@@ -0,0 +1,345 @@
+import csv
+import datetime
+import io
+import json
+import os
+import re
+import struct
+import time
+import numpy as np
+
+columnar_suffix = '.npycols'  # scan output saved as a directory of .npy files, one per column
+coordinate_units = (' / mm', ' / rad', ' / deg')  # columns written to csv with 3 decimal places, like the GUI shows
+needs_quotes = re.compile('["\r\n]')  # characters the csv module quotes a value for, besides its delimiter
+npy_header_length = 128  # bytes of fixed-size .npy header, so the shape can be rewritten in place as rows are added
+
+
+def column_filename(name):
+    """Return .npy filename for a column header, e.g. 'std(bx) / mT' -> 'std_bx_mT.npy'"""
+    return re.sub(r'\W+', '_', name).strip('_') + '.npy'
+
+
+def to_number(value):
+    """Convert a value written by a scan worker to a float - datetimes become POSIX timestamps"""
+    if isinstance(value, datetime.datetime):
+        return value.timestamp()
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value).timestamp()
+        except ValueError:
+            return float(value)
+    return float(value)
+
+
+class GrowingArray:
+    """Float64 .npy file which rows are appended to, readable with np.load at any time (including mmap_mode)"""
+
+    def __init__(self, filename, width=None, append=False):
+        self.filename = filename
+        self.width = width  # number of columns, or None for a 1D array
+        self.rows = 0  # rows written so far
+        if append and os.path.exists(filename):  # carry on from the rows already in the file
+            self.file = open(filename, 'r+b')
+            size = self.file.seek(0, os.SEEK_END)
+            self.truncate(max(0, size - npy_header_length) // (8 * (width or 1)))  # whole rows written so far
+        else:
+            self.file = open(filename, 'wb')
+            self.write_header()
+        self.file.flush()  # empty array readable straight away
+
+    def write_header(self):
+        shape = (self.rows,) if self.width is None else (self.rows, self.width)
+        header = "{{'descr': '<f8', 'fortran_order': False, 'shape': {}, }}".format(shape)
+        header = header.ljust(npy_header_length - 11) + '\n'  # 10 byte preamble + header + newline
+        self.file.seek(0)
+        self.file.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1'))
+
+    def append(self, values):
+        """Append rows of values - data is written before the header, so a partly written file is still valid"""
+        values = np.asarray(values, dtype='<f8')
+        if len(values) == 0:
+            return
+        self.file.seek(0, os.SEEK_END)
+        self.file.write(values.tobytes())
+        self.rows += len(values)
+        self.write_header()
+        self.file.flush()
+
+    def truncate(self, rows):
+        """Discard rows after the first rows, and any partly written row"""
+        self.rows = rows
+        self.file.truncate(npy_header_length + 8 * rows * (self.width or 1))
+        self.write_header()
+        self.file.flush()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.file.close()
+
+
+class ColumnarScanWriter:
+    """Scan writer storing each column of header_list as a memory-mappable .npy file in a directory.
+
+    Rows are buffered and appended in chunks of flush_rows rows, or after flush_interval seconds, so an interrupted
+    scan can still be read back with read_columns. Rows holding a single message (e.g. 'Missed Trigger') are kept in
+    notes.csv with the index of the next data row. If raw_samples is True the samples averaged for each point are
+    also kept in raw_samples.npy, with the point index as the first column."""
+
+    def __init__(self, filename, header_list, raw_samples=False, flush_rows=64, flush_interval=10, append=False):
+        self.filename = filename
+        self.header_list = list(header_list)
+        self.raw_samples = raw_samples
+        self.flush_rows = flush_rows  # rows held in memory before writing
+        self.flush_interval = flush_interval  # longest time rows are held in memory / s
+
+        append = append and os.path.exists(os.path.join(filename, 'columns.json'))
+        os.makedirs(filename, exist_ok=True)
+        files = [column_filename(name) for name in self.header_list]
+        if not append:
+            with open(os.path.join(filename, 'columns.json'), 'w') as f:
+                json.dump({'columns': self.header_list, 'files': files, 'created': str(datetime.datetime.now())}, f,
+                          indent=2)
+        self.columns = [GrowingArray(os.path.join(filename, name), append=append) for name in files]
+        self.rows = min(column.rows for column in self.columns)  # data rows written, including those buffered
+        for column in self.columns:
+            if column.rows > self.rows:  # interrupted part way through writing a chunk
+                column.truncate(self.rows)
+        self.raw = GrowingArray(os.path.join(filename, 'raw_samples.npy'), 7, append) if raw_samples else None
+        if self.raw is not None and self.raw.rows:  # drop samples of points whose data rows were not written
+            points = np.array(load_array(self.raw.filename)[:, 0])  # point index of each sample (copied - not mapped)
+            kept = int(np.searchsorted(points, self.rows))
+            if kept < self.raw.rows:
+                self.raw.truncate(kept)
+        self.notes = open(os.path.join(filename, 'notes.csv'), 'a' if append else 'w', newline='')
+        self.notes_writer = csv.writer(self.notes)
+        if not append:
+            self.notes_writer.writerow(['row', 'note'])
+
+        self.pending = []  # buffered data rows
+        self.pending_samples = []  # buffered raw sample blocks
+        self.last_flush = time.time()
+
+    def writerow(self, row, samples=None):
+        """Add one row in header_list order - a single item row is stored as a note.
+
+        samples is the block of raw samples (FieldBuffer columns) averaged for this row, kept if raw_samples is on."""
+        if len(row) == 1:
+            self.note(row[0])
+            return
+        self.pending.append([to_number(value) for value in row])
+        if self.raw is not None and samples is not None and len(samples):
+            block = np.empty((len(samples), 7))
+            block[:, 0] = self.rows
+            block[:, 1:] = samples
+            self.pending_samples.append(block)
+        self.rows += 1
+        if len(self.pending) >= self.flush_rows or time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def note(self, text):
+        self.notes_writer.writerow([self.rows, text])
+        self.notes.flush()
+
+    def flush(self):
+        """Append buffered rows to the column files"""
+        if self.pending:
+            values = np.array(self.pending)
+            for i, column in enumerate(self.columns):
+                column.append(values[:, i])
+            self.pending = []
+        if self.pending_samples:
+            self.raw.append(np.concatenate(self.pending_samples))
+            self.pending_samples = []
+        for column in self.columns + ([self.raw] if self.raw is not None else []):
+            os.fsync(column.fileno())  # checkpoint - rows written so far survive a crash
+        self.last_flush = time.time()
+
+    def close(self):
+        self.flush()
+        for column in self.columns:
+            column.close()
+        if self.raw is not None:
+            self.raw.close()
+        self.notes.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CSVScanWriter:
+    """Crash-safe scan writer producing the original csv file: header row, then one text row per point.
+
+    Rows are formatted as the csv module would and held in memory, then written and fsynced as a batch
+    every flush_rows rows or, at the next row, once flush_interval seconds have passed. A crash loses at most the rows
+    since the last checkpoint. After each checkpoint a small sidecar index (filename + '.index.json') records how many
+    rows and bytes of the file are safely on disk."""
+
+    def __init__(self, filename, header_list, flush_rows=64, flush_interval=10, append=False):
+        self.filename = filename
+        self.header_list = list(header_list)
+        self.flush_rows = flush_rows  # rows held in memory before writing
+        self.flush_interval = flush_interval  # longest time rows are held in memory, checked when a row is added / s
+        # Coordinates to 3 decimal places and everything else as given, i.e. str() as the csv module writes it
+        self.formats = ['{:.3f}'.format if name.endswith(coordinate_units) else str for name in self.header_list]
+        self.text = io.StringIO()  # csv module used for anything needing quotes, e.g. notes
+        self.text_writer = csv.writer(self.text, delimiter=',')
+        self.pending = []  # formatted lines not yet written
+        self.rows = 0  # data rows on disk
+        self.notes = 0  # note rows on disk
+        self.pending_rows = 0  # data rows waiting in pending
+        self.pending_notes = 0  # note rows waiting in pending
+        if append and os.path.exists(filename):  # carry on after the last complete line
+            rows, notes, length = read_csv(filename)[1:]
+            self.file = open(filename, 'r+', newline='')
+            self.file.truncate(length)
+            self.file.seek(length)
+            self.rows, self.notes = len(rows), len(notes)
+        else:
+            self.file = open(filename, 'w', newline='')
+            self.pending.append(self.quote(self.header_list))
+        self.checkpoint()
+
+    def quote(self, row):
+        """Return row formatted by the csv module, quoting values where needed"""
+        self.text.seek(0)
+        self.text.truncate()
+        self.text_writer.writerow(row)
+        return self.text.getvalue()
+
+    def writerow(self, row, samples=None):
+        """Add one row in header_list order - a single item row is a note. Raw samples are not stored in csv files"""
+        if len(row) == 1:
+            self.note(row[0])
+            return
+        text = [value if isinstance(value, str) else '' if value is None else fmt(value)
+                for fmt, value in zip(self.formats, row)]
+        line = ','.join(text)
+        if needs_quotes.search(line) or len(text) != line.count(',') + 1:  # a value contains , " or a line end
+            line = self.quote(text)
+        else:
+            line += '\r\n'
+        self.pending.append(line)
+        self.pending_rows += 1
+        if len(self.pending) >= self.flush_rows or time.time() - self.last_flush > self.flush_interval:
+            self.checkpoint()
+
+    def note(self, text):
+        """Add a message row, e.g. 'Missed Trigger', and write it to disk straight away"""
+        self.pending.append(self.quote([text]))
+        self.pending_notes += 1
+        self.checkpoint()
+
+    def checkpoint(self):
+        """Write pending rows, force them to disk and update the sidecar index"""
+        if self.pending:
+            self.file.write(''.join(self.pending))
+            self.pending = []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.rows += self.pending_rows
+        self.notes += self.pending_notes
+        self.pending_rows = self.pending_notes = 0
+        self.last_flush = time.time()
+        write_index(self.filename, {'rows': self.rows, 'notes': self.notes, 'bytes': self.file.tell(),
+                                    'updated': str(datetime.datetime.now())})
+
+    def flush(self):
+        self.checkpoint()
+
+    def close(self):
+        if not self.file.closed:
+            self.checkpoint()
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def index_filename(filename):
+    """Return name of sidecar index file of a csv scan file"""
+    return filename + '.index.json'
+
+
+def write_index(filename, index):
+    """Replace sidecar index of a scan file in one step, so a crash never leaves it half written"""
+    temporary = index_filename(filename) + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(index, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, index_filename(filename))
+
+
+def read_index(filename):
+    """Return sidecar index of a csv scan file: rows and notes safely written, and file size in bytes, or None"""
+    try:
+        with open(index_filename(filename)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def open_scan_writer(filename, header_list, raw_samples=False, append=False):
+    """Return writer for scan data - binary columns if filename ends .npycols, otherwise csv.
+
+    With append=True rows are added after those already in the file (if it exists) instead of replacing it."""
+    if filename.endswith(columnar_suffix):
+        return ColumnarScanWriter(filename, header_list, raw_samples, append=append)
+    return CSVScanWriter(filename, header_list, append=append)
+
+
+def read_csv(filename):
+    """Read a csv scan file and return header, data rows, note rows and length in bytes of the complete lines.
+
+    A partly written last line (e.g. after a crash) is left out."""
+    with open(filename, 'rb') as f:
+        data = f.read()
+    length = data.rfind(b'\n') + 1  # end of last complete line
+    lines = list(csv.reader(io.StringIO(data[:length].decode('utf-8'), newline='')))
+    header = lines[0] if lines else []
+    rows = [line for line in lines[1:] if len(line) == len(header)]
+    notes = [line for line in lines[1:] if len(line) == 1]
+    return header, rows, notes, length
+
+
+def read_positions(filename, columns=('x / mm', 'y / mm', 'z / mm')):
+    """Return (n, 3) array of the positions measured so far in a scan file of either type"""
+    if filename.endswith(columnar_suffix):
+        data = read_columns(filename)
+        return np.column_stack([np.asarray(data[name]) for name in columns])
+    header, rows = read_csv(filename)[:2]
+    indices = [header.index(name) for name in columns]
+    return np.array([[float(row[i]) for i in indices] for row in rows]).reshape(-1, len(columns))
+
+
+def load_array(filename, mmap_mode='r'):
+    try:
+        return np.load(filename, mmap_mode=mmap_mode)
+    except ValueError:  # empty arrays can't be memory-mapped
+        return np.load(filename)
+
+
+def read_columns(filename, mmap_mode='r'):
+    """Read a .npycols scan directory and return dict of column header: array, plus 'notes' and 'raw samples'.
+
+    Arrays are memory-mapped by default. Works on scans which are still running or were interrupted."""
+    with open(os.path.join(filename, 'columns.json')) as f:
+        layout = json.load(f)
+    data = {}
+    for name, file in zip(layout['columns'], layout['files']):
+        data[name] = load_array(os.path.join(filename, file), mmap_mode)
+    rows = min(len(values) for values in data.values())  # columns can differ by a row if interrupted mid-write
+    data = {name: values[:rows] for name, values in data.items()}
+    with open(os.path.join(filename, 'notes.csv'), newline='') as f:
+        data['notes'] = [(int(row), note) for row, note in list(csv.reader(f))[1:]]
+    raw = os.path.join(filename, 'raw_samples.npy')
+    data['raw samples'] = load_array(raw, mmap_mode) if os.path.exists(raw) else None
+    return data
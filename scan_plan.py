@@ -0,0 +1,262 @@
+import numpy as np
+
+# Scan order index (scanorder_Combo) : axes from fastest to slowest changing
+scan_axes = {0: 'zxy', 1: 'zyx', 2: 'xyz', 3: 'xzy', 4: 'yzx', 5: 'yxz'}
+
+
+def axis_values(start, stop, step):
+    """Return coordinates along one axis from start to stop, as spaced by the scan workers"""
+    number = int(1 + abs(float(stop) - float(start)) / float(step))  # number of points along axis
+    return np.linspace(float(start), float(stop), number)
+
+
+def grid_indices(fast, middle, slow, pattern='serpentine'):
+    """Return (n, 3) array of (fast, middle, slow) indices of a grid visited in serpentine or raster order.
+
+    In serpentine order the fast axis reverses direction after every line and the middle axis after every plane, as
+    the point by point scan worker does, so consecutive points are always neighbours. In raster order every line
+    and plane starts again from the same end."""
+    n_line = fast * middle  # points per plane
+    slow_index = np.repeat(np.arange(slow), n_line)
+    middle_index = np.tile(np.repeat(np.arange(middle), fast), slow)
+    fast_index = np.tile(np.arange(fast), slow * middle)
+    if pattern == 'serpentine':
+        middle_index = np.where(slow_index % 2 == 1, middle - 1 - middle_index, middle_index)
+        line_number = np.repeat(np.arange(slow * middle), fast)  # lines completed before this point
+        fast_index = np.where(line_number % 2 == 1, fast - 1 - fast_index, fast_index)
+    return np.column_stack([fast_index, middle_index, slow_index])
+
+
+class ScanPlan:
+    """Ordered points of a scan with metadata for each point.
+
+    points is an (n, 3) array of x, y, z / mm in the order to visit them. line numbers the line (a straight run along
+    the fast axis, a ring or a circle) each point belongs to, and direction is +1 or -1 as the fast coordinate
+    increases or decreases along that line, or 0 where a line has no single direction."""
+
+    def __init__(self, points, line=None, direction=None):
+        self.points = np.asarray(points, dtype=float).reshape(-1, 3)
+        self.line = np.arange(len(self.points)) if line is None else np.asarray(line)  # line number of each point
+        self.direction = np.zeros(len(self.points), dtype=int) if direction is None else np.asarray(direction)
+
+    def line_bounds(self):
+        """Return arrays of first index and one past last index of each line"""
+        starts = np.flatnonzero(np.diff(self.line, prepend=np.nan) != 0)
+        return starts, np.append(starts[1:], len(self.points))
+
+    def take(self, indices):
+        """Return plan with the points at indices, in that order"""
+        return ScanPlan(self.points[indices], self.line[indices], self.direction[indices])
+
+    def __len__(self):
+        return len(self.points)
+
+
+class GridPlan(ScanPlan):
+    """Points of a 3D grid scan in the order the point by point worker visits them"""
+
+    def __init__(self, x0, x1, dx, y0, y1, dy, z0, z1, dz, order=0, pattern='serpentine'):
+        self.values = {'x': axis_values(x0, x1, dx), 'y': axis_values(y0, y1, dy), 'z': axis_values(z0, z1, dz)}
+        self.axes = scan_axes[order]  # axes from fastest to slowest
+        self.pattern = pattern  # 'serpentine' or 'raster'
+        fast = self.values[self.axes[0]]
+        indices = grid_indices(*[len(self.values[axis]) for axis in self.axes], pattern)
+        # Grid index of each point along x, y and z, in scan order
+        self.indices = np.column_stack([indices[:, self.axes.index(axis)] for axis in 'xyz'])
+        line = np.arange(len(indices)) // len(fast)
+        reverse = (line % 2 == 1) if pattern == 'serpentine' else np.zeros(len(line), dtype=bool)
+        direction = np.where(reverse, -1, 1) * int(np.sign(fast[-1] - fast[0]))
+        super(GridPlan, self).__init__(
+            np.column_stack([self.values[axis][self.indices[:, i]] for i, axis in enumerate('xyz')]), line, direction)
+
+    def completed(self, measured, tolerance=None):
+        """Return boolean array marking the points of the plan already measured.
+
+        measured is an (n, 3) array of x, y, z positions read back during a previous scan. Each is matched to the
+        nearest grid point, and counts if it is within tolerance on every axis (default a quarter of the grid
+        spacing, or 0.01 mm along an axis with a single point)."""
+        measured = np.asarray(measured, dtype=float).reshape(-1, 3)
+        lookup = np.full([len(self.values[axis]) for axis in 'xyz'], -1)  # grid index -> position in plan
+        lookup[tuple(self.indices.T)] = np.arange(len(self))
+        nearest = []
+        within = np.ones(len(measured), dtype=bool)
+        for i, axis in enumerate('xyz'):
+            values = self.values[axis]
+            step = values[1] - values[0] if len(values) > 1 else 0
+            if step:
+                index = np.clip(np.rint((measured[:, i] - values[0]) / step), 0, len(values) - 1).astype(int)
+            else:
+                index = np.zeros(len(measured), dtype=int)
+            axis_tolerance = tolerance if tolerance is not None else (abs(step) / 4 if step else 0.01)
+            within &= np.abs(measured[:, i] - values[index]) <= axis_tolerance
+            nearest.append(index)
+        done = np.zeros(len(self), dtype=bool)
+        done[lookup[tuple(np.array(nearest)[:, within])]] = True
+        return done
+
+
+def ring(x0, x1, dx, y0, y1, dy):
+    """Return (n, 2) array of x, y around the edge of a rectangle, from (x0, y0) along x first, without repeating
+    the start point - as scanned in the middle planes of a boundary scan"""
+    x_np = int(1 + abs(float(x1) - float(x0)) / float(dx))  # number of points along x
+    y_np = int(1 + abs(float(y1) - float(y0)) / float(dy))  # number of points along y
+    dx = np.copysign(dx, x1 - x0)
+    dy = np.copysign(dy, y1 - y0)
+    sides = [(np.linspace(x0, x1 - dx, x_np - 1), np.full(x_np - 1, y0)),
+             (np.full(y_np - 1, x1), np.linspace(y0, y1 - dy, y_np - 1)),
+             (np.linspace(x1, x0 + dx, x_np - 1), np.full(x_np - 1, y1)),
+             (np.full(y_np - 1, x0), np.linspace(y1, y0 + dy, y_np - 1))]
+    return np.column_stack([np.concatenate([side[0] for side in sides]), np.concatenate([side[1] for side in sides])])
+
+
+class BoundaryPlan(ScanPlan):
+    """Points of a boundary scan - full planes at z0 and z1 and just the edge of the x-y rectangle in between"""
+
+    def __init__(self, x0, x1, dx, y0, y1, dy, z0, z1, dz):
+        x0, x1, dx, y0, y1, dy = (float(value) for value in (x0, x1, dx, y0, y1, dy))
+        z_values = axis_values(z0, z1, dz)
+        y_np = len(axis_values(y0, y1, dy))
+        # Serpentine plane at z0 from (x0, y0), ending on the y1 line at x0 if it has an even number of lines
+        first = GridPlan(x0, x1, dx, y0, y1, dy, z_values[0], z_values[0], 1, 2)
+        xs = (x0, x1) if y_np % 2 == 0 else (x1, x0)  # x at start of the rings and last plane
+        edge = ring(xs[0], xs[1], dx, y1, y0, dy)
+        middle = z_values[1:-1]
+        rings = np.column_stack([np.tile(edge, (len(middle), 1)), np.repeat(middle, len(edge))])
+        last = GridPlan(xs[0], xs[1], dx, y1, y0, dy, z_values[-1], z_values[-1], 1, 2)
+        last_line = first.line[-1] + len(middle) + 1
+        super(BoundaryPlan, self).__init__(
+            np.vstack([first.points, rings, last.points]),
+            np.concatenate([first.line, first.line[-1] + 1 + np.repeat(np.arange(len(middle)), len(edge)),
+                            last_line + last.line]),
+            np.concatenate([first.direction, np.zeros(len(rings), dtype=int), last.direction]))
+
+
+class CylindricalPlan(ScanPlan):
+    """Points on a cylinder of radius r0 about (x0, y0) - steps angles at each z, as for multipole measurements"""
+
+    def __init__(self, x0, y0, r0, steps, z0, z1, dz):
+        self.theta_values = np.linspace(0, 2 * np.pi, int(steps), endpoint=False)  # angles / rad
+        self.z_values = axis_values(z0, z1, dz)
+        self.theta = np.tile(self.theta_values, len(self.z_values))  # angle of each point / rad
+        x = np.round(float(x0) + float(r0) * np.cos(self.theta), 3)  # to 3 d.p.
+        y = np.round(float(y0) + float(r0) * np.sin(self.theta), 3)
+        z = np.repeat(self.z_values, len(self.theta_values))
+        super(CylindricalPlan, self).__init__(np.column_stack([x, y, z]), np.repeat(np.arange(len(self.z_values)),
+                                                                                      len(self.theta_values)),
+                                              np.ones(len(z), dtype=int))
+
+
+class RandomPlan(ScanPlan):
+    """Points drawn uniformly within one step of the edges of a scan volume, to 10 um precision"""
+
+    def __init__(self, x0, x1, dx, y0, y1, dy, z0, z1, dz, number_points, rng=np.random):
+        low = np.array([float(x0) + float(dx), float(y0) + float(dy), float(z0) + float(dz)])
+        high = np.array([float(x1) - float(dx), float(y1) - float(dy), float(z1) - float(dz)])
+        super(RandomPlan, self).__init__(np.around(rng.uniform(low, high, size=(int(number_points), 3)), 2))
+
+
+class AdaptivePlan:
+    """Points of an adaptive scan - a coarse grid refined where linear interpolation between points is poor.
+
+    Points lie on a lattice max_level halvings finer than the coarse grid, and are identified by integer lattice
+    indices (i, j, k). The volume is split into cells, each with measured corners. The error of interpolating
+    linearly along an edge of a cell is estimated as |B(a) - 2 B(b) + B(c)| / 8 from three measured points spaced
+    by the edge length, and a cell is halved along each axis where this exceeds tolerance."""
+
+    def __init__(self, x0, x1, dx, y0, y1, dy, z0, z1, dz, order=0, tolerance=0.01, max_level=4):
+        self.coarse = GridPlan(x0, x1, dx, y0, y1, dy, z0, z1, dz, order)
+        self.tolerance = tolerance  # largest acceptable interpolation error / mT
+        self.scale = 2 ** max_level  # lattice points per coarse grid step
+        values = [self.coarse.values[axis] for axis in 'xyz']
+        self.origin = np.array([v[0] for v in values])  # position of lattice index (0, 0, 0) / mm
+        self.spacing = np.array([(v[1] - v[0]) / self.scale if len(v) > 1 else 0 for v in values])  # / mm
+        self.fields = {}  # lattice index: array of (bx, by, bz) measured there
+        # Cells as (corner, size) in lattice units - size 0 along an axis with a single point
+        size = tuple(self.scale if len(v) > 1 else 0 for v in values)
+        corners = np.stack(np.meshgrid(*[np.arange(max(len(v) - 1, 1)) * self.scale for v in values],
+                                       indexing='ij'), -1).reshape(-1, 3)
+        self.cells = {(tuple(int(i) for i in corner), size): np.full(3, np.inf) for corner in corners}  # cell: errors
+        # inherited from its parent along each axis, used where the cell's own points can't give an estimate
+
+    def first_points(self):
+        """Return lattice indices of the coarse grid, in the coarse grid scan order"""
+        return [tuple(int(i) for i in index) for index in self.coarse.indices * self.scale]
+
+    def positions(self, indices):
+        """Return (n, 3) array of x, y, z / mm of lattice indices"""
+        return np.around(self.origin + np.asarray(indices).reshape(-1, 3) * self.spacing, 6)
+
+    def add(self, index, fields):
+        """Record fields (bx, by, bz, ...) measured at a lattice index"""
+        self.fields[tuple(index)] = np.asarray(fields[:3], dtype=float)
+
+    def second_difference(self, a, b, c):
+        """Return estimated linear interpolation error between three points spaced evenly, or None if not all measured"""
+        if a in self.fields and b in self.fields and c in self.fields:
+            return np.max(np.abs(self.fields[a] - 2 * self.fields[b] + self.fields[c])) / 8
+
+    def errors(self, cell):
+        """Return estimated interpolation error / mT along x, y and z in a cell (0 along an axis it has no extent in)"""
+        corner, size = cell
+        errors = np.zeros(3)
+        for axis in range(3):
+            s = size[axis]
+            if s == 0:
+                continue
+            step = np.zeros(3, dtype=int)
+            step[axis] = s
+            # Start of every edge of the cell along this axis
+            others = [(corner[i],) if i == axis or size[i] == 0 else (corner[i], corner[i] + size[i]) for i in range(3)]
+            estimates = []
+            for p in np.stack(np.meshgrid(*others, indexing='ij'), -1).reshape(-1, 3):
+                for centre in (p, p + step):  # second difference centred on either end of the edge
+                    estimate = self.second_difference(tuple(int(i) for i in centre - step),
+                                                      tuple(int(i) for i in centre),
+                                                      tuple(int(i) for i in centre + step))
+                    if estimate is not None:
+                        estimates.append(estimate)
+            errors[axis] = max(estimates) if estimates else self.cells[cell][axis]
+        return errors
+
+    def max_error(self):
+        """Return largest estimated interpolation error / mT over all cells"""
+        return max((np.max(self.errors(cell)) for cell in self.cells), default=0.0)
+
+    def refine(self, budget):
+        """Split the cells with the worst errors above tolerance and return lattice indices of new points to measure.
+
+        At most budget points are returned. An empty list means the map is within tolerance everywhere or can't be
+        refined further."""
+        candidates = []
+        for cell in self.cells:
+            errors = self.errors(cell)
+            split = (errors > self.tolerance) & (np.array(cell[1]) % 2 == 0) & (np.array(cell[1]) > 0)
+            if split.any():
+                candidates.append((np.max(errors[split]), cell, errors, split))
+        candidates.sort(key=lambda candidate: candidate[0], reverse=True)
+
+        new_points = []
+        queued = set()
+        for _, cell, errors, split in candidates:
+            corner, size = cell
+            halves = np.where(split, np.array(size) // 2, size)  # child cell size
+            offsets = [(0, halves[i]) if split[i] else (0,) for i in range(3)]
+            children = [(tuple(int(corner[i] + offset[i]) for i in range(3)), tuple(int(h) for h in halves))
+                        for offset in np.stack(np.meshgrid(*offsets, indexing='ij'), -1).reshape(-1, 3)]
+            # Corners of children not already measured or queued
+            points = set()
+            for child_corner, child_size in children:
+                ends = [(child_corner[i], child_corner[i] + child_size[i]) if child_size[i] else (child_corner[i],)
+                        for i in range(3)]
+                points.update(tuple(int(i) for i in p)
+                              for p in np.stack(np.meshgrid(*ends, indexing='ij'), -1).reshape(-1, 3))
+            points -= set(self.fields) | queued
+            if len(new_points) + len(points) > budget:
+                continue  # try smaller refinements which still fit
+            inherited = np.where(split, errors / 4, errors)  # error falls as square of spacing
+            del self.cells[cell]
+            for child in children:
+                self.cells[child] = inherited.copy()
+            new_points.extend(sorted(points))
+            queued.update(points)
+        return new_points
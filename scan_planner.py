@@ -0,0 +1,210 @@
+import datetime
+import time
+import numpy as np
+import scan_plan
+
+# Kinematics of the bench axes (max speed / mm/s, acceleration / mm/s/s), as set up by MotorController
+default_kinematics = {'x': (6, 0.5), 'y': (6, 0.75), 'z': (50, 10)}
+point_overhead = 0.5  # typical time per point to read positions, average fields and update the GUI / s
+line_overhead = 1.0  # typical time per on the fly line to change speed, log positions and fit fields / s
+order_names = {order: '-'.join(axes) for order, axes in scan_plan.scan_axes.items()}  # e.g. 0: 'z-x-y'
+
+
+def axis_kinematics(mc=None):
+    """Return dict of axis name: (max speed, acceleration) read from a MotorController, or the defaults"""
+    if mc is None:
+        return dict(default_kinematics)
+    return {name: (mc.axis[name].max_speed, mc.axis[name].acceleration) for name in 'xyz'}
+
+
+def move_time(distance, max_speed, acceleration):
+    """Time / s for moves of the given distances from the trapezoidal speed profile (same as Axis.move_time)"""
+    distance = np.abs(distance)
+    ramp = max_speed ** 2 / acceleration  # distance taken to reach full speed and stop again
+    return np.where(distance < ramp, 2 * np.sqrt(distance / acceleration),
+                    distance / max_speed + max_speed / acceleration)
+
+
+def step_times(start, end, kinematics):
+    """Time / s for each move from start to end points (n, 3), with all axes moving together as move_to does"""
+    delta = np.asarray(end, dtype=float) - np.asarray(start, dtype=float)
+    times = [move_time(delta[..., i], *kinematics[axis]) for i, axis in enumerate('xyz')]
+    return np.max(times, axis=0)
+
+
+def path_time(points, kinematics=None, start=None, overhead=point_overhead):
+    """Estimated time / s to visit points in the given order, starting from start (default the first point)"""
+    kinematics = kinematics or default_kinematics
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    if len(points) == 0:
+        return 0.0
+    if start is not None:
+        points = np.vstack([start, points])
+    return float(np.sum(step_times(points[:-1], points[1:], kinematics)) + overhead * len(points))
+
+
+def line_scan_time(plan, speed, kinematics=None, start=None, overhead=line_overhead):
+    """Estimated time / s for an on the fly scan of a grid plan: a move to the start of each line at full speed, then
+    along the line at the scan speed, as the on the fly worker does"""
+    kinematics = kinematics or default_kinematics
+    fast = 'xyz'.index(plan.axes[0])
+    firsts, lasts = plan.line_bounds()
+    starts = plan.points[firsts]
+    ends = plan.points[lasts - 1]
+    previous = np.vstack([starts[:1] if start is None else start, ends[:-1]])
+    lines = move_time(np.abs(ends[:, fast] - starts[:, fast]) + 0.1, speed, kinematics[plan.axes[0]][1])  # overshoot
+    return float(np.sum(step_times(previous, starts, kinematics)) + np.sum(lines) + overhead * len(starts))
+
+
+def grid_estimates(x0, x1, dx, y0, y1, dy, z0, z1, dz, kinematics=None, start=None, overhead=point_overhead,
+                   patterns=('serpentine', 'raster')):
+    """Return list of (time / s, order, pattern) for every axis order and pattern of a grid scan, fastest first"""
+    estimates = []
+    for order in scan_plan.scan_axes:
+        for pattern in patterns:
+            plan = scan_plan.GridPlan(x0, x1, dx, y0, y1, dy, z0, z1, dz, order, pattern)
+            estimates.append((path_time(plan.points, kinematics, start, overhead), order, pattern))
+    return sorted(estimates)
+
+
+def fastest_grid_order(x0, x1, dx, y0, y1, dy, z0, z1, dz, kinematics=None, start=None, overhead=point_overhead,
+                       patterns=('serpentine', 'raster')):
+    """Return (order, pattern, estimated time / s) of the quickest way to scan a grid, in one of the patterns the
+    scan worker follows.
+
+    Orders whose fastest axis is fixed are skipped (unless every axis is), as line scans move along that axis."""
+    estimates = grid_estimates(x0, x1, dx, y0, y1, dy, z0, z1, dz, kinematics, start, overhead, patterns)
+    values = scan_plan.GridPlan(x0, x1, dx, y0, y1, dy, z0, z1, dz).values
+    moving = [e for e in estimates if len(values[scan_plan.scan_axes[e[1]][0]]) > 1]
+    estimate, order, pattern = (moving or estimates)[0]
+    return order, pattern, estimate
+
+
+def nearest_neighbour_tour(points, kinematics=None, start=None):
+    """Return indices visiting points in nearest neighbour order (by move time), beginning nearest to start"""
+    kinematics = kinematics or default_kinematics
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    remaining = np.ones(len(points), dtype=bool)
+    tour = []
+    current = points[0] if start is None else np.asarray(start, dtype=float)
+    for _ in range(len(points)):
+        candidates = np.flatnonzero(remaining)
+        nearest = candidates[np.argmin(step_times(current, points[candidates], kinematics))]
+        tour.append(nearest)
+        remaining[nearest] = False
+        current = points[nearest]
+    return np.array(tour, dtype=int)
+
+
+def two_opt(points, tour, kinematics=None, start=None, time_limit=2.0):
+    """Improve an open tour by reversing segments while that shortens it (2-opt), for at most time_limit s.
+
+    The tour begins at start if given (which stays fixed) and ends wherever the last point is."""
+    kinematics = kinematics or default_kinematics
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    path = list(tour)
+    fixed_start = start is not None
+    nodes = np.vstack([start, points[path]]) if fixed_start else points[path]  # positions in visiting order
+    order = np.array(([-1] if fixed_start else []) + path, dtype=int)  # point index of each node (-1 for start)
+    n = len(nodes)
+    deadline = time.time() + time_limit
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range(n - 2):  # try reversing nodes i+1 .. j
+            a, b = nodes[i], nodes[i + 1]
+            c = nodes[i + 2:]  # candidate new last node of reversed segment, j = i+2 .. n-1
+            removed = step_times(a, b, kinematics) + np.append(step_times(c[:-1], nodes[i + 3:], kinematics), 0)
+            added = step_times(a, c, kinematics) + np.append(step_times(b, nodes[i + 3:], kinematics), 0)
+            gain = removed - added
+            best = np.argmax(gain)
+            if gain[best] > 1E-9:
+                j = i + 2 + best
+                nodes[i + 1:j + 1] = nodes[i + 1:j + 1][::-1]
+                order[i + 1:j + 1] = order[i + 1:j + 1][::-1]
+                improved = True
+            if time.time() > deadline:
+                break
+    return order[1:] if fixed_start else order
+
+
+def or_opt(points, tour, kinematics=None, start=None, time_limit=2.0, max_segment=3):
+    """Improve an open tour by moving runs of up to max_segment points (either way round) to a cheaper place in it.
+
+    The tour begins at start if given (which stays fixed). Stops when no move helps or after time_limit s."""
+    kinematics = kinematics or default_kinematics
+    points = np.asarray(points, dtype=float).reshape(-1, 3)
+    fixed_start = start is not None
+    nodes = np.vstack([start, points[list(tour)]]) if fixed_start else points[list(tour)]
+    order = np.array(([-1] if fixed_start else []) + list(tour), dtype=int)
+    first = 1 if fixed_start else 0  # first node which may be moved
+    deadline = time.time() + time_limit
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for length in range(1, max_segment + 1):
+            i = first
+            while i + length <= len(nodes) and time.time() < deadline:
+                head, tail = nodes[i], nodes[i + length - 1]
+                before = nodes[i - 1] if i > 0 else None
+                after = nodes[i + length] if i + length < len(nodes) else None
+                gain = 0.0  # time saved by taking segment out
+                if before is not None:
+                    gain += step_times(before, head, kinematics)
+                if after is not None:
+                    gain += step_times(tail, after, kinematics)
+                if before is not None and after is not None:
+                    gain -= step_times(before, after, kinematics)
+
+                rest = np.delete(nodes, np.s_[i:i + length], axis=0)
+                u, v = rest[:-1], rest[1:]
+                joined = step_times(u, v, kinematics)
+                # Cost of putting segment back between rest[k] and rest[k + 1], forwards and reversed, then at the end
+                forward = step_times(u, head, kinematics) + step_times(tail, v, kinematics) - joined
+                backward = step_times(u, tail, kinematics) + step_times(head, v, kinematics) - joined
+                costs = np.concatenate([forward, backward, [step_times(rest[-1], head, kinematics),
+                                                            step_times(rest[-1], tail, kinematics)]])
+                if not fixed_start:  # can also go before the first point
+                    costs = np.append(costs, [step_times(tail, rest[0], kinematics),
+                                              step_times(head, rest[0], kinematics)])
+                best = int(np.argmin(costs))
+                if gain - costs[best] > 1E-9:
+                    m = len(u)
+                    reverse = best in (m + np.arange(m)) or best in (2 * m + 1, 2 * m + 3)
+                    if best < 2 * m:
+                        position = best % m + 1  # insert after rest[k]
+                    elif best < 2 * m + 2:
+                        position = len(rest)
+                    else:
+                        position = 0
+                    segment = slice(i, i + length)
+                    seg_nodes, seg_order = nodes[segment][::-1 if reverse else 1], order[segment][::-1 if reverse else 1]
+                    rest_order = np.delete(order, segment)
+                    nodes = np.concatenate([rest[:position], seg_nodes, rest[position:]])
+                    order = np.concatenate([rest_order[:position], seg_order, rest_order[position:]])
+                    improved = True
+                i += 1
+    return order[1:] if fixed_start else order
+
+
+def tour(points, kinematics=None, start=None, time_limit=2.0):
+    """Return indices of a quick order to visit an irregular set of points.
+
+    Starts from a nearest neighbour tour, then alternates 2-opt and Or-opt until neither helps or time_limit s
+    have passed. Move times are weighted by each axis's kinematics, so slow axes are traversed less."""
+    if len(points) < 3:
+        return np.arange(len(points))
+    deadline = time.time() + time_limit
+    path = nearest_neighbour_tour(points, kinematics, start)
+    while time.time() < deadline:
+        before = path_time(np.asarray(points)[path], kinematics, start, 0)
+        path = two_opt(points, path, kinematics, start, max(0.0, deadline - time.time()))
+        path = or_opt(points, path, kinematics, start, max(0.0, deadline - time.time()))
+        if path_time(np.asarray(points)[path], kinematics, start, 0) > before - 1E-6:
+            break
+    return path
+
+
+def format_duration(seconds):
+    """Return duration as h:mm:ss"""
+    return str(datetime.timedelta(seconds=int(round(seconds))))
@@ -5,7 +5,7 @@ import sys
 import time
 import datetime
 from WorkerSignals import WorkerSignals
-mutex = QMutex()
+import device_broker
 import numpy as np
 import csv
 
@@ -32,6 +32,7 @@ class setMotorSettingsWorker(QRunnable):
 
     def run(self):
         """Task to read motor positions and emit signal"""
+        session = device_broker.broker(self.mc).exclusive('motor settings', ['stage'])
         try:
             self.signals.progress.emit(10)  # send progress signal to GUI
             # Set new speeds
@@ -76,5 +77,6 @@ class setMotorSettingsWorker(QRunnable):
                 [x_speed, y_speed, z_speed, x_lower, x_upper, y_lower, y_upper, z_lower, z_upper])  # emit fields
             print('speeds emitted')
         finally:
+            session.release()  # let monitors and other workers use the devices again
             self.signals.progress.emit(99)
             self.signals.finished.emit()
\ No newline at end of file
@@ -5,7 +5,7 @@ import sys
 import time
 import datetime
 from WorkerSignals import WorkerSignals
-mutex = QMutex()
+import device_broker
 import numpy as np
 import csv
 
@@ -23,6 +23,7 @@ class setProbeSettingsWorker(QRunnable):
     def run(self):
         """Task to read probe settings and emit signal"""
         print('running setProbeSettings')
+        session = device_broker.broker(HP=self.HP).exclusive('probe settings', ['probe'])
         try:
             self.signals.progress.emit(20)  # send progress signal to GUI
             print('New range  = ', self.range)
@@ -59,6 +60,7 @@ class setProbeSettingsWorker(QRunnable):
             self.signals.result.emit([range_string, sample_rate])  # emit fields
             self.signals.progress.emit(80)  # send progress signal to GUI
         finally:
+            session.release()  # let monitors and other workers use the devices again
             self.signals.progress.emit(99)  # send progress signal to GUI
             self.signals.finished.emit()
             print('worker ran ok')
@@ -1,8 +1,15 @@
 import serial
 import numpy as np
 import time
-import struct
-import sys
+from field_buffer import FieldBuffer
+import teslameter_simulator
+import instrumentation
+from packet_decoder import FrameDecoder
+
+# Layout of one 8 byte broadcast data frame: "B", bx, by, bz as little-endian signed 16 bit integers (units of 0.1 mT),
+# then carriage return
+frame_dtype = np.dtype([('start', 'u1'), ('bx', '<i2'), ('by', '<i2'), ('bz', '<i2'), ('end', 'u1')])
+frame_length = frame_dtype.itemsize  # 8 bytes
 
 
 class teslameter_3MH3:
@@ -11,13 +18,17 @@ class teslameter_3MH3:
     def __init__(self, port='COM4'):
         self.port = port  # set serial port name
 
-        self.ser = serial.Serial()
-        self.ser.port = self.port  # set serial port name
+        if self.port.startswith('sim://'):  # simulated probe, e.g. sim://?model=quadrupole&gradient=20
+            self.ser = teslameter_simulator.Simulated3MH3(self.port)
+        else:
+            self.ser = serial.Serial()
+            self.ser.port = self.port  # set serial port name
         self.ser.bytesize = serial.EIGHTBITS
         self.ser.parity = serial.PARITY_NONE
         self.ser.baudrate = 115200
         self.ser.stopbits = serial.STOPBITS_ONE
         self.ser.timeout = 1
+        self.ser = instrumentation.instrument(self.ser, '3MH3')  # record round trips if statistics are on
 
         # Define available sampling rates
         self.available_rates = [90, 150, 300, 500, 800, 1000]  # list of possible sampling rates / samples per second
@@ -28,11 +39,10 @@ class teslameter_3MH3:
         # Define available measurement ranges
         self.available_ranges = [1] # only one range available, +/- 2T
 
-    def unsigned_to_signed(self, value):
-        """Take a signed integer and convert to unsigned integer"""
-        value_bytes = value.to_bytes(1, byteorder=sys.byteorder, signed=False)
-        value_signed = int.from_bytes(value_bytes, byteorder=sys.byteorder, signed=True)
-        return value_signed
+        self.buffer = FieldBuffer()  # ring buffer of timestamped samples shared with consumers
+        self.last_block = None  # raw samples averaged by the last call to get_fields
+        self.decoder = FrameDecoder(frame_dtype, ord('B'), 0x0d)  # decoder for broadcast frames
+        self.rx_buffer = bytearray(frame_length * 1024)  # preallocated receive buffer, grown if needed
 
     def open(self):
         self.ser.open()  # open serial port
@@ -60,62 +70,67 @@ class teslameter_3MH3:
         """Sends help command to teslameter and reads response"""
         pass
 
-    def get_fields(self, samples=100):
-        """Measure B fields averaged over n samples"""
-        message_end = f'{13:02x}'  # end of expected message as hex
+    def start_stream(self, buffer=None):
+        """Continuous streaming not supported - fields are read on demand by get_fields"""
+        pass
 
-        bx_values = []  # empty array to store bx values in
-        by_values = []  # empty array to store by values in
-        bz_values = []  # empty array to store bz values in
-        th_values = []  # empty array to store probe temperature values in
+    def stop_stream(self):
+        """Continuous streaming not supported"""
+        pass
+
+    def read_frames(self, samples):
+        """Broadcast until n valid data frames are received and return them as a structured array"""
+        frames = np.empty(samples, dtype=frame_dtype)  # array to store decoded frames in
+        if len(self.rx_buffer) < samples * frame_length:
+            self.rx_buffer = bytearray(samples * frame_length)  # grow receive buffer to fit whole read
+        rx_view = memoryview(self.rx_buffer)
+        self.decoder.reset()
 
+        count = 0  # number of frames read
         self.ser.write(b'B') # send broadcast command to read fields
+        while count < samples:
+            wanted = (samples - count) * frame_length  # bytes needed to complete remaining frames
+            n = self.ser.readinto(rx_view[:wanted])  # read as much as possible in one go, up to timeout
+            if n == 0:  # nothing received before timeout - re-send broadcast command
+                self.ser.write(b'B')
+                continue
+            decoded = self.decoder.decode(rx_view[:n])  # resynchronise on 'B' ... 0x0d and decode whole frames
+            used = min(len(decoded), samples - count)
+            frames[count:count + used] = decoded[:used]  # copy out before receive buffer is re-used
+            count += used
+
+        return frames
+
+    @property
+    def frames_dropped(self):
+        """Number of frames discarded due to incorrect start or termination character"""
+        return self.decoder.frames_dropped
 
-        for i in range(samples):
-            t0 = time.time()
-            message = []  # list to store bytes of response message in
-
-            self.ser.read_until(b'B')  # read up to first character of message
-
-            for i in range(7):  # read next 7 bytes - full length of expected message
-                byte = self.ser.read(1).hex()  # read 1 hexadecimal character
-                message.append(byte)
-            if message[-1] == message_end:  # if correct last character
-                # Calculate Bx field
-                Bxl = int(message[0], 16)  # 'Bxl' byte as 16 bit integer
-                Bxh = int(message[1], 16)
-                Bxh = self.unsigned_to_signed(Bxh)  # transfer high byte into signed integer
-
-                # print(Bxl, Bxh)
-                Bx = ((Bxh * 256) + Bxl) / 10
-                bx_values.append(Bx)
-
-                # Calculate By field
-                Byl = int(message[2], 16)
-                Byh = int(message[3], 16)
-                Byh = self.unsigned_to_signed(Byh)  # transfer high byte into signed integer
-                By = ((Byh * 256) + Byl) / 10
-                by_values.append(By)
-
-                # Calculate Bz field
-                Bzl = int(message[4], 16)
-                Bzh = int(message[5], 16)
-                Bzh = self.unsigned_to_signed(Bzh)  # transfer high byte into signed integer
-                Bz = ((Bzh * 256) + Bzl) / 10
-                bz_values.append(Bz)
-
-                dt = time.time() - t0
+    def get_fields(self, samples=100):
+        """Measure B fields averaged over n samples"""
+        t_start = time.time()
+        frames = self.read_frames(samples)
 
         self.ser.write(b'S')  # stop broadcasting data
         time.sleep(0.1)
         self.ser.flushInput()  # Clear input buffer
 
-        bx_ave = np.mean(bx_values)  # bx average
-        bx_sd = np.std(bx_values)  # bx standard deviation
-        by_ave = np.mean(by_values)  # by average
-        by_sd = np.std(by_values)  # by standard deviation
-        bz_ave = np.mean(bz_values)  # bz average
-        bz_sd = np.std(bz_values)  # bz standard deviation
+        # Store samples in ring buffer, spreading timestamps evenly over the time taken to receive them
+        block = FieldBuffer.new_block(samples)
+        block[:, 0] = frames['bx'] / 10  # field / mT
+        block[:, 1] = frames['by'] / 10
+        block[:, 2] = frames['bz'] / 10
+        block[:, 3] = 0  # Hall probe temperature not measured by 3MH3
+        block[:, 4] = np.linspace(t_start, time.time(), samples)
+        self.buffer.append(block)
+        self.last_block = block  # raw samples averaged below
+
+        bx_ave = np.mean(block[:, 0])  # bx average
+        bx_sd = np.std(block[:, 0])  # bx standard deviation
+        by_ave = np.mean(block[:, 1])  # by average
+        by_sd = np.std(block[:, 1])  # by standard deviation
+        bz_ave = np.mean(block[:, 2])  # bz average
+        bz_sd = np.std(block[:, 2])  # bz standard deviation
         th_ave = 0  # Hall probe temperature average not measured by 3MH3
         th_sd = 0  # Hall probe temperature standard deviation not measured by 3MH3
         return [bx_ave, by_ave, bz_ave, bx_sd, by_sd, bz_sd, th_ave, th_sd]
@@ -1,7 +1,18 @@
 import serial
 import numpy as np
 import time
-import struct
+import threading
+from packet_decoder import FrameDecoder
+from field_buffer import FieldBuffer
+import teslameter_simulator
+import instrumentation
+import time_calibration
+
+# Layout of one 25 byte broadcast data packet: "B", bx, probe temperature, by, bz as big-endian floats, then status
+# bytes and carriage return
+packet_dtype = np.dtype([('start', 'u1'), ('bx', '>f4'), ('th', '>f4'), ('by', '>f4'), ('bz', '>f4'),
+                         ('status', 'V7'), ('end', 'u1')])
+packet_length = packet_dtype.itemsize  # 25 bytes
 
 
 class teslameter_3MH6:
@@ -10,10 +21,14 @@ class teslameter_3MH6:
     def __init__(self, port):
         self.port = port  # set serial port name
 
-        self.ser = serial.Serial()
-        self.ser.port = self.port  # set serial port name
+        if self.port.startswith('sim://'):  # simulated probe, e.g. sim://?model=quadrupole&gradient=20
+            self.ser = teslameter_simulator.Simulated3MH6(self.port)
+        else:
+            self.ser = serial.Serial()
+            self.ser.port = self.port  # set serial port name
         self.ser.baudrate = 3E6  # set baud rate
         self.ser.timeout = 1  # set timeout
+        self.ser = instrumentation.instrument(self.ser, '3MH6')  # record round trips if statistics are on
 
         # Define available sampling rates and corresponding hex codes
         self.available_rates = [10, 30, 50, 60, 100, 500, 1E3, 2E3, 3.75E3, 7.5E3,
@@ -25,6 +40,16 @@ class teslameter_3MH6:
         # Define available measurement ranges:
         self.available_ranges = [1, 2, 3, 4]  # list of available measurement ranges
 
+        self.decoder = FrameDecoder(packet_dtype, 0x42, 0x0d)  # decoder for broadcast packets
+        self.rx_buffer = bytearray(packet_length * 1024)  # preallocated receive buffer, grown if needed
+
+        # Continuous streaming acquisition
+        self.buffer = FieldBuffer()  # ring buffer of timestamped samples shared with consumers
+        self.stream_thread = None  # background reader thread, None when not streaming
+        self.stream_stop = None  # event used to stop background reader thread
+        self.stream_rate = None  # sample rate when stream was started / Hz
+        self.range_response = None  # last measurement range response, returned whilst streaming
+        self.last_block = None  # raw samples averaged by the last call to get_fields
 
     def open(self):
         self.ser.open()  # open serial port
@@ -53,8 +78,43 @@ class teslameter_3MH6:
         response = self.ser.readall().decode('ascii')  # read response from Tesla-meter and decode to ascii
         print(response)  # print response to console
 
-    def get_fields(self, samples):
-        """Measure B fields averaged over n samples"""
+    def read_packets(self, samples):
+        """Broadcast until n valid data packets are received and return them as a structured array"""
+        packets = np.empty(samples, dtype=packet_dtype)  # array to store decoded packets in
+        if len(self.rx_buffer) < samples * packet_length:
+            self.rx_buffer = bytearray(samples * packet_length)  # grow receive buffer to fit whole read
+        rx_view = memoryview(self.rx_buffer)
+        self.decoder.reset()
+
+        count = 0  # number of packets read
+        t_start = time.time()
+        self.ser.write(b'B')  # send broadcast command to tesla-meter
+        while count < samples:
+            wanted = (samples - count) * packet_length  # bytes needed to complete remaining packets
+            n = self.ser.readinto(rx_view[:wanted])  # read as much as possible in one go, up to timeout
+            if n == 0:  # nothing received before timeout - re-send broadcast command
+                self.ser.write(b'B')
+                continue
+            frames = self.decoder.decode(rx_view[:n])  # locate and decode all whole packets
+            used = min(len(frames), samples - count)
+            packets[count:count + used] = frames[:used]  # copy out before receive buffer is re-used
+            count += used
+        self.ser.write(b'S')  # stop broadcast
+
+        # Store packets in ring buffer, spreading timestamps evenly over the time taken to receive them
+        block = FieldBuffer.new_block(samples)
+        block[:, 0] = packets['bx']
+        block[:, 1] = packets['by']
+        block[:, 2] = packets['bz']
+        block[:, 3] = packets['th']
+        block[:, 4] = np.linspace(t_start, time.time(), samples)
+        self.buffer.append(block)
+        self.last_block = block
+
+        return packets
+
+    def stop_broadcast(self):
+        """Stop any broadcast and wait until the input buffer stays empty"""
         self.ser.write(b'S')  # stop any broadcasting before sending broadcast signal
         # print('Getting fields')
         time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
@@ -62,8 +122,6 @@ class teslameter_3MH6:
         time.sleep(0.2)
         # print('Check if buffer clear')
 
-        # sample_rate = self.get_sample_rate()
-
         # print('waiting = ', self.ser.in_waiting)
         while self.ser.in_waiting != 0:  # while waiting bytes not equal to zero, flush input buffer
             #print('waiting to clear HP buffer')
@@ -73,65 +131,89 @@ class teslameter_3MH6:
             time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
             # print(self.ser.in_waiting)
 
-        # print('sample rate =', sample_rate)
+    def start_stream(self, buffer=None):
+        """Start broadcasting and continuously decode packets into a ring buffer from a background thread"""
+        if self.streaming:
+            return
+        self.stream_rate = self.get_sample_rate()  # used to timestamp samples within each read
+        self.get_range()  # remember range so it can be reported without interrupting stream
+        self.stop_broadcast()
+        if buffer is not None:
+            self.buffer = buffer  # write into ring buffer supplied by caller
+        self.decoder.reset()
+        self.stream_stop = threading.Event()
+        self.stream_thread = threading.Thread(target=self.stream_loop, daemon=True)
+        self.ser.write(b'B')  # send broadcast command to tesla-meter
+        self.stream_thread.start()
+
+    def stream_loop(self):
+        """Read and decode broadcast packets until stream is stopped - run in background thread"""
+        rx_view = memoryview(self.rx_buffer)
+        period = 1 / self.stream_rate  # time between samples / s
+        last = -np.inf  # arrival time given to the previous sample
+        while not self.stream_stop.is_set():
+            wanted = min(len(self.rx_buffer), max(self.ser.in_waiting, packet_length))
+            n = self.ser.readinto(rx_view[:wanted])  # block until at least one packet or timeout
+            t_read = time.time()
+            if n == 0:  # nothing received before timeout - re-send broadcast command
+                self.ser.write(b'B')
+                continue
+            frames = self.decoder.decode(rx_view[:n])
+            k = len(frames)
+            if k == 0:
+                continue
+            block = FieldBuffer.new_block(k)
+            block[:, 0] = frames['bx']
+            block[:, 1] = frames['by']
+            block[:, 2] = frames['bz']
+            block[:, 3] = frames['th']
+            arrivals = t_read - period * np.arange(k - 1, -1, -1)  # last packet in read arrived at t_read
+            # A backlog, or a device clock running a little fast, would date samples before the previous block's -
+            # keep times increasing, as the buffer's searches by time need
+            arrivals = np.maximum(arrivals, last + period * np.arange(1, k + 1))
+            last = arrivals[-1]
+            block[:, 4] = time_calibration.profile.probe_times('3MH6', arrivals, period=period)  # when measured
+            self.buffer.append(block)
+
+    def stop_stream(self):
+        """Stop background reader thread and broadcast"""
+        if not self.streaming:
+            return
+        self.stream_stop.set()
+        self.stream_thread.join()
+        self.stream_thread = None
+        self.stop_broadcast()
 
+    @property
+    def streaming(self):
+        """True if broadcast is being read continuously by background thread"""
+        return self.stream_thread is not None
+
+    def get_fields(self, samples, since=None):
+        """Measure B fields averaged over n samples.
+
+        When streaming, the first n samples taken at or after host time since (default now) are used."""
         if type(samples) == int and samples > 0:  # if samples given is integer > 0
-            bx_values = []  # empty array to store bx values in
-            by_values = []  # empty array to store by values in
-            bz_values = []  # empty array to store bz values in
-            th_values = []  # empty array to store probe temperature values in
-            # print('writing to tesla-meter')
-            self.ser.write(b'B')  # send broadcast command to tesla-meter
-            # print('wrote to tesla-meter')
-            #for i in range(samples):  # read n data packets
-            while len(bx_values) < samples: # read n samples
-                # print('i = ', i)
-                if self.ser.in_waiting == 0:  # if whole number of signals read, wait
-                    time.sleep(0.1)  # wait long enough for more data to be sent
-                    #print('wait')
-                else:
-                    pass
-                    #print('do not wait')
-                packet = self.ser.read(25).hex()  # read 25 bytes as hex value (one data package)
-                # print('read packet', packet)
-                start_character_hex = packet[0:2] # expect data packet to start with "42"
-                end_character_hex = packet[-2:]  # expect data packet to end with "0d"
-                if start_character_hex == '42' and end_character_hex == '0d': #if correct starting and end character
-                    # Separate bx data and calculate float value
-                    bx_hex = packet[2:10]  # separate bx byte values from string
-                    bx = struct.unpack('>f', bytes.fromhex(bx_hex))[0]  # convert Hex value to float
-                    bx_values.append(bx)  # store value in array
-                    # Separate Hall probe temperature data
-                    th_hex = packet[10:18]  # separate th byte values from string
-                    th = struct.unpack('>f', bytes.fromhex(th_hex))[0]  # convert Hex value to float
-                    th_values.append(th)  # store value in array
-                    # Separate by data and calculate float value
-                    by_hex = packet[18:26]  # separate by byte values from string
-                    by = struct.unpack('>f', bytes.fromhex(by_hex))[0]  # convert Hex value to float
-                    by_values.append(by)  # store value in array
-                    # Separate bz data and calculate float value
-                    bz_hex = packet[26:34]  # Separate bz byte values from string
-                    bz = struct.unpack('>f', bytes.fromhex(bz_hex))[0]  # convert Hex value to float
-                    bz_values.append(bz)
-                else: # if not correct starting byte - clear buffer
-                    while self.ser.in_waiting != 0:  # while waiting bytes not equal to zero, flush input buffer
-                        self.ser.write(b'S') # stop broadcast so can clear input buffer
-                        time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
-                        self.ser.flushInput()  # clear input buffer
-                        time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
-                    self.ser.write(b'B')  # re-send broadcast command to tesla-meter
-
-            self.ser.write(b'S')  # stop broadcast
-            # print('Stopped broadcast')
+            if self.streaming:  # slice samples out of the stream instead of starting a new broadcast
+                block = self.buffer.wait_for(samples, since, timeout=samples / self.stream_rate + 5)
+                self.last_block = block
+                bx_values = block[:, 0]
+                by_values = block[:, 1]
+                bz_values = block[:, 2]
+                th_values = block[:, 3]
+            else:
+                self.stop_broadcast()
+                packets = self.read_packets(samples)  # read and decode n data packets
+
+                bx_values = packets['bx'].astype(float)  # convert big-endian floats to native array
+                by_values = packets['by'].astype(float)
+                bz_values = packets['bz'].astype(float)
+                th_values = packets['th'].astype(float)
 
             # reject outliers from arrays
-            bx_values = np.asarray(bx_values) # turn list to array
             bx_values = self.reject_outliers(bx_values) # reject obvious outliers
-            by_values = np.asarray(by_values) # turn list to array
             by_values = self.reject_outliers(by_values) # reject outliers
-            bz_values = np.asarray(bz_values) # list to array
             bz_values = self.reject_outliers(bz_values) # reject outliers
-            th_values = np.asarray(th_values) # list to array
             th_values = self.reject_outliers(th_values) # reject outliers
 
             bx_ave = np.mean(bx_values)  # bx average
@@ -148,6 +230,12 @@ class teslameter_3MH6:
 
     def set_sample_rate(self, rate):
         """Set Teslameter samples rate (samples per second)"""
+        if self.streaming:  # restart stream so new rate is used to timestamp samples
+            self.stop_stream()
+            set_rate = self.set_sample_rate(rate)
+            self.start_stream()
+            return set_rate
+
         time.sleep(0.1)
         while self.ser.in_waiting != 0:  # while waiting bytes not equal to zero, flush input buffer
             time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
@@ -170,6 +258,9 @@ class teslameter_3MH6:
 
     def get_sample_rate(self):
         """Get current Teslameter samples rate (samples per second)"""
+        if self.streaming:  # cannot query device during broadcast
+            return self.stream_rate
+
         time.sleep(0.1)
         while self.ser.in_waiting != 0:  # while waiting bytes not equal to zero, flush input buffer
             time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
@@ -186,6 +277,12 @@ class teslameter_3MH6:
 
     def set_range(self, set_range):
         """Set Teslameter measurement range"""
+        if self.streaming:  # pause stream whilst range is changed
+            self.stop_stream()
+            response = self.set_range(set_range)
+            self.start_stream()
+            return response
+
         time.sleep(0.1)
         while self.ser.in_waiting != 0:  # while waiting bytes not equal to zero, flush input buffer
             time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
@@ -204,6 +301,9 @@ class teslameter_3MH6:
 
     def get_range(self):
         """Get current measurement range from Teslameter"""
+        if self.streaming:  # cannot query device during broadcast
+            return self.range_response
+
         time.sleep(0.1)
         while self.ser.in_waiting != 0:  # while waiting bytes not equal to zero, flush input buffer
             time.sleep(0.2)  # Sleep long enough to add waiting commands to input buffer
@@ -214,6 +314,7 @@ class teslameter_3MH6:
         time.sleep(0.1)
         response = self.ser.read_all().decode('ascii')  # read response as ascii value
         # print('Current measurement range = ', response)
+        self.range_response = response  # remembered for use whilst streaming
         return response
 
     def port_open(self):
@@ -221,4 +322,5 @@ class teslameter_3MH6:
 
 
     def close(self):
+        self.stop_stream()  # stop background reader before closing port
         self.ser.close()  # closes serial port
@@ -4,6 +4,9 @@ import struct
 import ctypes as C
 import os
 import sys
+from field_buffer import FieldBuffer
+import instrumentation
+import time_calibration
 
 
 # Is this code needed for saving DLL in a .exe file?
@@ -19,27 +22,46 @@ elif __file__:
 
 #C.windll.kernel32.SetDllDirectoryW(os.getcwd().replace('\\', '/'))
 
-C.windll.kernel32.SetDllDirectoryW(application_path.replace('\\', '/'))
+A3mtslib = None  # software library, loaded when first teslameter is created
+
+
+def load_library():
+    """Load 3MTS software library from application directory and declare argument types of time-critical functions"""
+    global A3mtslib
+    if A3mtslib is None:
+        C.windll.kernel32.SetDllDirectoryW(application_path.replace('\\', '/'))
+
+        #A3mtslib = C.CDLL(os.path.join(path, "A3mtslib64"))  # find software library
+        A3mtslib = C.CDLL("A3mtslib64")  # find software library
+
+        # Declaring argument types once saves ctypes working them out on every call
+        A3mtslib.get_sensor_values_fl.argtypes = [C.POINTER(C.c_int), C.POINTER(C.c_ulong), C.POINTER(C.c_float),
+                                                  C.POINTER(C.c_float), C.POINTER(C.c_float)]
+        A3mtslib.get_sensor_values_fl.restype = C.c_int
+        A3mtslib.clear_buffer.argtypes = [C.POINTER(C.c_int)]
+        A3mtslib.clear_buffer.restype = C.c_int
+    return A3mtslib
 
-#A3mtslib = C.CDLL(os.path.join(path, "A3mtslib64"))  # find software library
-A3mtslib = C.CDLL("A3mtslib64")  # find software library
 
 class teslameter_3MTS:
     """Class to establish communication with Senis 3MTS Teslameter"""
 
-    def __init__(self):
+    def __init__(self, lib=None):
+        # Software library - can be replaced with a mock library exporting the same functions
+        self.lib = load_library() if lib is None else lib
+        self.lib = instrumentation.instrument(self.lib, '3MTS')  # record call times if statistics are on
 
         # Count number of connected devices
         # EXPORT  int count_devices(unsigned short* number_of_devices);
         i = C.c_ushort()  # create unsigned short variable
-        result = A3mtslib.count_devices(C.byref(i))  # call function to count connected devices
+        result = self.lib.count_devices(C.byref(i))  # call function to count connected devices
         print('Number connected devices = ', i.value)
 
         # Get device name
         p = C.create_string_buffer(40)  # empty string buffer to store device name in
         # EXPORT  int get_device_name_ch(int *device_number, char *name );
         self.device_number = C.c_int()  # C type integer
-        result = A3mtslib.get_device_name_ch(C.byref(self.device_number), C.byref(p))  # get name of device
+        result = self.lib.get_device_name_ch(C.byref(self.device_number), C.byref(p))  # get name of device
         print('Device name = ', p.value)
 
         self.device_number.value = 0
@@ -50,9 +72,23 @@ class teslameter_3MTS:
         self.available_ranges = [0, 1, 2, 3]  # list of available measurement ranges
         # Measurement ranges correspond to 0.1, 0.5, 3, 20 T
 
+        self.buffer = FieldBuffer()  # ring buffer of timestamped samples shared with consumers
+        self.last_block = None  # raw samples read by the last call to read_block
+        self.clock_anchor = None  # offset of host time from device clock this session, None until found (or restarted)
+        self.last_device_time = None  # device timestamp of newest sample read / ms
+
+        # Preallocated ctypes values and references re-used for every sample read
+        self.timestamp = C.c_ulong()  # device timestamp
+        self.sensorx = C.c_float()  # Bx sensor value / uT
+        self.sensory = C.c_float()  # By sensor value / uT
+        self.sensorz = C.c_float()  # Bz sensor value / uT
+        self.sensor_args = (C.byref(self.device_number), C.byref(self.timestamp), C.byref(self.sensorx),
+                            C.byref(self.sensory), C.byref(self.sensorz))
+
     def open(self):
         """Open device"""
-        A3mtslib.open_device(C.byref(self.device_number))
+        self.lib.open_device(C.byref(self.device_number))
+        self.clock_anchor = None  # device clock restarts
 
     def type(self):
         """Return string describing Hall probe type"""
@@ -70,39 +106,84 @@ class teslameter_3MTS:
         """Sends help command to teslameter and reads response"""
         pass
 
+    def start_stream(self, buffer=None):
+        """Continuous streaming not supported - fields are read on demand by get_fields"""
+        pass
+
+    def stop_stream(self):
+        """Continuous streaming not supported"""
+        pass
+
+    def read_block(self, samples, clear=False):
+        """Read n samples into a block of the field buffer and return it.
+
+        Samples the device buffered before the call are read first, as get_fields always has. With clear the device
+        buffer is emptied first, so only samples taken after the call (e.g. once the probe has stopped moving) are
+        included.
+
+        A3mtslib has no bulk read: get_sensor_values_fl returns one sample per call, and get_sensor_values only
+        returns the sensor values of one sample as an array. So there is still one ctypes call per sample - the loop
+        only avoids re-creating its arguments and looking up attributes on every call.
+
+        With a calibrated device clock, sample times are the clock anchor (found this session from samples that
+        arrived while reading) plus the device timestamps. A block read wholly from the device buffer before any
+        sample has arrived live can only be timed to within the age of its newest sample."""
+        if clear:
+            self.lib.clear_buffer(C.byref(self.device_number))  # drain stale samples held by device
+            self.clock_anchor = None
+
+        # Local names avoid repeated attribute lookups inside the loop
+        read = self.lib.get_sensor_values_fl
+        args = self.sensor_args
+        timestamp = self.timestamp
+        sensorx = self.sensorx
+        sensory = self.sensory
+        sensorz = self.sensorz
+        clock = time.time
+
+        values = np.empty((samples, 5))  # bx, by, bz / uT, host time, device timestamp
+        started = clock()
+        for i in range(samples):  # read n samples
+            read(*args)
+            values[i] = (sensorx.value, sensory.value, sensorz.value, clock(), timestamp.value)
+
+        block = FieldBuffer.new_block(samples)
+        block[:, 0:3] = values[:, 0:3] / 1000  # fields / mT
+        block[:, 3] = 0  # Hall probe temperature not measured by 3MTS
+        block[:, 4:6] = values[:, 3:5]
+        if self.last_device_time is not None and values[0, 4] < self.last_device_time:
+            self.clock_anchor = None  # device clock restarted
+        self.last_device_time = values[-1, 4]
+        profile = time_calibration.profile
+        if '3MTS' in profile.device_clock:  # host time of each sample from device clock
+            host = values[:, 3]
+            device = values[:, 4] / 1000  # device timestamps / s
+            # Only samples the library had to wait for were stamped as they were measured - samples already buffered
+            # are all stamped together as they are read, so say nothing about the clock offset
+            period = np.median(np.diff(device)) if samples > 1 else 0.001
+            live = np.diff(host, prepend=started) > period / 2
+            if live.any():
+                self.clock_anchor = profile.clock_anchor('3MTS', host[live], device[live], self.clock_anchor)
+            anchor = self.clock_anchor
+            if anchor is None:  # all buffered - best guess for this block only, late by the age of its newest sample
+                anchor = profile.clock_anchor('3MTS', host, device)
+            block[:, 4] = profile.probe_times('3MTS', host, device, anchor=anchor)
+        self.buffer.append(block)
+        self.last_block = block
+        return block
+
     def get_fields(self, samples=1000):
         """Measure B fields averaged over n samples"""
 
         if type(samples) == int and samples > 0:  # if samples given is integer > 0
-            bx_values = [0]  # empty array to store bx values in
-            by_values = [0]  # empty array to store by values in
-            bz_values = [0]  # empty array to store bz values in
-            th_values = [0]  # empty array to store probe temperature values in
-
-            while len(bx_values) < samples:  # read n samples
-                # Read fields
-                timestamp = C.c_ulong()
-                sensorx = C.c_float()
-                sensory = C.c_float()
-                sensorz = C.c_float()
-
-                # read values
-                A3mtslib.get_sensor_values_fl(C.byref(self.device_number), C.byref(timestamp), C.byref(sensorx),
-                                              C.byref(sensory), C.byref(sensorz))
-                bx = sensorx.value  # Bx sensor value / uT
-                by = sensory.value  # By sensor value / uT
-                bz = sensorz.value  # Bz sensor value / uT
-
-                bx_values.append(bx / 1000)  # append Bx field / mT
-                by_values.append(by / 1000)  # append By field / mT
-                bz_values.append(bz / 1000)  # append Bz field / mT
-
-            bx_ave = np.mean(bx_values)  # bx average
-            bx_sd = np.std(bx_values)  # bx standard deviation
-            by_ave = np.mean(by_values)  # by average
-            by_sd = np.std(by_values)  # by standard deviation
-            bz_ave = np.mean(bz_values)  # bz average
-            bz_sd = np.std(bz_values)  # bz standard deviation
+            block = self.read_block(samples)
+
+            bx_ave = np.mean(block[:, 0])  # bx average
+            bx_sd = np.std(block[:, 0])  # bx standard deviation
+            by_ave = np.mean(block[:, 1])  # by average
+            by_sd = np.std(block[:, 1])  # by standard deviation
+            bz_ave = np.mean(block[:, 2])  # bz average
+            bz_sd = np.std(block[:, 2])  # bz standard deviation
             th_ave = 0  # Hall probe temperature average not measured by 3MTS
             th_sd = 0  # Hall probe temperature standard deviation not measured by 3MTS
             return [bx_ave, by_ave, bz_ave, bx_sd, by_sd, bz_sd, th_ave, th_sd]
@@ -114,8 +195,9 @@ class teslameter_3MTS:
 
         time_period = int(1000 / rate)  # time period per sample / ms
 
-        result = A3mtslib.set_speed(C.byref(self.device_number), time_period)
+        result = self.lib.set_speed(C.byref(self.device_number), time_period)
         print('Set sample result = ', result)
+        self.clock_anchor = None  # device clock restarts at new rate
 
         return self.get_sample_rate()
 
@@ -123,7 +205,7 @@ class teslameter_3MTS:
         """Get current Teslameter samples rate (samples per second)"""
 
         period = C.c_ushort()
-        A3mtslib.get_speed(C.byref(self.device_number), C.byref(period))  # get time per sample / ms
+        self.lib.get_speed(C.byref(self.device_number), C.byref(period))  # get time per sample / ms
 
         time_period = period.value / 1000  # time per sample / seconds
 
@@ -135,7 +217,7 @@ class teslameter_3MTS:
         """Set Teslameter measurement range"""
         if set_range in self.available_ranges:  # if selected range is available to be set
 
-            result = A3mtslib.set_range(C.byref(self.device_number), set_range)
+            result = self.lib.set_range(C.byref(self.device_number), set_range)
             print(result)
 
             return self.get_range()
@@ -144,10 +226,10 @@ class teslameter_3MTS:
         """Get current measurement range from Teslameter"""
         # get range
         range = C.c_ushort()
-        A3mtslib.get_range(C.byref(self.device_number), C.byref(range))
+        self.lib.get_range(C.byref(self.device_number), C.byref(range))
 
         return range.value
 
     def close(self):
         """Close connection to Teslameter"""
-        A3mtslib.close_device(C.byref(self.device_number))
+        self.lib.close_device(C.byref(self.device_number))
@@ -2,13 +2,15 @@ import serial
 import numpy as np
 import time
 import struct
+from field_buffer import FieldBuffer
 
 
 class teslameter_blank:
     """Blank teslameter class"""
 
     def __init__(self):
-        pass
+        self.buffer = FieldBuffer()  # ring buffer of samples, always empty for blank teslameter
+        self.last_block = None  # no raw samples
 
         # Define available sampling rates 
 
@@ -30,6 +32,14 @@ class teslameter_blank:
         """Sends help command to teslameter and reads response"""
         pass
 
+    def start_stream(self, buffer=None):
+        """Continuous streaming not supported - fields are read on demand by get_fields"""
+        pass
+
+    def stop_stream(self):
+        """Continuous streaming not supported"""
+        pass
+
     def get_fields(self, samples=0):
         """Measure B fields averaged over n samples"""
         return 8*[0]
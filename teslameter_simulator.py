@@ -0,0 +1,489 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+import ctypes as C
+import numpy as np
+from urllib.parse import urlparse, parse_qs
+
+
+class FieldModel:
+    """Analytic magnet field model - field in mT at positions in mm.
+
+    Multipole fields are centred on (x0, y0) and, if length is given, fall off either side of z0 with a tanh
+    fringe field of the given width."""
+
+    def __init__(self, centre=(0, 0, 0), length=None, fringe=10):
+        self.centre = np.asarray(centre, dtype=float)  # magnet centre (x0, y0, z0) / mm
+        self.length = length  # magnetic length / mm, None for infinitely long magnet
+        self.fringe = fringe  # width of fringe field / mm
+
+    def longitudinal(self, z):
+        """Return field strength along z relative to the magnet centre"""
+        if self.length is None:
+            return np.ones_like(z)
+        z = z - self.centre[2]
+        half = self.length / 2
+        return 0.5 * (np.tanh((z + half) / self.fringe) - np.tanh((z - half) / self.fringe))
+
+    def transverse(self, x, y):
+        """Return (bx, by) at transverse position relative to the magnet centre"""
+        return np.zeros_like(x), np.zeros_like(y)
+
+    def field(self, x, y, z):
+        """Return arrays (bx, by, bz) / mT at positions x, y, z / mm"""
+        x, y, z = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (x, y, z)))
+        bx, by = self.transverse(x - self.centre[0], y - self.centre[1])
+        profile = self.longitudinal(z)
+        return bx * profile, by * profile, np.zeros_like(bx)
+
+
+class DipoleField(FieldModel):
+    """Uniform vertical field, e.g. dipole magnet"""
+
+    def __init__(self, b0=100, **kwargs):
+        super().__init__(**kwargs)
+        self.b0 = b0  # field / mT
+
+    def transverse(self, x, y):
+        return np.zeros_like(x), np.full_like(x, self.b0)
+
+
+class QuadrupoleField(FieldModel):
+    """Quadrupole field: bx = g y, by = g x"""
+
+    def __init__(self, gradient=10, **kwargs):
+        super().__init__(**kwargs)
+        self.gradient = gradient  # field gradient / mT/mm
+
+    def transverse(self, x, y):
+        return self.gradient * y, self.gradient * x
+
+
+class SextupoleField(FieldModel):
+    """Sextupole field: by + i bx = k (x + i y)^2"""
+
+    def __init__(self, k=1, **kwargs):
+        super().__init__(**kwargs)
+        self.k = k  # sextupole strength / mT/mm^2
+
+    def transverse(self, x, y):
+        return 2 * self.k * x * y, self.k * (x ** 2 - y ** 2)
+
+
+class GradientField(FieldModel):
+    """Field varying linearly in all three directions: B = b0 + G (r - centre)"""
+
+    def __init__(self, b0=(0, 0, 0), gradient=np.zeros((3, 3)), **kwargs):
+        super().__init__(**kwargs)
+        self.b0 = np.asarray(b0, dtype=float)  # field at centre / mT
+        self.gradient = np.asarray(gradient, dtype=float)  # dB_i/dx_j / mT/mm
+
+    def field(self, x, y, z):
+        x, y, z = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (x, y, z)))
+        r = np.stack([x, y, z]) - self.centre.reshape((3,) + (1,) * x.ndim)
+        b = self.b0.reshape((3,) + (1,) * x.ndim) + np.tensordot(self.gradient, r, axes=1)
+        return b[0], b[1], b[2]
+
+
+field_models = {'dipole': DipoleField, 'quadrupole': QuadrupoleField, 'sextupole': SextupoleField,
+                'gradient': GradientField}
+
+
+def model_from_url(url):
+    """Return (field model, options dict) from a URL such as sim://?model=quadrupole&gradient=20&noise=0.01"""
+    options = {key: values[0] for key, values in parse_qs(urlparse(url).query).items()}
+    model_class = field_models[options.pop('model', 'dipole')]
+    kwargs = {}
+    if model_class is not GradientField:  # gradient model takes vector and matrix - set up in code instead
+        for name in ('b0', 'gradient', 'k', 'length', 'fringe'):
+            if name in options:
+                kwargs[name] = float(options.pop(name))
+    return model_class(**kwargs), options
+
+
+def stage_position(mc, names=('x', 'y', 'z')):
+    """Return function giving the probe position / mm at time t, from a MotorController on a simulated PM1000"""
+    simulator = mc.serial_port.simulator
+    axes = [(simulator.axes[mc.axis[name].id], mc.axis[name].scale_factor) for name in names]
+
+    def position(t):
+        return tuple((axis.position(t) + axis.offset) / scale for axis, scale in axes)
+    return position
+
+
+class SimulatedProbeSerial(ABC):
+    """pyserial-like port for a simulated broadcasting teslameter, completed by a subclass for each device.
+
+    Frames are generated at the selected sample rate from the time broadcast starts, with fields from the field
+    model at the probe position, so reads block for as long as the real device would take."""
+
+    sample_rate = 100  # default sample rate / Hz
+
+    def __init__(self, url='sim://', model=None, position=None, noise=0.01):
+        url_model, options = model_from_url(url)
+        self.port = url
+        self.model = url_model if model is None else model  # field model
+        self.position = position if position is not None else lambda t: (0.0, 0.0, 0.0)  # probe position / mm
+        self.noise = float(options.get('noise', noise))  # standard deviation of field noise / mT
+        self.baudrate = 115200
+        self.bytesize = 8
+        self.parity = 'N'
+        self.stopbits = 1
+        self.timeout = 1
+        self.is_open = False
+
+        self.condition = threading.Condition()
+        self.commands = bytearray()  # bytes received from host not yet interpreted
+        self.rx = bytearray()  # bytes sent by device waiting to be read by host
+        self.max_backlog = 2 ** 20  # bytes held before further frames are lost
+        self.frames_lost = 0  # frames dropped because host did not read fast enough
+        self.broadcasting = False
+        self.broadcast_start = 0  # time broadcast started
+        self.frames_sent = 0  # frames generated since broadcast started
+        self.rng = np.random.default_rng()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.broadcasting = False
+
+    @abstractmethod
+    def frames(self, times):
+        """Return bytes of broadcast frames measured at the given times"""
+
+    @abstractmethod
+    def interpret(self):
+        """Act on complete commands at the start of self.commands"""
+
+    def reply(self, data):
+        self.rx += data
+
+    def start_broadcast(self):
+        if not self.broadcasting:
+            self.broadcasting = True
+            self.broadcast_start = time.time()
+            self.frames_sent = 0
+
+    def stop_broadcast(self):
+        self.generate()
+        self.broadcasting = False
+
+    def measure(self, times):
+        """Return arrays bx, by, bz / mT at the given times, with noise"""
+        start, end = np.asarray(self.position(times[0])), np.asarray(self.position(times[-1]))
+        fraction = (times - times[0]) / (times[-1] - times[0]) if len(times) > 1 else np.zeros(1)
+        x, y, z = start[:, None] + (end - start)[:, None] * fraction  # interpolate probe position over the read
+        return [b + self.rng.normal(0, self.noise, len(times)) if self.noise else b for b in self.model.field(x, y, z)]
+
+    def generate(self):
+        """Add frames due since broadcast started to receive buffer"""
+        if not self.broadcasting:
+            return
+        due = int((time.time() - self.broadcast_start) * self.sample_rate)
+        n = due - self.frames_sent
+        if n <= 0:
+            return
+        times = self.broadcast_start + (self.frames_sent + np.arange(n)) / self.sample_rate
+        data = self.frames(times)
+        space = max(0, self.max_backlog - len(self.rx)) // (len(data) // n)
+        if space < n:
+            self.frames_lost += n - space
+            data = data[:space * (len(data) // n)]
+        self.rx += data
+        self.frames_sent = due
+
+    def write(self, data):
+        with self.condition:
+            self.generate()
+            self.commands += data
+            self.interpret()
+            self.condition.notify_all()
+        return len(data)
+
+    @property
+    def in_waiting(self):
+        with self.condition:
+            self.generate()
+            return len(self.rx)
+
+    def inWaiting(self):
+        return self.in_waiting
+
+    def readinto(self, buffer):
+        size = len(buffer)
+        deadline = time.time() + (self.timeout if self.timeout is not None else 1e9)
+        with self.condition:
+            while True:
+                self.generate()
+                now = time.time()
+                if len(self.rx) >= size or now >= deadline:
+                    n = min(size, len(self.rx))
+                    buffer[:n] = self.rx[:n]
+                    del self.rx[:n]
+                    return n
+                wait = deadline - now
+                if self.broadcasting:  # wake when next frame is due
+                    wait = min(wait, (self.frames_sent + 1) / self.sample_rate + self.broadcast_start - now)
+                self.condition.wait(max(wait, 0))
+
+    def read(self, size=1):
+        buffer = bytearray(size)
+        n = self.readinto(buffer)
+        return bytes(buffer[:n])
+
+    def read_until(self, expected=b'\n', size=None):
+        data = bytearray()
+        while not data.endswith(expected) and (size is None or len(data) < size):
+            byte = self.read(1)
+            if not byte:
+                break
+            data += byte
+        return bytes(data)
+
+    def read_all(self):
+        with self.condition:
+            self.generate()
+            data = bytes(self.rx)
+            self.rx.clear()
+            return data
+
+    def readall(self):
+        return self.read_all()
+
+    def reset_input_buffer(self):
+        with self.condition:
+            self.generate()
+            self.rx.clear()
+
+    def flushInput(self):
+        self.reset_input_buffer()
+
+    def flush(self):
+        pass
+
+
+# 3MH6 broadcast packet as sent by the device: "B", bx, temperature, by, bz as big-endian floats, status, CR
+packet_dtype_3MH6 = np.dtype([('start', 'u1'), ('bx', '>f4'), ('th', '>f4'), ('by', '>f4'), ('bz', '>f4'),
+                              ('status', 'V7'), ('end', 'u1')])
+rates_3MH6 = {'23': 10, '53': 30, '63': 50, '72': 60, '82': 100, '92': 500, 'a1': 1E3, 'b0': 2E3, 'c0': 3.75E3,
+              'd0': 7.5E3, 'e0': 15E3}  # rate code: samples per second
+
+
+class Simulated3MH6(SimulatedProbeSerial):
+    """Simulated Senis 3MH6 teslameter - 25 byte packets at the rate selected with K<code>"""
+
+    sample_rate = 100
+
+    def __init__(self, url='sim://', model=None, position=None, noise=0.01, temperature=25):
+        super().__init__(url, model, position, noise)
+        self.temperature = temperature  # probe temperature / C
+        self.rate_code = '82'
+        self.range = 3  # measurement range number
+
+    def frames(self, times):
+        packets = np.zeros(len(times), dtype=packet_dtype_3MH6)
+        packets['start'] = 0x42
+        packets['end'] = 0x0d
+        packets['bx'], packets['by'], packets['bz'] = self.measure(times)
+        packets['th'] = self.temperature + self.rng.normal(0, 0.01, len(times))
+        return packets.tobytes()
+
+    def interpret(self):
+        while self.commands:
+            command = bytes(self.commands)
+            if command[:1] == b'S':
+                self.stop_broadcast()
+                used = 1
+            elif command[:1] == b'B':
+                self.start_broadcast()
+                used = 1
+            elif command[:1] == b'C':
+                self.reply(b'Calibrated mode\r\n')
+                used = 1
+            elif command[:1] == b'h':
+                self.reply(b'3MH6 simulator: S stop, B broadcast, C calibrated, K<code> rate, mr<n> range\r\n')
+                used = 1
+            elif command[:2] == b'K?':
+                self.reply(b'K' + bytes.fromhex(self.rate_code))
+                used = 2
+            elif command[:1] == b'K':
+                if len(command) < 3:
+                    return  # wait for rest of command
+                code = command[1:3].decode('ascii').lower()
+                if code in rates_3MH6:
+                    self.rate_code = code
+                    self.sample_rate = rates_3MH6[code]
+                self.reply(b'K' + bytes.fromhex(self.rate_code))
+                used = 3
+            elif command[:2] == b'mr':
+                if len(command) < 3:
+                    return
+                self.range = int(command[2:3])
+                self.reply('mrng:{}\r\n'.format(self.range).encode('ascii'))
+                used = 3
+            elif command[:1] in (b'm', b'a'):
+                if command.startswith(b'amr?'):
+                    self.reply('mrng:{}\r\n'.format(self.range).encode('ascii'))
+                    used = 4
+                elif b'amr?'.startswith(command[:4]):
+                    return
+                else:
+                    used = 1  # unknown - ignore
+            else:
+                used = 1  # unknown - ignore
+            del self.commands[:used]
+
+
+# 3MH3 broadcast frame as sent by the device: "B", bx, by, bz as little-endian int16 in units of 0.1 mT, CR
+frame_dtype_3MH3 = np.dtype([('start', 'u1'), ('bx', '<i2'), ('by', '<i2'), ('bz', '<i2'), ('end', 'u1')])
+rates_3MH3 = {128: 90, 64: 150, 32: 300, 16: 500, 8: 800, 4: 1000}  # rate code: samples per second
+
+
+class Simulated3MH3(SimulatedProbeSerial):
+    """Simulated Senis 3MH3 teslameter - 8 byte frames at the rate selected with A<code>"""
+
+    sample_rate = 300
+
+    def frames(self, times):
+        frames = np.zeros(len(times), dtype=frame_dtype_3MH3)
+        frames['start'] = ord('B')
+        frames['end'] = 0x0d
+        for name, b in zip(('bx', 'by', 'bz'), self.measure(times)):
+            frames[name] = np.clip(np.round(b * 10), -20000, 20000)  # +/- 2 T range
+        return frames.tobytes()
+
+    def interpret(self):
+        while self.commands:
+            command = bytes(self.commands)
+            if command[:1] == b'S':
+                self.stop_broadcast()
+                used = 1
+            elif command[:1] == b'B':
+                self.start_broadcast()
+                used = 1
+            elif command[:1] == b'C':
+                self.reply(b'Calibrated!')
+                used = 1
+            elif command[:1] == b'A':
+                end = command.find(b'\r')
+                if end < 0:
+                    return  # wait for rest of command
+                code = int(command[1:end] or 0)
+                if code in rates_3MH3:
+                    self.sample_rate = rates_3MH3[code]
+                self.reply(b'A' + command[1:end] + b'\r')
+                used = end + 1
+            else:
+                used = 1  # unknown - ignore
+            del self.commands[:used]
+
+
+class MockA3mtslib:
+    """Stand-in for the 3MTS software library A3mtslib64, exporting the functions in A3mtsdll.h.
+
+    Arguments are passed by reference with ctypes.byref as for the real library. Samples are produced at the rate set
+    with set_speed and buffered, so get_sensor_values_fl blocks until the next sample is due."""
+
+    ranges = [100, 500, 3000, 20000]  # measurement ranges / mT
+
+    def __init__(self, model=None, position=None, noise=0.01, buffer_size=1000):
+        self.model = DipoleField() if model is None else model
+        self.position = position if position is not None else lambda t: (0.0, 0.0, 0.0)
+        self.noise = noise  # standard deviation of field noise / mT
+        self.buffer_size = buffer_size  # number of samples held by device before the oldest are lost
+        self.period = 1  # time per sample / ms
+        self.range = 2
+        self.trigger = 0
+        self.opened = False
+        self.t0 = time.time()  # time of first sample
+        self.next_sample = 0  # index of next sample to be read
+        self.rng = np.random.default_rng()
+
+    def available(self):
+        """Return index of the newest sample taken"""
+        return int((time.time() - self.t0) * 1000 / self.period)
+
+    def count_devices(self, number_of_devices):
+        number_of_devices._obj.value = 1
+        return 0
+
+    def open_device(self, device_number):
+        self.opened = True
+        self.t0 = time.time()
+        self.next_sample = 0
+        return 0
+
+    def close_device(self, device_number):
+        self.opened = False
+        return 0
+
+    def get_device_name_ch(self, device_number, name):
+        name._obj.value = b'3MTS simulator'
+        return 0
+
+    def get_device_name(self, device_number, values):
+        return 0
+
+    def get_firmware_version_ch(self, device_number, values):
+        values._obj.value = b'simulated'
+        return 0
+
+    def get_firmware_version(self, device_number, values):
+        return 0
+
+    def get_sensor_count(self, device_number, sensor_count):
+        sensor_count._obj.value = 3
+        return 0
+
+    def clear_buffer(self, device_number):
+        self.next_sample = self.available() + 1
+        return 0
+
+    def get_sensor_values_fl(self, device_number, timestamp, sensorx, sensory, sensorz):
+        newest = self.available()
+        if newest - self.next_sample >= self.buffer_size:  # oldest samples overwritten
+            self.next_sample = newest - self.buffer_size + 1
+        t = self.t0 + self.next_sample * self.period / 1000  # time sample is taken
+        delay = t - time.time()
+        if delay > 0:
+            time.sleep(delay)  # wait for sample
+        limit = self.ranges[self.range]
+        for ref, b in zip((sensorx, sensory, sensorz), self.model.field(*self.position(t))):
+            value = float(b) + (self.rng.normal(0, self.noise) if self.noise else 0)
+            ref._obj.value = min(max(value, -limit), limit) * 1000  # field / uT
+        timestamp._obj.value = self.next_sample * self.period  # device time / ms
+        self.next_sample += 1
+        return 0
+
+    def get_sensor_values(self, device_number, timestamp, values):
+        return self.get_sensor_values_fl(device_number, timestamp, C.byref(C.c_float()), C.byref(C.c_float()),
+                                         C.byref(C.c_float()))
+
+    def set_range(self, device_number, range):
+        self.range = int(range)
+        return 0
+
+    def get_range(self, device_number, range):
+        range._obj.value = self.range
+        return 0
+
+    def set_trigger(self, device_number, trigger):
+        self.trigger = int(trigger)
+        return 0
+
+    def get_trigger(self, device_number, trigger):
+        trigger._obj.value = self.trigger
+        return 0
+
+    def set_speed(self, device_number, period):
+        self.period = max(1, int(period))
+        self.t0 = time.time()  # restart sampling at new rate
+        self.next_sample = 0
+        return 0
+
+    def get_speed(self, device_number, period):
+        period._obj.value = self.period
+        return 0
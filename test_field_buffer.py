@@ -0,0 +1,26 @@
+import numpy as np
+from field_buffer import FieldBuffer
+
+
+def samples(first, last):
+    """Return block of samples numbered first to last - 1, with the number in every column"""
+    block = FieldBuffer.new_block(last - first)
+    block[:] = np.arange(first, last)[:, None]
+    return block
+
+
+def test_block_larger_than_capacity_keeps_newest_in_order():
+    buffer = FieldBuffer(capacity=4)
+    buffer.append(samples(0, 6))
+    assert list(buffer.latest(4)[:, 0]) == [2, 3, 4, 5]
+    assert list(buffer.since(3)[:, 0]) == [3, 4, 5]
+    buffer.append(samples(6, 8))
+    assert list(buffer.latest(4)[:, 0]) == [4, 5, 6, 7]
+
+
+def test_block_larger_than_capacity_after_partial_fill():
+    buffer = FieldBuffer(capacity=4)
+    buffer.append(samples(0, 3))
+    buffer.append(samples(3, 10))
+    assert list(buffer.latest(4)[:, 0]) == [6, 7, 8, 9]
+    assert list(buffer.window(7, 9)[:, 0]) == [7, 8]
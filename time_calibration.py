@@ -0,0 +1,297 @@
+import argparse
+import datetime
+import json
+import os
+import time
+import numpy as np
+import position_fusion
+
+# Calibration profile used by the probe drivers and scan workers, unless HP_BENCH_TIME_CALIBRATION names another
+default_filename = os.environ.get('HP_BENCH_TIME_CALIBRATION',
+                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'time_calibration.json'))
+
+
+def summarise(latencies):
+    """Return dict of statistics of a set of round trip times / s"""
+    latencies = np.asarray(latencies, dtype=float)
+    if len(latencies) == 0:
+        return {'count': 0}
+    return {'count': len(latencies), 'mean': float(latencies.mean()), 'min': float(latencies.min()),
+            'p5': float(np.percentile(latencies, 5)), 'median': float(np.median(latencies)),
+            'p95': float(np.percentile(latencies, 95)), 'max': float(latencies.max()),
+            'std': float(latencies.std())}
+
+
+def fit_clock(device_times, host_times, bins=20):
+    """Return (offset / s, drift) so that host time = offset + device time * (1 + drift).
+
+    Host timestamps are late by a varying transfer latency, never early, so the line is fitted to the earliest
+    host timestamp in each of a number of bins along the device time axis (the lower envelope)."""
+    device_times = np.asarray(device_times, dtype=float)
+    difference = np.asarray(host_times, dtype=float) - device_times
+    edges = np.linspace(device_times.min(), device_times.max(), bins + 1)
+    index = np.clip(np.searchsorted(edges, device_times, side='right') - 1, 0, bins - 1)
+    lowest = np.full(bins, np.inf)
+    np.minimum.at(lowest, index, difference)
+    used = np.isfinite(lowest)
+    first = np.flatnonzero(used)
+    where = np.array([np.flatnonzero((index == b) & (difference == lowest[b]))[0] for b in first])
+    if len(where) < 2:
+        return float(lowest[used][0]), 0.0
+    drift, offset = np.polyfit(device_times[where], difference[where], 1)
+    return float(offset), float(drift)
+
+
+class TimeCalibration:
+    """Delays and clock fits which map timestamps taken by the host onto the time things actually happened.
+
+    stage_delay is the time from writing a command to the PM1000 to it acting on it - moving, or latching the
+    position it reports. probe_delay is the time from a probe measuring a sample to the host stamping it, for probes
+    without their own clock. device_clock holds (drift, latency) of probe clocks: the fractional rate error against
+    host time, and the shortest time from a sample being measured to the host stamping it.
+
+    A probe clock restarts whenever the device is opened or its sample rate changed, so its offset from host time is
+    never saved - the driver finds it afresh each session with clock_anchor."""
+
+    def __init__(self, stage_delay=None, probe_delay=None, device_clock=None, round_trips=None, created=None):
+        self.stage_delay = stage_delay  # / s, None for uncalibrated
+        self.probe_delay = dict(probe_delay or {})  # probe type: delay / s
+        self.device_clock = dict(device_clock or {})  # probe type: (drift, latency / s)
+        self.round_trips = dict(round_trips or {})  # '<device> <command>': summarise() of latencies measured
+        self.created = created  # when calibration was made
+
+    def stage_time(self, send_time, reply_time=None):
+        """Return time the PM1000 acted on a command written at host time send_time.
+
+        Uncalibrated, this is taken as half way to reply_time if given (the time its reply was read)."""
+        if self.stage_delay is None:
+            return send_time if reply_time is None else (send_time + reply_time) / 2
+        return send_time + self.stage_delay
+
+    def clock_anchor(self, device, host_times, device_times, anchor=None):
+        """Return offset / s of host time from a probe clock, from samples with host and device timestamps / s.
+
+        Host timestamps are late by a varying transfer latency, so the offset is taken from the least delayed sample
+        seen so far this session - pass the previous result as anchor, or None after the probe clock restarts."""
+        drift = self.device_clock.get(device, (0.0, 0.0))[0]
+        device_times = np.asarray(device_times, dtype=float)
+        lowest = float(np.min(np.asarray(host_times, dtype=float) - device_times * (1 + drift)))
+        return lowest if anchor is None else min(anchor, lowest)
+
+    def probe_times(self, device, host_times, device_times=None, period=None, anchor=None):
+        """Return times samples were measured, from host timestamps and device timestamps / s if the probe has them.
+
+        Device timestamps are used for calibrated probes given the session's clock anchor (see clock_anchor).
+        Without a calibration, samples stamped on arrival are taken to be measured half a sample period earlier."""
+        if device_times is not None and anchor is not None and device in self.device_clock:
+            drift, latency = self.device_clock[device]
+            return anchor + np.asarray(device_times, dtype=float) * (1 + drift) - latency
+        delay = self.probe_delay.get(device)
+        if delay is None:
+            delay = 0.5 * period if period else 0.0
+        return np.asarray(host_times, dtype=float) - delay
+
+    def as_dict(self):
+        return {'created': self.created, 'stage delay': self.stage_delay, 'probe delay': self.probe_delay,
+                'device clock': {device: {'drift': drift, 'latency': latency}
+                                 for device, (drift, latency) in self.device_clock.items()},
+                'round trips': self.round_trips}
+
+    def save(self, filename=None):
+        filename = filename or default_filename
+        with open(filename, 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        print('Time calibration saved to', filename)
+
+    @classmethod
+    def load(cls, filename=None):
+        """Return calibration read from file, or an empty calibration if there is no file"""
+        filename = filename or default_filename
+        if not os.path.exists(filename):
+            return cls()
+        with open(filename) as f:
+            data = json.load(f)
+        return cls(data.get('stage delay'), data.get('probe delay'),
+                   {device: (clock['drift'], clock.get('latency', 0.0))  # any saved offset is stale - ignored
+                    for device, clock in data.get('device clock', {}).items()},
+                   data.get('round trips'), data.get('created'))
+
+
+def stage_round_trips(mc, names=('x', 'y', 'z'), repeats=100):
+    """Return round trip times / s of "output actual" position queries to the PM1000, one axis at a time"""
+    latencies = []
+    for _ in range(repeats):
+        for name in names:
+            start = time.perf_counter()
+            mc.axis[name].get_position(set_value=False)
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def probe_round_trips(HP, repeats=20):
+    """Return round trip times / s of a query to the teslameter (sample rate query for 3MH6, range for 3MTS)"""
+    latencies = []
+    if HP.type() == '3MH6':
+        HP.stop_broadcast()
+        for _ in range(repeats):
+            start = time.perf_counter()
+            HP.ser.write(b'K?')
+            reply = HP.ser.read(2)  # "K" and rate code
+            if len(reply) == 2:
+                latencies.append(time.perf_counter() - start)
+    elif HP.type() == '3MTS':
+        for _ in range(repeats):
+            start = time.perf_counter()
+            HP.get_range()
+            latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def measure_device_clock(HP, seconds=5, block=200):
+    """Return (offset, drift) of the 3MTS clock against host time, from samples read for the given time.
+
+    The offset only holds until the probe clock next restarts."""
+    device_times = []
+    host_times = []
+    profile.device_clock.pop(HP.type(), None)  # so read_block gives raw host timestamps
+    HP.read_block(block, clear=True)  # discard stale samples
+    end = time.time() + seconds
+    while time.time() < end:
+        samples = HP.read_block(block)
+        host_times.append(samples[:, 4])
+        device_times.append(samples[:, 5] / 1000)  # device timestamps / ms
+    return fit_clock(np.concatenate(device_times), np.concatenate(host_times))
+
+
+def line_pass(HP, mc, axis, start, stop, speed, calibration):
+    """Scan axis from start to stop at speed while the probe streams; return sample times, fields and fitted
+    profile shift"""
+    motor = mc.axis[axis]
+    speed0 = motor.getSpeed()
+    motor.setSpeed(speed0)
+    mc.move_to({axis: start}, tolerance=0.005)
+    begun = time.time()
+    motor.setSpeed(speed)
+    sent = time.time()
+    motor.send_move(stop)
+    profile = position_fusion.MoveProfile(start, stop, calibration.stage_time(sent, time.time()), speed,
+                                          motor.acceleration)
+    log_times = []
+    log_positions = []
+    while True:
+        time.sleep(0.1)
+        sent = time.time()
+        log_positions.append(motor.get_position(set_value=False))
+        log_times.append(calibration.stage_time(sent, time.time()))
+        if log_times[-1] > profile.t0 + profile.duration() and not motor.is_busy():
+            break
+    motor.setSpeed(speed0)
+    samples = HP.buffer.window(begun, time.time())
+    shift, error = position_fusion.fit_shift(profile, log_times, log_positions)
+    return samples, profile, shift
+
+
+def measure_probe_delay(HP, mc, axis, start, stop, speed, calibration, max_delay=0.1, repeats=3):
+    """Return delay / s between a streaming probe measuring a sample and the host stamping it, or None.
+
+    The probe is scanned through a field gradient in both directions. A timestamp delay shifts the field profile
+    one way going forwards and the other coming back, so the delay is the one which brings the two together - the
+    median over a few forward and backward pairs. Needs a field which changes by much more than the probe noise
+    along the line."""
+    common = np.linspace(min(start, stop), max(start, stop), 200)[20:-20]  # away from the turning points
+    delays = np.linspace(0, max_delay, 401)
+    found = []
+    for _ in range(repeats):
+        forward = line_pass(HP, mc, axis, start, stop, speed, calibration)
+        backward = line_pass(HP, mc, axis, stop, start, speed, calibration)
+        change = np.ptp(forward[0][:, :3], axis=0).max()  # field change along the line / mT
+        noise = np.std(np.diff(forward[0][:, :3], axis=0), axis=0).max()
+        if change < 20 * noise:
+            print('Field changes by only {:.3f} mT along the line - too little to measure the probe delay'.format(
+                change))
+            return None
+        mismatch = []
+        for delay in delays:
+            profiles = []
+            for samples, profile, shift in (forward, backward):
+                positions = profile.position(samples[:, 4] - delay, shift)
+                order = np.argsort(positions, kind='stable')
+                profiles.append(np.column_stack([np.interp(common, positions[order], samples[order, i])
+                                                 for i in range(3)]))
+            mismatch.append(np.mean((profiles[0] - profiles[1]) ** 2))
+        found.append(delays[np.argmin(mismatch)])
+    print('Probe delays measured / ms:', ', '.join('{:.2f}'.format(1E3 * delay) for delay in found))
+    return float(np.median(found))
+
+
+def calibrate(mc, HP, axis='x', start=0, stop=4, speed=2, repeats=100):
+    """Run all calibrations possible with this probe and return a TimeCalibration"""
+    calibration = TimeCalibration(created=str(datetime.datetime.now()))
+
+    stage = stage_round_trips(mc, repeats=repeats)
+    calibration.round_trips['PM1000 oa'] = summarise(stage)
+    calibration.stage_delay = float(np.min(stage) / 2)  # one way, with no queueing
+    print('PM1000 round trip: median {:.2f} ms, p95 {:.2f} ms - stage delay {:.2f} ms'.format(
+        1E3 * np.median(stage), 1E3 * np.percentile(stage, 95), 1E3 * calibration.stage_delay))
+
+    probe = probe_round_trips(HP)
+    if len(probe):
+        calibration.round_trips['{} query'.format(HP.type())] = summarise(probe)
+        print('{} round trip: median {:.2f} ms, p95 {:.2f} ms'.format(HP.type(), 1E3 * np.median(probe),
+                                                                      1E3 * np.percentile(probe, 95)))
+
+    if HP.type() == '3MTS':
+        offset, drift = measure_device_clock(HP)
+        latency = float(np.min(probe) / 2) if len(probe) else 0.0  # one way, with no queueing
+        calibration.device_clock['3MTS'] = (drift, latency)
+        print('3MTS clock: drift {:.2f} ppm, latency {:.2f} ms'.format(1E6 * drift, 1E3 * latency))
+    else:
+        HP.start_stream()
+        if getattr(HP, 'streaming', False):
+            calibration.probe_delay[HP.type()] = 0.0  # measure from raw host timestamps
+            profile.probe_delay[HP.type()] = 0.0
+            try:
+                delay = measure_probe_delay(HP, mc, axis, start, stop, speed, calibration)
+            finally:
+                HP.stop_stream()
+            if delay is None:
+                del calibration.probe_delay[HP.type()]
+            else:
+                calibration.probe_delay[HP.type()] = delay
+                print('{} sample delay {:.1f} ms'.format(HP.type(), 1E3 * delay))
+    return calibration
+
+
+profile = TimeCalibration.load()  # calibration applied to timestamps by probe drivers and scan workers
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure serial latencies and probe/stage clock offsets')
+    parser.add_argument('--probe', default='3MH6', choices=['3MH6', '3MTS'])
+    parser.add_argument('--port', default='COM3', help='teslameter serial port (3MH6)')
+    parser.add_argument('--motor-port', default='COM1', help='PM1000 serial port')
+    parser.add_argument('--sim', action='store_true', help='calibrate simulated hardware in a quadrupole field')
+    parser.add_argument('--axis', default='x', help='axis to scan through the field gradient (3MH6)')
+    parser.add_argument('--start', type=float, default=0, help='start of gradient scan / mm')
+    parser.add_argument('--stop', type=float, default=4, help='end of gradient scan / mm')
+    parser.add_argument('--speed', type=float, default=2, help='gradient scan speed / mm/s')
+    parser.add_argument('--output', default=default_filename, help='calibration profile file')
+    args = parser.parse_args()
+
+    import time_calibration  # the module the probe drivers use, so its profile is the one calibration changes
+    import motor_controller_PM1000
+    from teslameter_3MH6 import teslameter_3MH6
+    from teslameter_3MTS import teslameter_3MTS
+    mc = motor_controller_PM1000.MotorController('sim://' if args.sim else args.motor_port)
+    if args.sim:
+        import teslameter_simulator
+        import scan_benchmark
+        HP = scan_benchmark.open_probe(args.probe, mc, teslameter_simulator.QuadrupoleField(gradient=20))
+    else:
+        HP = teslameter_3MH6(args.port) if args.probe == '3MH6' else teslameter_3MTS()
+        HP.open()
+    try:
+        time_calibration.calibrate(mc, HP, args.axis, args.start, args.stop, args.speed).save(args.output)
+    finally:
+        HP.close()
+        mc.close()